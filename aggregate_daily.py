@@ -4,48 +4,490 @@
 # statistiques (prix, spreads, volumes, ratios) — y compris :
 #   pct_spread, coef_var_buy, true_range, vwap_buy/vwap_sell,
 #   imbalance_qty, sell_through_rate, atr_like.
-# Si l'item n'existe pas dans la table items, on appelle l’API GW2
-# pour récupérer son nom (en anglais) et on l’insère automatiquement,
-# puis on upsert dans snapshots et on purge le brut.
+# Les items absents de la table items sont insérés (nom du cache
+# local, sinon placeholder auto_{id}, voir item_names.py), puis on
+# upsert dans snapshots, on construit les barres OHLC 5 min / 1 h
+# (bars.py) et on purge le brut.
+#
+# Modes :
+#   --mode sql  (défaut) : tous les jours complets en un seul
+#                INSERT … SELECT … ON CONFLICT DO UPDATE, métriques
+#                dérivées calculées en SQL, purge par plage de ts
+#                (ou suppression des partitions journalières) ;
+#   --mode rollup : finalisation O(items) depuis intraday_rollup
+#                (médiane approchée, ou exacte avec --exact-median) ;
+#                sans relire daily_raw, donc sans barres OHLC sauf
+#                avec --bars ;
+#   --mode loop : l'ancien traitement jour par jour avec merge ORM ;
+#   --mode sharded : pour les gros arriérés, tranches (jour × plage
+#                d'item_id) en parallèle sur --workers connexions, une
+#                transaction par tranche, reprise possible après
+#                interruption (table aggregation_shards).
+# --forward-fill (modes sql, sharded) reconstruit la série complète quand daily_raw
+# ne contient que des captures delta (fetch_to_daily_raw --delta).
+# Si HISTORY_CACHE_DIR est défini, les mois agrégés sont ensuite
+# ré-exportés dans le cache local en colonnes (history_cache.py).
+# Si TICK_ARCHIVE_DIR est défini, les ticks de chaque jour sont
+# archivés avant la purge (tick_archive.py, ré-agrégation possible).
 # ------------------------------------------------------------------
 
+import argparse
 import datetime
 import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 load_dotenv()
-import os
-if not os.getenv("DATABASE_URL"):
-    raise RuntimeError("DATABASE_URL n'est pas défini (ni dans .env, ni en variable d'environnement).")
-import requests                       # ← nouveau
-from sqlalchemy import select, func, case, BigInteger
-from models import Session, DailyRaw, Snapshot, Item
+from sqlalchemy import (
+    select, delete, update, func, case, cast, and_, or_, true, false, union_all,
+    BigInteger, Date, Integer, Numeric,
+)
+from sqlalchemy.dialects.postgresql import array, insert as pg_insert
+from models import (
+    Session, DailyRaw, Snapshot, IntradayRollup, RawCapture, Item, AggregationShard,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    daily_raw_partitioned, daily_partitions, drop_daily_partitions, notify,
+)
+from item_names import ensure_items
+from rollup import rollup_stats
+from bars import upsert_bars, expire_bars
+import tick_store
+
+
+# ------------------------------------------------------------------
+# Ticks bruts sur [start, end[ — filtre par plage, utilisable par index
+# items = (lo, hi) : seulement les item_id de [lo, hi[ (mode sharded)
+# daily_raw ou daily_ticks selon RAW_STORAGE (voir tick_store.py)
+# ------------------------------------------------------------------
+raw_ticks = tick_store.ticks
+
+
+# ------------------------------------------------------------------
+# Ticks reconstruits (forward-fill) sur la grille des captures : pour
+# chaque item et chaque capture de raw_captures, la dernière valeur
+# connue.  Nécessaire quand daily_raw ne contient que des deltas.
+# Un jour sans raw_captures (chargé sans capture, ex. import_scraped_
+# trends) prend pour grille les ts distincts de ses ticks.  Un item
+# absent d'une keyframe n'est plus reporté jusqu'à son retour.
+# ------------------------------------------------------------------
+def ff_ticks(start: datetime.datetime | None, end: datetime.datetime,
+             items_range: tuple[int, int] | None = None):
+    raw = raw_ticks(start, end, items_range).subquery("raw")
+    r = raw.c
+    seen = raw_ticks(start, end, items_range).subquery("seen")
+
+    captured = select(RawCapture.ts, RawCapture.keyframe).where(RawCapture.ts < end)
+    if start is not None:
+        captured = captured.where(RawCapture.ts >= start)
+    cap_days = captured.with_only_columns(func.date_trunc("day", RawCapture.ts)).distinct()
+    if items_range is None:
+        fallback = select(seen.c.ts).where(func.date_trunc("day", seen.c.ts).not_in(cap_days))
+    else:
+        # tranche d'un jour : même grille pour toutes les tranches (tous
+        # les items), lue seulement si le jour n'a aucune capture
+        every = raw_ticks(start, end).subquery("every")
+        fallback = select(every.c.ts).where(~captured.exists())
+    fallback = fallback.add_columns(false().label("keyframe")).distinct()
+    grid = union_all(captured, fallback).subquery("grid")
+    caps = select(
+        grid.c.ts.label("cap_ts"), grid.c.keyframe,
+        func.lead(grid.c.ts).over(order_by=grid.c.ts).label("next_ts"),
+    ).subquery("caps")
+    items = select(seen.c.item_id).distinct().subquery("items")
+
+    # un tick réel au plus par (item, capture) ; grp compte les ticks
+    # réels et les keyframes manquées vus jusque-là, les trous héritent
+    # du dernier
+    present = r.ts.is_not(None)
+    j = (
+        select(
+            items.c.item_id, caps.c.cap_ts, r.ts, present.label("present"),
+            r.buy_price, r.sell_price, r.buy_quantity, r.sell_quantity,
+            func.count(case((or_(present, caps.c.keyframe), 1)))
+                .over(partition_by=items.c.item_id, order_by=caps.c.cap_ts).label("grp"),
+        )
+        .select_from(
+            items.join(caps, true()).outerjoin(raw, and_(
+                r.item_id == items.c.item_id,
+                r.ts >= caps.c.cap_ts,
+                or_(caps.c.next_ts.is_(None), r.ts < caps.c.next_ts),
+            ))
+        )
+        .subquery("joined")
+    )
+
+    def fill(col):
+        return func.first_value(col).over(partition_by=(j.c.item_id, j.c.grp),
+                                          order_by=j.c.cap_ts)
+
+    f = (
+        select(
+            j.c.item_id,
+            func.coalesce(j.c.ts, j.c.cap_ts).label("ts"),
+            fill(j.c.buy_price).label("buy_price"),
+            fill(j.c.sell_price).label("sell_price"),
+            fill(j.c.buy_quantity).label("buy_quantity"),
+            fill(j.c.sell_quantity).label("sell_quantity"),
+            fill(j.c.present).label("alive"),
+        )
+        .where(j.c.grp > 0)          # avant la 1re observation : rien à reporter
+        .subquery("filled")
+    )
+    # groupe ouvert par une keyframe manquée : l'item a disparu
+    return select(*(c for c in f.c if c.name != "alive")).where(f.c.alive)
+
+
+# ------------------------------------------------------------------
+# Statistiques brutes par (item_id, jour) à partir d'un SELECT de ticks
+# (colonnes item_id, ts, buy/sell_price, buy/sell_quantity)
+# ------------------------------------------------------------------
+def daily_stats(ticks):
+    t = ticks.subquery("ticks")
+    day = func.date_trunc("day", t.c.ts)
+
+    # ========= CTE 1 : snapshots + LAG des quantités =============
+    lagged = (
+        select(
+            t.c.item_id, day.label("day"), t.c.ts,
+            t.c.buy_price, t.c.sell_price,
+            t.c.buy_quantity, t.c.sell_quantity,
+            func.lag(t.c.buy_quantity)
+                .over(partition_by=(t.c.item_id, day),
+                      order_by=t.c.ts).label("prev_buy_qty"),
+            func.lag(t.c.sell_quantity)
+                .over(partition_by=(t.c.item_id, day),
+                      order_by=t.c.ts).label("prev_sell_qty"),
+        )
+        .cte("lagged")
+    )
+
+    # ========= CTE 2 : calcul de toutes les fenêtres =============
+    w = lagged.alias()
+    part = (w.c.item_id, w.c.day)
+
+    with_windows = (
+        select(
+            w.c.item_id, w.c.day, w.c.ts,
+            w.c.buy_price, w.c.sell_price,
+            w.c.buy_quantity, w.c.sell_quantity,
+            w.c.prev_buy_qty, w.c.prev_sell_qty,
+
+            func.first_value(w.c.buy_price)
+                .over(partition_by=part,
+                      order_by=w.c.ts).label("open_buy"),
+            func.first_value(w.c.sell_price)
+                .over(partition_by=part,
+                      order_by=w.c.ts).label("open_sell"),
+
+            func.last_value(w.c.buy_price)
+                .over(partition_by=part,
+                      order_by=w.c.ts,
+                      rows=(None, None)).label("close_buy"),
+            func.last_value(w.c.sell_price)
+                .over(partition_by=part,
+                      order_by=w.c.ts,
+                      rows=(None, None)).label("close_sell"),
+
+            (w.c.sell_price - w.c.buy_price).label("spread"),
+
+            case(
+                (w.c.prev_sell_qty > w.c.sell_quantity,
+                 w.c.prev_sell_qty - w.c.sell_quantity), else_=0
+            ).label("delta_exec_buy"),
+            case(
+                (w.c.prev_buy_qty > w.c.buy_quantity,
+                 w.c.prev_buy_qty - w.c.buy_quantity), else_=0
+            ).label("delta_exec_sell"),
+        )
+    ).cte("with_windows")
+
+    # ========= SELECT final : uniquement des agrégats ============
+    z = with_windows.alias()
+
+    return (
+        select(
+            z.c.item_id,
+            z.c.day,
+
+            func.min(z.c.open_buy).label("open_buy"),
+            func.min(z.c.open_sell).label("open_sell"),
+            func.max(z.c.close_buy).label("close_buy"),
+            func.max(z.c.close_sell).label("close_sell"),
+
+            func.min(z.c.buy_price).label("min_buy"),
+            func.max(z.c.buy_price).label("max_buy"),
+            func.min(z.c.sell_price).label("min_sell"),
+            func.max(z.c.sell_price).label("max_sell"),
+
+            func.avg(z.c.buy_price).label("avg_buy"),
+            func.avg(z.c.sell_price).label("avg_sell"),
+
+            func.percentile_cont(0.5).within_group(
+                z.c.buy_price).label("median_buy"),
+            func.percentile_cont(0.5).within_group(
+                z.c.sell_price).label("median_sell"),
+
+            func.stddev_pop(z.c.buy_price).label("std_buy"),
+            func.stddev_pop(z.c.sell_price).label("std_sell"),
+
+            func.avg(z.c.spread).label("avg_spread"),
+            func.min(z.c.spread).label("min_spread"),
+            func.max(z.c.spread).label("max_spread"),
+
+            (func.max(z.c.buy_price) - func.min(z.c.buy_price)).label("delta_buy"),
+            (func.max(z.c.sell_price) - func.min(z.c.sell_price)).label("delta_sell"),
+
+            func.sum(z.c.buy_quantity).label("tot_buy_listed"),
+            func.sum(z.c.sell_quantity).label("tot_sell_listed"),
+            func.sum(z.c.delta_exec_buy.cast(BigInteger)).label("exec_buy_qty"),
+            func.sum(z.c.delta_exec_sell.cast(BigInteger)).label("exec_sell_qty"),
+        )
+        .group_by(z.c.item_id, z.c.day)
+    )
 
 
 # ------------------------------------------------------------------
-# Récupère le nom officiel d’un item (API GW2, langue « en »)
+# Colonnes de snapshots calculées en SQL à partir de daily_stats()
+# (mêmes formules que derive_metrics ; int() ≙ trunc())
 # ------------------------------------------------------------------
-def fetch_item_name(item_id: int) -> str | None:
-    url = f"https://api.guildwars2.com/v2/items/{item_id}?lang=en"
-    try:
-        resp = requests.get(url, timeout=5)
-        resp.raise_for_status()
-        return resp.json().get("name")
-    except Exception:
-        return None
+def snapshot_columns(r) -> dict:
+    def trunc(x):
+        return cast(func.trunc(x), Integer)
+
+    def ratio(num, den):
+        return cast(num, Numeric) / func.nullif(den, 0)
+
+    return dict(
+        item_id = r.item_id, ts = r.day,
+
+        open_buy_price   = r.open_buy,
+        open_sell_price  = r.open_sell,
+        close_buy_price  = r.close_buy,
+        close_sell_price = r.close_sell,
+
+        min_buy_price  = r.min_buy,
+        max_buy_price  = r.max_buy,
+        min_sell_price = r.min_sell,
+        max_sell_price = r.max_sell,
+
+        avg_buy_price  = trunc(r.avg_buy),
+        avg_sell_price = trunc(r.avg_sell),
+        median_buy_price  = trunc(r.median_buy),
+        median_sell_price = trunc(r.median_sell),
+        std_buy_price  = r.std_buy,
+        std_sell_price = r.std_sell,
+
+        avg_spread = trunc(r.avg_spread),
+        min_spread = r.min_spread,
+        max_spread = r.max_spread,
+
+        delta_buy_price  = r.delta_buy,
+        delta_sell_price = r.delta_sell,
+        pct_change_buy  = ratio((r.close_buy  - r.open_buy)  * 100, r.open_buy),
+        pct_change_sell = ratio((r.close_sell - r.open_sell) * 100, r.open_sell),
+
+        total_buy_qty_listed  = r.tot_buy_listed,
+        total_sell_qty_listed = r.tot_sell_listed,
+        exec_buy_qty  = r.exec_buy_qty,
+        exec_sell_qty = r.exec_sell_qty,
+
+        buy_liquidity_ratio  = ratio(r.exec_sell_qty, r.tot_sell_listed),
+        sell_liquidity_ratio = ratio(r.exec_buy_qty,  r.tot_buy_listed),
+
+        pct_spread        = ratio(r.avg_spread * 100, r.avg_sell),
+        coef_var_buy      = ratio(r.std_buy, r.avg_buy),
+        true_range        = r.max_sell - r.min_buy,
+        vwap_buy          = trunc(r.avg_buy),
+        vwap_sell         = trunc(r.avg_sell),
+        imbalance_qty     = r.tot_buy_listed - r.tot_sell_listed,
+        sell_through_rate = ratio(r.exec_sell_qty, r.exec_sell_qty + r.tot_sell_listed),
+        atr_like          = r.delta_buy + r.delta_sell,
+    )
 
 
+# ------------------------------------------------------------------
+# Upsert ensembliste : stats → snapshots en une seule requête
+# ------------------------------------------------------------------
+def upsert_snapshots(s, stats) -> list[datetime.date]:
+    """Upsert dans snapshots ; retourne le jour (date) de chaque ligne écrite."""
+    r = stats.subquery("stats")
+    cols = snapshot_columns(r.c)
+
+    stmt = pg_insert(Snapshot).from_select(list(cols), select(*cols.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["item_id", "ts"],
+        set_={c: stmt.excluded[c] for c in cols if c not in ("item_id", "ts")},
+    ).returning(cast(Snapshot.ts, Date))       # ts date ou timestamp selon le schéma
+    return s.execute(stmt).scalars().all()
+
+
+def archive_raw(s, days, ticks=None) -> None:
+    """Archive les ticks des jours `days` avant leur purge, si TICK_ARCHIVE_DIR.
+    `ticks` : ceux que l'agrégation a lus (forward-fill), exportés en un seul
+    passage quelle que soit la plage ; sinon le brut, jour par jour."""
+    if os.getenv("TICK_ARCHIVE_DIR"):
+        import tick_archive                     # numpy/pandas : seulement si utilisé
+        tick_archive.export_days(s, days, ticks=ticks)
+
+
+def purge_raw(s, start: datetime.datetime | None, end: datetime.datetime) -> str:
+    """Purge le brut de [start, end) ; retourne un résumé pour l'affichage.
+
+    daily_raw partitionnée : les partitions des jours agrégés sont
+    détachées puis supprimées (ni DELETE ni VACUUM) ; sinon DELETE par
+    plage de ts.  start/end sont des minuits.
+    """
+    q = delete(DailyRaw).where(DailyRaw.ts < end)
+    r = delete(IntradayRollup).where(IntradayRollup.day < end.date())
+    c = delete(RawCapture).where(RawCapture.ts < end)
+    if start is not None:
+        q = q.where(DailyRaw.ts >= start)
+        r = r.where(IntradayRollup.day >= start.date())
+        c = c.where(RawCapture.ts >= start)
+    s.execute(r)                       # accumulateurs des jours finalisés
+    s.execute(c)
+    expire_bars(s, end)                # barres 5 min hors rétention
+    packed = tick_store.purge_packed(s, start, end)
+    conn = s.connection()
+    if daily_raw_partitioned(conn):
+        dropped = drop_daily_partitions(conn, start and start.date(), end.date())
+        done = f"{len(dropped)} partition(s) brute(s) supprimée(s)"
+    else:
+        done = f"{s.execute(q).rowcount} lignes brutes purgées"
+    return done + (f", {packed} lignes daily_ticks" if packed else "")
+
+
+def purge_days(s, days) -> str:
+    """Purge le brut des seuls jours `days` (ceux réellement agrégés), par
+    plages de jours consécutifs ; les autres jours restent en attente."""
+    one = datetime.timedelta(days=1)
+    runs = []
+    for day in sorted(set(days)):
+        ts0 = datetime.datetime.combine(day, datetime.time())
+        if runs and runs[-1][1] == ts0:
+            runs[-1][1] = ts0 + one
+        else:
+            runs.append([ts0, ts0 + one])
+    return " ; ".join(purge_raw(s, start, end) for start, end in runs)
+
+
+# ------------------------------------------------------------------
+# Mode sql : tous les jours complets (< aujourd'hui) d'un seul coup
+# ------------------------------------------------------------------
+def aggregate_pending_days(from_rollup: bool = False, exact_median: bool = False,
+                           forward_fill: bool = False, with_bars: bool | None = None) -> None:
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    # les barres se construisent depuis les ticks : en mode rollup, seulement
+    # sur demande (elles reliraient tout daily_raw)
+    if with_bars is None:
+        with_bars = not from_rollup
+
+    ticks = ff_ticks(None, today) if forward_fill else raw_ticks(None, today)
+    stats = rollup_stats(None, today, exact_median) if from_rollup else daily_stats(ticks)
+
+    with Session() as s:
+        # la FK daily_raw.item_id → items garantit que chaque item existe
+        days = upsert_snapshots(s, stats)
+        if from_rollup:
+            # jours bruts sans accumulateurs (arriéré antérieur au rollup) ou
+            # écartés par rollup_stats (ticks reçus hors ordre) : finalisés
+            # depuis les ticks plutôt que purgés sans snapshot
+            for day in sorted(set(pending_days(s, today.date())) - set(days)):
+                ts0 = datetime.datetime.combine(day, datetime.time())
+                days += upsert_snapshots(s, daily_stats(raw_ticks(ts0, ts0 + datetime.timedelta(days=1))))
+        if not days:
+            print("👍 Rien à agréger.")
+            return
+        bars = f"{upsert_bars(s, ticks)} barres 5 min" if with_bars else "sans barres"
+        archive_raw(s, days, ticks if forward_fill and not from_rollup else None)
+        purged = purge_days(s, days)             # jamais un jour sans snapshot
+        notify(s.connection(), "snapshots")
+        s.commit()
+        print(f"✅ {len(days)} snapshots upsertés, {bars}, {purged}.")
+
+    if os.getenv("HISTORY_CACHE_DIR"):
+        import history_cache                    # numpy/pandas : seulement si utilisé
+        history_cache.update(set(days))
+
+
+# ------------------------------------------------------------------
+# Métriques dérivées côté Python (mode loop)
+# ------------------------------------------------------------------
+def derive_metrics(r) -> dict:
+    # ratios simples
+    pct_buy  = ((r.close_buy  - r.open_buy)  * 100 / r.open_buy)  if r.open_buy  else None
+    pct_sell = ((r.close_sell - r.open_sell) * 100 / r.open_sell) if r.open_sell else None
+    buy_liq  = (r.exec_sell_qty / r.tot_sell_listed) if r.tot_sell_listed else None
+    sell_liq = (r.exec_buy_qty  / r.tot_buy_listed)  if r.tot_buy_listed  else None
+
+    # métriques dérivées
+    pct_spread       = (r.avg_spread * 100 / r.avg_sell) if r.avg_sell else None
+    coef_var_buy     = (r.std_buy / r.avg_buy) if r.avg_buy else None
+    true_range       = r.max_sell - r.min_buy
+    vwap_buy         = int(r.avg_buy)
+    vwap_sell        = int(r.avg_sell)
+    imbalance_qty    = r.tot_buy_listed - r.tot_sell_listed
+    sell_through_rate = (r.exec_sell_qty / (r.exec_sell_qty + r.tot_sell_listed)
+                         if (r.exec_sell_qty + r.tot_sell_listed) else None)
+    atr_like         = r.delta_buy + r.delta_sell
+
+    return dict(
+        open_buy_price   = r.open_buy,
+        open_sell_price  = r.open_sell,
+        close_buy_price  = r.close_buy,
+        close_sell_price = r.close_sell,
+
+        min_buy_price  = r.min_buy,
+        max_buy_price  = r.max_buy,
+        min_sell_price = r.min_sell,
+        max_sell_price = r.max_sell,
+
+        avg_buy_price  = int(r.avg_buy),
+        avg_sell_price = int(r.avg_sell),
+        median_buy_price  = int(r.median_buy),
+        median_sell_price = int(r.median_sell),
+        std_buy_price = r.std_buy,
+        std_sell_price = r.std_sell,
+
+        avg_spread = int(r.avg_spread),
+        min_spread = r.min_spread,
+        max_spread = r.max_spread,
+
+        delta_buy_price = r.delta_buy,
+        delta_sell_price = r.delta_sell,
+        pct_change_buy  = pct_buy,
+        pct_change_sell = pct_sell,
+
+        total_buy_qty_listed  = r.tot_buy_listed,
+        total_sell_qty_listed = r.tot_sell_listed,
+        exec_buy_qty = r.exec_buy_qty,
+        exec_sell_qty = r.exec_sell_qty,
+
+        buy_liquidity_ratio  = buy_liq,
+        sell_liquidity_ratio = sell_liq,
+
+        pct_spread        = pct_spread,
+        coef_var_buy      = coef_var_buy,
+        true_range        = true_range,
+        vwap_buy          = vwap_buy,
+        vwap_sell         = vwap_sell,
+        imbalance_qty     = imbalance_qty,
+        sell_through_rate = sell_through_rate,
+        atr_like          = atr_like,
+    )
+
+
+# ------------------------------------------------------------------
+# Mode loop : jour par jour, merge ORM item par item
+# ------------------------------------------------------------------
 def aggregate_all_days() -> None:
     today = datetime.date.today()
 
     with Session() as s:
-        # ── jours complets (≤ hier) encore présents dans daily_raw ───────
-        days = [
-            d for (d,) in
-            s.query(func.date(DailyRaw.ts))
-             .filter(func.date(DailyRaw.ts) < today)
-             .group_by(func.date(DailyRaw.ts))
-        ]
+        # ── jours complets (≤ hier) encore présents dans le brut ────────
+        days = pending_days(s, today)
         if not days:
             print("👍 Rien à agréger.")
             return
@@ -53,184 +495,196 @@ def aggregate_all_days() -> None:
         for day in days:
             print(f"📊 Agrégation du {day} …")
 
-            # ========= CTE 1 : snapshots + LAG des quantités =============
-            lagged = (
-                select(
-                    DailyRaw.item_id, DailyRaw.ts,
-                    DailyRaw.buy_price, DailyRaw.sell_price,
-                    DailyRaw.buy_quantity, DailyRaw.sell_quantity,
-                    func.lag(DailyRaw.buy_quantity)
-                        .over(partition_by=DailyRaw.item_id,
-                              order_by=DailyRaw.ts).label("prev_buy_qty"),
-                    func.lag(DailyRaw.sell_quantity)
-                        .over(partition_by=DailyRaw.item_id,
-                              order_by=DailyRaw.ts).label("prev_sell_qty"),
-                )
-                .where(func.date(DailyRaw.ts) == day)
-                .cte("lagged")
-            )
-
-            # ========= CTE 2 : calcul de toutes les fenêtres =============
-            w = lagged.alias()
-
-            with_windows = (
-                select(
-                    w.c.item_id, w.c.ts,
-                    w.c.buy_price, w.c.sell_price,
-                    w.c.buy_quantity, w.c.sell_quantity,
-                    w.c.prev_buy_qty, w.c.prev_sell_qty,
-
-                    func.first_value(w.c.buy_price)
-                        .over(partition_by=w.c.item_id,
-                              order_by=w.c.ts).label("open_buy"),
-                    func.first_value(w.c.sell_price)
-                        .over(partition_by=w.c.item_id,
-                              order_by=w.c.ts).label("open_sell"),
-
-                    func.last_value(w.c.buy_price)
-                        .over(partition_by=w.c.item_id,
-                              order_by=w.c.ts,
-                              rows=(None, None)).label("close_buy"),
-                    func.last_value(w.c.sell_price)
-                        .over(partition_by=w.c.item_id,
-                              order_by=w.c.ts,
-                              rows=(None, None)).label("close_sell"),
-
-                    (w.c.sell_price - w.c.buy_price).label("spread"),
-
-                    case(
-                        (w.c.prev_sell_qty > w.c.sell_quantity,
-                         w.c.prev_sell_qty - w.c.sell_quantity), else_=0
-                    ).label("delta_exec_buy"),
-                    case(
-                        (w.c.prev_buy_qty > w.c.buy_quantity,
-                         w.c.prev_buy_qty - w.c.buy_quantity), else_=0
-                    ).label("delta_exec_sell"),
-                )
-            ).cte("with_windows")
-
-            # ========= SELECT final : uniquement des agrégats ============
-            z = with_windows.alias()
-
-            rows = s.execute(
-                select(
-                    z.c.item_id,
-
-                    func.min(z.c.open_buy).label("open_buy"),
-                    func.min(z.c.open_sell).label("open_sell"),
-                    func.max(z.c.close_buy).label("close_buy"),
-                    func.max(z.c.close_sell).label("close_sell"),
-
-                    func.min(z.c.buy_price).label("min_buy"),
-                    func.max(z.c.buy_price).label("max_buy"),
-                    func.min(z.c.sell_price).label("min_sell"),
-                    func.max(z.c.sell_price).label("max_sell"),
-
-                    func.avg(z.c.buy_price).label("avg_buy"),
-                    func.avg(z.c.sell_price).label("avg_sell"),
-
-                    func.percentile_cont(0.5).within_group(
-                        z.c.buy_price).label("median_buy"),
-                    func.percentile_cont(0.5).within_group(
-                        z.c.sell_price).label("median_sell"),
-
-                    func.stddev_pop(z.c.buy_price).label("std_buy"),
-                    func.stddev_pop(z.c.sell_price).label("std_sell"),
-
-                    func.avg(z.c.spread).label("avg_spread"),
-                    func.min(z.c.spread).label("min_spread"),
-                    func.max(z.c.spread).label("max_spread"),
-
-                    (func.max(z.c.buy_price) - func.min(z.c.buy_price)).label("delta_buy"),
-                    (func.max(z.c.sell_price) - func.min(z.c.sell_price)).label("delta_sell"),
-
-                    func.sum(z.c.buy_quantity).label("tot_buy_listed"),
-                    func.sum(z.c.sell_quantity).label("tot_sell_listed"),
-                    func.sum(z.c.delta_exec_buy.cast(BigInteger)).label("exec_buy_qty"),
-                    func.sum(z.c.delta_exec_sell.cast(BigInteger)).label("exec_sell_qty"),
-                )
-                .group_by(z.c.item_id)
-            ).fetchall()
-
-            # ========= insertion / merge dans snapshots ===================
             ts0 = datetime.datetime.combine(day, datetime.time())
+            ts1 = ts0 + datetime.timedelta(days=1)
+            rows = s.execute(daily_stats(raw_ticks(ts0, ts1))).fetchall()
 
+            # ========= items absents : un SELECT, API par lots, un INSERT ==
+            ensure_items(s.connection(), {r.item_id for r in rows})
+
+            # ========= insertion / merge dans snapshots ===================
             for r in rows:
-                # 0) créer l'item s'il n'existe pas (nom réel ou placeholder)
-                if not s.get(Item, r.item_id):
-                    real_name = fetch_item_name(r.item_id) or f"auto_{r.item_id}"
-                    s.add(Item(id=r.item_id, name=real_name))
-                    s.flush()  # FK OK
-
-                # ratios simples
-                pct_buy  = ((r.close_buy  - r.open_buy)  * 100 / r.open_buy)  if r.open_buy  else None
-                pct_sell = ((r.close_sell - r.open_sell) * 100 / r.open_sell) if r.open_sell else None
-                buy_liq  = (r.exec_sell_qty / r.tot_sell_listed) if r.tot_sell_listed else None
-                sell_liq = (r.exec_buy_qty  / r.tot_buy_listed)  if r.tot_buy_listed  else None
-
-                # métriques dérivées
-                pct_spread       = (r.avg_spread * 100 / r.avg_sell) if r.avg_sell else None
-                coef_var_buy     = (r.std_buy / r.avg_buy) if r.avg_buy else None
-                true_range       = r.max_sell - r.min_buy
-                vwap_buy         = int(r.avg_buy)
-                vwap_sell        = int(r.avg_sell)
-                imbalance_qty    = r.tot_buy_listed - r.tot_sell_listed
-                sell_through_rate = (r.exec_sell_qty / (r.exec_sell_qty + r.tot_sell_listed)
-                                     if (r.exec_sell_qty + r.tot_sell_listed) else None)
-                atr_like         = r.delta_buy + r.delta_sell
-
-                s.merge(Snapshot(
-                    item_id = r.item_id, ts = ts0,
-
-                    open_buy_price   = r.open_buy,
-                    open_sell_price  = r.open_sell,
-                    close_buy_price  = r.close_buy,
-                    close_sell_price = r.close_sell,
-
-                    min_buy_price  = r.min_buy,
-                    max_buy_price  = r.max_buy,
-                    min_sell_price = r.min_sell,
-                    max_sell_price = r.max_sell,
-
-                    avg_buy_price  = int(r.avg_buy),
-                    avg_sell_price = int(r.avg_sell),
-                    median_buy_price  = int(r.median_buy),
-                    median_sell_price = int(r.median_sell),
-                    std_buy_price = r.std_buy,
-                    std_sell_price = r.std_sell,
-
-                    avg_spread = int(r.avg_spread),
-                    min_spread = r.min_spread,
-                    max_spread = r.max_spread,
-
-                    delta_buy_price = r.delta_buy,
-                    delta_sell_price = r.delta_sell,
-                    pct_change_buy  = pct_buy,
-                    pct_change_sell = pct_sell,
-
-                    total_buy_qty_listed  = r.tot_buy_listed,
-                    total_sell_qty_listed = r.tot_sell_listed,
-                    exec_buy_qty = r.exec_buy_qty,
-                    exec_sell_qty = r.exec_sell_qty,
-
-                    buy_liquidity_ratio  = buy_liq,
-                    sell_liquidity_ratio = sell_liq,
-
-                    pct_spread        = pct_spread,
-                    coef_var_buy      = coef_var_buy,
-                    true_range        = true_range,
-                    vwap_buy          = vwap_buy,
-                    vwap_sell         = vwap_sell,
-                    imbalance_qty     = imbalance_qty,
-                    sell_through_rate = sell_through_rate,
-                    atr_like          = atr_like,
-                ))
-
-            # ========= purge du brut du jour ==============================
-            s.query(DailyRaw).filter(func.date(DailyRaw.ts) == day).delete(synchronize_session=False)
+                s.merge(Snapshot(item_id=r.item_id, ts=ts0, **derive_metrics(r)))
+
+            # ========= barres OHLC puis purge du brut du jour =============
+            upsert_bars(s, raw_ticks(ts0, ts1))
+            archive_raw(s, [day])
+            purge_raw(s, ts0, ts1)
+            notify(s.connection(), "snapshots")
             s.commit()
             print(f"✅ {day} agrégé & purgé.")
 
+    if os.getenv("HISTORY_CACHE_DIR"):
+        import history_cache
+        history_cache.update(days)
+
+
+# ------------------------------------------------------------------
+# Mode sharded : tranches (jour × plage d'item_id) agrégées en
+# parallèle, une transaction par tranche, avancement dans
+# aggregation_shards ; un jour n'est purgé qu'une fois toutes ses
+# tranches commitées.  Relancer reprend les tranches non faites.
+# ------------------------------------------------------------------
+SHARDS      = 8                        # tranches d'item_id par jour
+WORKERS     = 4                        # connexions simultanées
+ITEM_ID_MAX = 2**31 - 1
+
+
+def item_bounds(s, days, shards: int) -> list[int]:
+    """Bornes de `shards` plages [lo, hi[ d'effectifs égaux : quantiles des
+    item_id de intraday_rollup sur `days` (un par item et par jour ingéré),
+    à défaut de la table items."""
+    fractions = array([k / shards for k in range(1, shards)])
+    cuts = s.scalar(
+        select(func.percentile_disc(fractions).within_group(IntradayRollup.item_id))
+        .where(IntradayRollup.day.in_(days))
+    )
+    if cuts is None:
+        cuts = s.scalar(select(func.percentile_disc(fractions).within_group(Item.id)))
+    return [0, *sorted({c for c in cuts or () if c > 0}), ITEM_ID_MAX]
+
+
+def pending_days(s, today: datetime.date) -> list[datetime.date]:
+    """Jours complets encore présents dans daily_raw ou daily_ticks."""
+    conn = s.connection()
+    midnight = datetime.datetime.combine(today, datetime.time())
+    if daily_raw_partitioned(conn):
+        days = {d for d in daily_partitions(conn) if d < today}
+    else:
+        days = set(s.scalars(
+            select(func.date(DailyRaw.ts)).where(DailyRaw.ts < midnight).group_by(func.date(DailyRaw.ts))
+        ))
+    if tick_store.PACKED:
+        days |= tick_store.packed_days(s, midnight)
+    return sorted(days)
+
+
+def plan_shards(s, days, shards: int) -> None:
+    """Crée les tranches des jours pas encore planifiés (les autres gardent les leurs)."""
+    planned = set(s.scalars(select(AggregationShard.day).distinct()))
+    days = [d for d in days if d not in planned]
+    if not days:
+        return
+    bounds = item_bounds(s, days, shards)
+    s.execute(pg_insert(AggregationShard).values([
+        {"day": d, "item_lo": lo, "item_hi": hi}
+        for d in days for lo, hi in zip(bounds, bounds[1:])
+    ]).on_conflict_do_nothing())
+
+
+def run_shard(day: datetime.date, lo: int, hi: int, forward_fill: bool = False):
+    t0 = time.monotonic()
+    ts0 = datetime.datetime.combine(day, datetime.time())
+    ts1 = ts0 + datetime.timedelta(days=1)
+    ticks = (ff_ticks if forward_fill else raw_ticks)(ts0, ts1, (lo, hi))
+    with Session() as s:
+        n = len(upsert_snapshots(s, daily_stats(ticks)))
+        upsert_bars(s, ticks)
+        seconds = time.monotonic() - t0
+        s.execute(
+            update(AggregationShard)
+            .where(AggregationShard.day == day, AggregationShard.item_lo == lo)
+            .values(done_at=func.now(), rows=n, seconds=round(seconds, 3))
+        )
+        s.commit()                     # snapshots + avancement ensemble
+    return day, lo, hi, n, seconds
+
+
+def purge_completed(s, forward_fill: bool = False) -> list[datetime.date]:
+    """Purge le brut des jours dont toutes les tranches sont faites.  Un
+    jour sans aucun snapshot garde son brut et sera replanifié."""
+    done = s.execute(
+        select(AggregationShard.day, func.sum(AggregationShard.rows).label("rows"))
+        .group_by(AggregationShard.day)
+        .having(func.count(AggregationShard.done_at) == func.count())
+        .order_by(AggregationShard.day)
+    ).all()
+    for day, rows in done:
+        if not rows:
+            s.execute(delete(AggregationShard).where(AggregationShard.day == day))
+            s.commit()
+            print(f"⚠️  {day} : aucun snapshot, brut conservé.")
+            continue
+        ts0 = datetime.datetime.combine(day, datetime.time())
+        ts1 = ts0 + datetime.timedelta(days=1)
+        archive_raw(s, [day], ff_ticks(ts0, ts1) if forward_fill else None)
+        purged = purge_raw(s, ts0, ts1)
+        s.execute(delete(AggregationShard).where(AggregationShard.day == day))
+        notify(s.connection(), "snapshots")
+        s.commit()                     # un jour par transaction
+        print(f"🧹 {day} : {purged}.")
+    return [day for day, rows in done if rows]
+
+
+def aggregate_sharded(shards: int = SHARDS, workers: int = WORKERS,
+                      forward_fill: bool = False) -> None:
+    if workers > DB_POOL_SIZE + DB_MAX_OVERFLOW:
+        workers = DB_POOL_SIZE + DB_MAX_OVERFLOW
+        print(f"⚠️  limité à {workers} workers (DB_POOL_SIZE + DB_MAX_OVERFLOW)")
+
+    with Session() as s:
+        plan_shards(s, pending_days(s, datetime.date.today()), shards)
+        todo = s.execute(
+            select(AggregationShard.day, AggregationShard.item_lo, AggregationShard.item_hi)
+            .where(AggregationShard.done_at.is_(None))
+            .order_by(AggregationShard.day, AggregationShard.item_lo)
+        ).all()
+        s.commit()
+
+    t0 = time.monotonic()
+    timings = []
+    if todo:
+        print(f"🧩 {len(todo)} tranches sur {len({t.day for t in todo})} jour(s), {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_shard, *t, forward_fill) for t in todo]
+            try:
+                for fut in as_completed(futures):
+                    day, lo, hi, n, seconds = fut.result()
+                    timings.append(seconds)
+                    print(f"   ↳ {day} items [{lo}, {hi}[ : {n} snapshots en {seconds:.2f}s")
+            except BaseException:
+                # tranches déjà commitées conservées : relancer pour reprendre
+                print("⏹️  Interrompu — fin des tranches en cours, relancer pour reprendre.")
+                pool.shutdown(wait=True, cancel_futures=True)
+                raise
+
+    with Session() as s:
+        days = purge_completed(s, forward_fill)
+    if not todo and not days:
+        print("👍 Rien à agréger.")
+        return
+    if timings:
+        print(f"✅ {len(timings)} tranches en {time.monotonic() - t0:.1f}s "
+              f"(tranche min {min(timings):.2f}s, médiane {statistics.median(timings):.2f}s, "
+              f"max {max(timings):.2f}s)")
+
+    if days and os.getenv("HISTORY_CACHE_DIR"):
+        import history_cache
+        history_cache.update(days)
+
 
 if __name__ == "__main__":
-    aggregate_all_days()
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mode", choices=("sql", "rollup", "loop", "sharded"), default="sql",
+                    help="sql : requête ensembliste unique ; rollup : depuis "
+                         "intraday_rollup ; loop : jour par jour ; sharded : "
+                         "tranches jour × item_id en parallèle")
+    ap.add_argument("--exact-median", action="store_true",
+                    help="mode rollup : médiane exacte relue dans daily_raw")
+    ap.add_argument("--bars", action="store_true",
+                    help="mode rollup : construit aussi les barres OHLC (relit daily_raw)")
+    ap.add_argument("--forward-fill", action="store_true",
+                    help="modes sql/sharded : reconstruit les ticks des captures delta")
+    ap.add_argument("--shards", type=int, default=SHARDS,
+                    help="mode sharded : tranches d'item_id par jour")
+    ap.add_argument("--workers", type=int, default=WORKERS,
+                    help="mode sharded : tranches agrégées simultanément")
+    args = ap.parse_args()
+
+    if args.mode == "loop":
+        aggregate_all_days()
+    elif args.mode == "sharded":
+        aggregate_sharded(args.shards, args.workers, args.forward_fill)
+    else:
+        aggregate_pending_days(args.mode == "rollup", args.exact_median,
+                               args.forward_fill, args.bars or None)
@@ -0,0 +1,82 @@
+"""partition daily_raw by day
+
+Revision ID: 7c3e5a9d2b41
+Revises: 1d90bb802f23
+Create Date: 2026-10-18 09:12:31.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '7c3e5a9d2b41'
+down_revision: Union[str, None] = '1d90bb802f23'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+_COLUMNS = "item_id, ts, buy_price, buy_quantity, sell_price, sell_quantity"
+
+# une partition par jour déjà présent dans l'ancienne table
+_CREATE_PARTITIONS = """
+DO $$
+DECLARE d date;
+BEGIN
+    FOR d IN SELECT DISTINCT ts::date FROM daily_raw_old LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF daily_raw FOR VALUES FROM (%L) TO (%L)',
+            'daily_raw_' || to_char(d, 'YYYYMMDD'), d, d + 1);
+    END LOOP;
+END $$
+"""
+
+
+def _rename_objects(table: str) -> None:
+    op.execute(f"ALTER INDEX daily_raw_pkey RENAME TO {table}_pkey")
+    op.execute(f"ALTER INDEX uq_daily_item_time RENAME TO uq_{table}_item_time")
+    op.execute(f"ALTER SEQUENCE daily_raw_id_seq RENAME TO {table}_id_seq")
+    op.execute(f"ALTER TABLE {table} RENAME CONSTRAINT daily_raw_item_id_fkey"
+               f" TO {table}_item_id_fkey")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # index, séquence et FK gardent leur nom : on libère ceux de l'ancienne table
+    op.rename_table('daily_raw', 'daily_raw_old')
+    _rename_objects('daily_raw_old')
+
+    # id en bigint : la séquence continue de croître malgré les purges
+    op.execute(
+        "CREATE TABLE daily_raw ("
+        " id bigserial NOT NULL,"
+        " item_id integer NOT NULL REFERENCES items (id),"
+        " ts timestamp without time zone NOT NULL,"
+        " buy_price integer, buy_quantity integer,"
+        " sell_price integer, sell_quantity integer,"
+        " PRIMARY KEY (id, ts),"
+        " CONSTRAINT uq_daily_item_time UNIQUE (item_id, ts)"
+        ") PARTITION BY RANGE (ts)"
+    )
+    op.execute(_CREATE_PARTITIONS)
+    op.execute(f"INSERT INTO daily_raw ({_COLUMNS}) SELECT {_COLUMNS} FROM daily_raw_old")
+    op.drop_table('daily_raw_old')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.rename_table('daily_raw', 'daily_raw_part')
+    _rename_objects('daily_raw_part')
+    op.create_table(
+        'daily_raw',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('item_id', sa.Integer(), sa.ForeignKey('items.id'), nullable=False),
+        sa.Column('ts', sa.DateTime(), nullable=False),
+        sa.Column('buy_price', sa.Integer()),
+        sa.Column('buy_quantity', sa.Integer()),
+        sa.Column('sell_price', sa.Integer()),
+        sa.Column('sell_quantity', sa.Integer()),
+        sa.UniqueConstraint('item_id', 'ts', name='uq_daily_item_time'),
+    )
+    op.execute(f"INSERT INTO daily_raw ({_COLUMNS}) SELECT {_COLUMNS} FROM daily_raw_part")
+    op.drop_table('daily_raw_part')          # emporte toutes les partitions
@@ -0,0 +1,245 @@
+# backtest_flips.py
+# ----------------------------------------------------------------
+# Backtest de la stratégie de flips rapides sur l'historique snapshots.
+#
+# Chaque jour J de l'historique sert de signal : les règles de
+# flip_scoring (flip_metrics + candidate_mask, donc les mêmes seuils
+# que find_fast_flips) sont appliquées aux snapshots de J, puis le
+# trade est simulé sur J+1 :
+#
+#   achat  : ordre d'achat au avg_buy_price de J, jusqu'à --size
+#            unités, rempli dans la limite des ordres d'achat exécutés
+#            en J+1 (exec_sell_qty) ;
+#   vente  : annonce à min(avg_sell_price de J, de J+1), écoulée dans
+#            la limite des annonces exécutées en J+1 (exec_buy_qty),
+#            taxe FEE déduite ;
+#   reste  : le stock invendu est soldé au avg_buy_price de J+1,
+#            taxe FEE déduite.
+#
+# --top N ne garde que les N meilleurs scores par jour (0 = tous).
+# Les colonnes sont chargées une fois (cache history_cache.py s'il
+# existe, sinon base) en tableaux [item, jour] ; la grille de seuils
+# est répartie sur un pool de processus (--workers), chaque jeu de
+# paramètres est un calcul vectorisé sur tout l'historique.
+#
+#   python backtest_flips.py --min-net-gain 15,50,100 \
+#       --min-spread-pct 5,10,20 --size 50,250 --top 0,20 --workers 8
+# ----------------------------------------------------------------
+
+import argparse
+import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from tabulate import tabulate
+
+load_dotenv()
+import flip_scoring
+import history_cache
+from flip_scoring import DEFAULTS, FEE, grid
+from models import Snapshot, get_engine
+from sqlalchemy import Date, cast, func, select
+
+COLUMNS = ("avg_buy_price", "avg_sell_price", "exec_buy_qty",
+           "exec_sell_qty", "total_buy_qty_listed")
+SIZE    = 250                  # unités max par trade (une pile)
+TOP     = 0                    # candidats max par jour (0 = tous)
+WORKERS = os.cpu_count() or 1
+
+
+# ----------------------------------------------------------------
+# Chargement de l'historique en tableaux [item, jour]
+# ----------------------------------------------------------------
+def _load_from_db(start: datetime.date, end: datetime.date):
+    q = (
+        select(Snapshot.item_id, Snapshot.ts, *(getattr(Snapshot, c) for c in COLUMNS))
+        .where(Snapshot.ts >= start, Snapshot.ts <= end)
+    )
+    df = pd.read_sql(q, get_engine())
+    ids, row = np.unique(df["item_id"].to_numpy(), return_inverse=True)
+    day = (pd.to_datetime(df["ts"]) - pd.Timestamp(start)).dt.days.to_numpy()
+    ndays = (end - start).days + 1
+    arrays = {}
+    for c in COLUMNS:
+        arr = np.full((len(ids), ndays), np.nan)
+        arr[row, day] = pd.to_numeric(df[c]).to_numpy(dtype="float64")
+        arrays[c] = arr
+    arrays["present"] = np.zeros((len(ids), ndays), dtype=bool)
+    arrays["present"][row, day] = True
+    return ids, arrays
+
+
+def load_history(start: datetime.date | None = None, end: datetime.date | None = None):
+    """(item_ids, jours, {colonne: [item, jour]}) depuis le cache local ou la base."""
+    if start is None or end is None:
+        with get_engine().connect() as conn:
+            first, last = conn.execute(   # dates, que snapshots.ts soit date ou timestamp
+                select(cast(func.min(Snapshot.ts), Date), cast(func.max(Snapshot.ts), Date))
+            ).one()
+        if first is None:
+            raise SystemExit("❌ snapshots vide : rien à rejouer.")
+        start, end = start or first, end or last
+
+    months = history_cache.cached_months()
+    if months and months[0] <= start and history_cache.next_month(months[-1]) > end:
+        print(f"🗄️  Historique lu dans {history_cache.CACHE_DIR}/")
+        ids, _, arrays = history_cache.load(COLUMNS, start, end)
+    else:
+        print("🐘 Historique lu en base (lancer history_cache.py sync pour accélérer)")
+        ids, arrays = _load_from_db(start, end)
+    days = np.array([start + datetime.timedelta(days=i) for i in range((end - start).days + 1)])
+    return ids, days, arrays
+
+
+# ----------------------------------------------------------------
+# Simulation
+# ----------------------------------------------------------------
+_DATA: dict = {}               # données du process (parent ou worker)
+
+
+def prepare(arrays: dict) -> dict:
+    """Métriques des jours signal (J) et marché du lendemain (J+1), aplaties."""
+    sig = {c: np.asarray(arrays[c][:, :-1], dtype="float64").ravel() for c in COLUMNS}
+    nxt = {c: np.asarray(arrays[c][:, 1:], dtype="float64").ravel() for c in COLUMNS}
+    metrics = flip_scoring.flip_metrics(pd.DataFrame(sig))
+    n_items, n_days = arrays["present"].shape
+    score = metrics["score"].to_numpy()
+    day = np.arange(len(score)) % (n_days - 1)
+    return {
+        "metrics": metrics,
+        "buy":     sig["avg_buy_price"],
+        "sell":    sig["avg_sell_price"],
+        # lignes triées par jour puis score décroissant, pour --top
+        "order":   np.lexsort((-score, day)),
+        "next":    nxt,
+        "tradable": arrays["present"][:, 1:].ravel(),     # snapshot en J+1
+        "shape":   (n_items, n_days - 1),
+        "fills":   {},                                     # cache par taille
+    }
+
+
+def fills(data: dict, size: int):
+    """(unités achetées, P&L) par ligne pour une taille d'ordre — indépendant des seuils."""
+    if size not in data["fills"]:
+        nxt = data["next"]
+        with np.errstate(invalid="ignore"):
+            bought = np.nan_to_num(np.minimum(size, nxt["exec_sell_qty"]))
+            sold = np.minimum(bought, np.nan_to_num(nxt["exec_buy_qty"]))
+            sell_px = np.fmin(data["sell"], nxt["avg_sell_price"])
+            pnl = (
+                sold * np.floor(sell_px * (1 - FEE))
+                + (bought - sold) * np.floor(np.nan_to_num(nxt["avg_buy_price"]) * (1 - FEE))
+                - bought * data["buy"]
+            )
+        data["fills"][size] = (bought, np.nan_to_num(pnl))
+    return data["fills"][size]
+
+
+def _top_per_day(mask: np.ndarray, order: np.ndarray, n_days: int, top: int) -> np.ndarray:
+    """Indices des `top` meilleurs scores de chaque jour parmi `mask`."""
+    sel = mask[order].reshape(n_days, -1)               # un jour par ligne, score décroissant
+    keep = sel & (np.cumsum(sel, axis=1) <= top)
+    return np.sort(order[keep.ravel()])
+
+
+def evaluate(params: dict, data: dict | None = None) -> dict:
+    """Résultat d'un jeu de paramètres (seuils + size + top) sur tout l'historique."""
+    data = data or _DATA
+    thresholds = {k: v for k, v in params.items() if k in DEFAULTS}
+    size, top = int(params.get("size", SIZE)), int(params.get("top", TOP))
+    m = data["metrics"]
+    n_days = data["shape"][1]
+
+    mask = flip_scoring.candidate_mask(m, **{**DEFAULTS, **thresholds}) & data["tradable"]
+    # ensuite, seulement les indices des candidats (rares), pas la matrice
+    idx = _top_per_day(mask, data["order"], n_days, top) if top else np.flatnonzero(mask)
+    bought, pnl = fills(data, size)
+    traded = idx[bought[idx] > 0]
+    gains = pnl[traded]
+    capital = np.bincount(traded % n_days, weights=bought[traded] * data["buy"][traded],
+                          minlength=n_days)
+    trades = len(traded)
+    total = float(gains.sum())
+    return {
+        **{**DEFAULTS, **thresholds}, "size": size, "top": top,
+        "signals": len(idx),
+        "trades": trades,
+        "pnl": total,
+        "hit_rate": float((gains > 0).mean()) if trades else np.nan,
+        "avg_pnl": total / trades if trades else np.nan,
+        "max_capital": float(capital.max()) if n_days else 0.0,
+    }
+
+
+def _init_worker(arrays: dict) -> None:
+    _DATA.update(prepare(arrays))
+
+
+def _evaluate_chunk(param_sets: list[dict]) -> list[dict]:
+    return [evaluate(p) for p in param_sets]
+
+
+def backtest(arrays: dict, param_sets: list[dict], workers: int = WORKERS) -> pd.DataFrame:
+    """Une ligne par jeu de paramètres, triée par P&L décroissant."""
+    if workers <= 1 or len(param_sets) == 1:
+        data = prepare(arrays)
+        rows = [evaluate(p, data) for p in param_sets]
+    else:
+        # quelques lots par worker : équilibre la charge sans trop de messages
+        n = max(1, len(param_sets) // (workers * 4))
+        chunks = [param_sets[i:i + n] for i in range(0, len(param_sets), n)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(arrays,)) as pool:
+            rows = [r for part in pool.map(_evaluate_chunk, chunks) for r in part]
+    return pd.DataFrame(rows).sort_values("pnl", ascending=False).reset_index(drop=True)
+
+
+# ----------------------------------------------------------------
+# CLI
+# ----------------------------------------------------------------
+def _axis(value: str, cast=float) -> list:
+    return [cast(v) for v in value.split(",")]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--start", type=datetime.date.fromisoformat, help="premier jour (défaut : début de l'historique)")
+    ap.add_argument("--end", type=datetime.date.fromisoformat, help="dernier jour (défaut : fin de l'historique)")
+    for name, default in DEFAULTS.items():
+        ap.add_argument(f"--{name.replace('_', '-')}", default=str(default),
+                        help=f"valeurs séparées par des virgules (défaut {default})")
+    ap.add_argument("--size", default=str(SIZE), help="unités max par trade, ex. 50,250")
+    ap.add_argument("--top", default=str(TOP), help="candidats max par jour (0 = tous), ex. 0,20")
+    ap.add_argument("--workers", type=int, default=WORKERS, help="processus pour la grille")
+    ap.add_argument("--show", type=int, default=20, help="lignes affichées")
+    ap.add_argument("--csv", help="écrit tous les résultats dans ce fichier")
+    args = ap.parse_args()
+
+    axes = {name: _axis(getattr(args, name)) for name in DEFAULTS}
+    param_sets = grid(**axes, size=_axis(args.size, int), top=_axis(args.top, int))
+
+    t0 = time.monotonic()
+    ids, days, arrays = load_history(args.start, args.end)
+    print(f"📅 {days[0]} → {days[-1]} : {len(ids)} items × {len(days)} jours "
+          f"chargés en {time.monotonic() - t0:.1f}s")
+    if len(days) < 2:
+        raise SystemExit("❌ Il faut au moins deux jours d'historique.")
+
+    t0 = time.monotonic()
+    res = backtest(arrays, param_sets, args.workers)
+    print(f"⏱️  {len(param_sets)} jeux de paramètres en {time.monotonic() - t0:.1f}s "
+          f"({args.workers} workers)")
+
+    if args.csv:
+        res.to_csv(args.csv, index=False)
+        print(f"💾 {args.csv} écrit.")
+    print(tabulate(res.head(args.show).to_dict("records"), headers="keys", tablefmt="fancy_grid",
+                   showindex=False, floatfmt=".2f"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# bars.py
+# ------------------------------------------------------------------
+# Barres OHLC intraday par item dans ohlc_bars : 5 min et 1 h.
+#
+# À l'agrégation (aggregate_daily ; en mode rollup seulement avec
+# --bars, pour ne pas relire daily_raw), avant la purge du brut : les
+# ticks du jour sont réduits en barres 5 min (open/high/low/close achat
+# et vente, quantités listées en fin de barre,
+# quantités exécutées estimées par les baisses de quantité comme dans
+# snapshots), puis les barres 1 h sont construites à partir des barres
+# 5 min écrites, dans la même requête.  Le journalier reste snapshots.
+# Les barres 5 min sont gardées BARS_5M_KEEP_DAYS jours, les barres
+# 1 h indéfiniment.
+#
+# query_bars(item_id, start, end, max_points) choisit la résolution la
+# plus fine qui tient dans le budget de points (5 min, 1 h, puis jour)
+# et complète les jours pas encore agrégés à la volée depuis daily_raw :
+# un graphique sur plusieurs semaines lit quelques centaines de barres
+# horaires au lieu de millions de ticks.
+#
+#   python bars.py 19721 --from 2025-07-01 --to 2025-07-14 --points 500
+# ------------------------------------------------------------------
+
+import argparse
+import datetime
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import (
+    BigInteger, DateTime, Integer, case, cast, delete, func, literal, null, select, union_all,
+)
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
+
+load_dotenv()
+from models import OhlcBar, Session, Snapshot
+import tick_store
+
+RESOLUTIONS = {300: "5m", 3600: "1h", 86400: "1d"}
+KEEP_5M_DAYS = int(os.getenv("BARS_5M_KEEP_DAYS", "30"))
+MAX_POINTS   = 500
+
+_COLS = [c.name for c in OhlcBar.__table__.c]
+_KEY  = ("item_id", "resolution", "ts")
+
+
+def _bucket(ts, seconds: int):
+    # début de la barre ; ts naïf en UTC → reste naïf
+    return func.timezone("UTC", func.to_timestamp(
+        func.floor(func.extract("epoch", ts) / seconds) * seconds))
+
+
+def _first(col, order):
+    return func.array_agg(aggregate_order_by(col, order))[1]
+
+
+def _ohlc(side: str, opens, highs, lows, closes, order) -> list:
+    return [
+        _first(opens, order).label(f"{side}_open"),
+        func.max(highs).label(f"{side}_high"),
+        func.min(lows).label(f"{side}_low"),
+        _first(closes, order.desc()).label(f"{side}_close"),
+    ]
+
+
+# ------------------------------------------------------------------
+# Construction (même ordre de colonnes que ohlc_bars)
+# ------------------------------------------------------------------
+def bars_from_ticks(ticks, seconds: int = 300):
+    """Barres de `seconds` depuis un SELECT de ticks (colonnes de daily_raw)."""
+    t = ticks.subquery("ticks")
+    day = func.date_trunc("day", t.c.ts)
+    l = (
+        select(
+            t.c.item_id, t.c.ts, _bucket(t.c.ts, seconds).label("bucket"),
+            t.c.buy_price, t.c.sell_price, t.c.buy_quantity, t.c.sell_quantity,
+            # même LAG que daily_stats : Σ des barres = exec du snapshot
+            func.lag(t.c.buy_quantity)
+                .over(partition_by=(t.c.item_id, day), order_by=t.c.ts).label("prev_buy_qty"),
+            func.lag(t.c.sell_quantity)
+                .over(partition_by=(t.c.item_id, day), order_by=t.c.ts).label("prev_sell_qty"),
+        )
+        .subquery("lagged")
+        .c
+    )
+    return (
+        select(
+            l.item_id, literal(seconds).label("resolution"), l.bucket.label("ts"),
+            *_ohlc("buy", l.buy_price, l.buy_price, l.buy_price, l.buy_price, l.ts),
+            *_ohlc("sell", l.sell_price, l.sell_price, l.sell_price, l.sell_price, l.ts),
+            _first(l.buy_quantity, l.ts.desc()).label("buy_qty"),
+            _first(l.sell_quantity, l.ts.desc()).label("sell_qty"),
+            func.sum(case((l.prev_sell_qty > l.sell_quantity,
+                           l.prev_sell_qty - l.sell_quantity), else_=0).cast(BigInteger)).label("exec_buy_qty"),
+            func.sum(case((l.prev_buy_qty > l.buy_quantity,
+                           l.prev_buy_qty - l.buy_quantity), else_=0).cast(BigInteger)).label("exec_sell_qty"),
+            func.count().label("ticks"),
+        )
+        .group_by(l.item_id, l.bucket)
+    )
+
+
+def coarser_bars(bars, seconds: int):
+    """Regroupe des barres (sous-requête aux colonnes de ohlc_bars) en barres de `seconds`."""
+    b = select(bars, _bucket(bars.c.ts, seconds).label("bucket")).subquery("fine").c
+    return (
+        select(
+            b.item_id, literal(seconds).label("resolution"), b.bucket.label("ts"),
+            *_ohlc("buy", b.buy_open, b.buy_high, b.buy_low, b.buy_close, b.ts),
+            *_ohlc("sell", b.sell_open, b.sell_high, b.sell_low, b.sell_close, b.ts),
+            _first(b.buy_qty, b.ts.desc()).label("buy_qty"),
+            _first(b.sell_qty, b.ts.desc()).label("sell_qty"),
+            func.sum(b.exec_buy_qty).label("exec_buy_qty"),
+            func.sum(b.exec_sell_qty).label("exec_sell_qty"),
+            func.sum(b.ticks).cast(Integer).label("ticks"),
+        )
+        .group_by(b.item_id, b.bucket)
+    )
+
+
+def _upsert(source):
+    stmt = pg_insert(OhlcBar).from_select(_COLS, source)
+    return stmt.on_conflict_do_update(
+        index_elements=list(_KEY),
+        set_={c: stmt.excluded[c] for c in _COLS if c not in _KEY},
+    )
+
+
+def upsert_bars(s, ticks) -> int:
+    """Barres 5 min des `ticks` puis barres 1 h correspondantes, en une
+    requête ; retourne le nombre de barres 5 min écrites.  Les ticks
+    doivent couvrir des jours entiers (ceux qu'on agrège)."""
+    five = _upsert(bars_from_ticks(ticks, 300)).returning(*OhlcBar.__table__.c).cte("five")
+    hour = _upsert(coarser_bars(five, 3600)).cte("hour")
+    return s.execute(select(func.count()).select_from(five).add_cte(hour)).scalar()
+
+
+def expire_bars(s, end: datetime.datetime) -> int:
+    """Supprime les barres 5 min de plus de KEEP_5M_DAYS jours avant `end`."""
+    cutoff = end - datetime.timedelta(days=KEEP_5M_DAYS)
+    return s.execute(
+        delete(OhlcBar).where(OhlcBar.resolution == 300, OhlcBar.ts < cutoff)
+    ).rowcount
+
+
+# ------------------------------------------------------------------
+# Lecture
+# ------------------------------------------------------------------
+def pick_resolution(start: datetime.datetime, end: datetime.datetime,
+                    max_points: int = MAX_POINTS) -> int:
+    """Résolution la plus fine donnant au plus `max_points` barres sur
+    [start, end[ (le 5 min seulement dans sa fenêtre de rétention)."""
+    span = (end - start).total_seconds()
+    kept_from = datetime.datetime.now() - datetime.timedelta(days=KEEP_5M_DAYS)
+    for seconds in (300, 3600):
+        if span / seconds <= max_points and (seconds != 300 or start >= kept_from):
+            return seconds
+    return 86400
+
+
+def _daily(item_id: int, start: datetime.datetime, end: datetime.datetime):
+    s = Snapshot
+    return (
+        select(
+            s.item_id, literal(86400).label("resolution"), cast(s.ts, DateTime).label("ts"),
+            s.open_buy_price.label("buy_open"), s.max_buy_price.label("buy_high"),
+            s.min_buy_price.label("buy_low"), s.close_buy_price.label("buy_close"),
+            s.open_sell_price.label("sell_open"), s.max_sell_price.label("sell_high"),
+            s.min_sell_price.label("sell_low"), s.close_sell_price.label("sell_close"),
+            null().label("buy_qty"), null().label("sell_qty"),
+            s.exec_buy_qty, s.exec_sell_qty, null().label("ticks"),
+        )
+        .where(s.item_id == item_id, s.ts >= start.date(), s.ts < end)
+        .order_by(s.ts)
+    )
+
+
+def _intraday(item_id: int, start: datetime.datetime, end: datetime.datetime, seconds: int):
+    stored = select(*OhlcBar.__table__.c).where(
+        OhlcBar.item_id == item_id, OhlcBar.resolution == seconds,
+        OhlcBar.ts >= start, OhlcBar.ts < end,
+    )
+    # jours pas encore agrégés : barres calculées depuis daily_raw, ticks
+    # lus depuis minuit pour que le LAG soit celui de l'agrégation
+    midnight = datetime.datetime.combine(start.date(), datetime.time())
+    live = bars_from_ticks(tick_store.ticks(midnight, end, (item_id, item_id + 1)), 300)
+    if seconds != 300:
+        live = coarser_bars(live.subquery("live"), seconds)
+    u = union_all(stored, live).subquery("bars")
+    return select(u).where(u.c.ts >= start).order_by(u.c.ts)
+
+
+def query_bars(item_id: int, start: datetime.datetime, end: datetime.datetime,
+               max_points: int = MAX_POINTS, resolution: int | None = None):
+    """(résolution en secondes, barres [dict]) de l'item sur [start, end[."""
+    seconds = resolution or pick_resolution(start, end, max_points)
+    # aligne le début sur une barre entière
+    start = datetime.datetime.fromtimestamp(
+        start.replace(tzinfo=datetime.timezone.utc).timestamp() // seconds * seconds,
+        datetime.timezone.utc,
+    ).replace(tzinfo=None)
+    q = (_daily(item_id, start, end) if seconds == 86400
+         else _intraday(item_id, start, end, seconds))
+    with Session() as s:
+        return seconds, [dict(r) for r in s.execute(q).mappings()]
+
+
+def main() -> None:
+    from tabulate import tabulate
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("item_id", type=int)
+    ap.add_argument("--from", dest="start", type=datetime.datetime.fromisoformat,
+                    help="début (défaut : il y a 7 jours)")
+    ap.add_argument("--to", dest="end", type=datetime.datetime.fromisoformat,
+                    help="fin exclue (défaut : maintenant)")
+    ap.add_argument("--points", type=int, default=MAX_POINTS, help="nombre max de barres")
+    ap.add_argument("--resolution", choices=RESOLUTIONS.values(), help="force la résolution")
+    args = ap.parse_args()
+
+    end = args.end or datetime.datetime.now()
+    start = args.start or end - datetime.timedelta(days=7)
+    forced = {v: k for k, v in RESOLUTIONS.items()}.get(args.resolution)
+    seconds, rows = query_bars(args.item_id, start, end, args.points, forced)
+    print(f"📈 {len(rows)} barres {RESOLUTIONS[seconds]} pour l'item {args.item_id}")
+    print(tabulate(rows, headers="keys", tablefmt="github"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# bulk_ingest.py
+# ------------------------------------------------------------------
+# Chargement massif dans daily_raw via COPY FROM STDIN.
+# Les lignes sont copiées dans une table temporaire de staging puis
+# versées dans daily_raw par un seul INSERT … SELECT … ON CONFLICT
+# DO NOTHING sur (item_id, ts) : ré-ingérer un fichier déjà chargé
+# ne crée aucun doublon et ne fait pas échouer la transaction.
+# Dans la même requête, seules les lignes réellement insérées
+# alimentent les accumulateurs intraday_rollup (voir rollup.py).
+# Si daily_raw est partitionnée, les partitions des jours présents
+# dans le staging sont créées au besoin avant l'INSERT ; les items
+# inconnus (nouveaux sur le TP) sont créés via item_names.ensure_items,
+# sans appel HTTP : l'appelant passe `unnamed` puis appelle name_items
+# après le commit.
+# Un NOTIFY 'raw' (voir models.notify) signale les nouvelles lignes.
+# Avec `ledger`, le fichier source est inscrit dans ingest_ledger dans
+# la même transaction (voir local_ingest.py).
+# Avec RAW_STORAGE=packed, les lignes sont ajoutées aux tableaux de
+# daily_ticks au lieu de daily_raw (voir tick_store.py).
+# ------------------------------------------------------------------
+
+from sqlalchemy import text
+
+from item_names import ensure_items
+from models import daily_raw_partitioned, ensure_daily_partitions, notify
+from rollup import rollup_ctes
+from tick_store import PACKED, append_ctes
+
+COLUMNS = ("item_id", "ts", "buy_price", "buy_quantity", "sell_price", "sell_quantity")
+STAGE   = "daily_raw_stage"
+
+_COLS = ", ".join(COLUMNS)
+
+
+class _CopyStream:
+    """Objet « fichier » minimal lu par copy_expert : sérialise les
+    lignes à la demande, sans construire tout le texte en mémoire."""
+
+    def __init__(self, rows):
+        self._lines = (_copy_line(r) for r in rows)
+        self._buf   = ""
+        self.count  = 0
+        self.error  = None
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buf) < size:
+            try:
+                line = next(self._lines, None)
+            except Exception as exc:
+                # fichier invalide : psycopg2 masquerait l'erreur (QueryCanceled) ;
+                # on clôt le COPY et load_rows la relève telle quelle
+                self.error, line = exc, None
+            if line is None:
+                break
+            self._buf += line
+            self.count += 1
+        if size < 0:
+            out, self._buf = self._buf, ""
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+def _copy_line(row: dict) -> str:
+    return "\t".join(
+        "\\N" if (v := row[c]) is None else str(v) for c in COLUMNS
+    ) + "\n"
+
+
+def _ensure_stage(conn) -> None:
+    # table temporaire propre à la connexion, vidée à chaque commit
+    conn.execute(text(
+        f"CREATE TEMP TABLE IF NOT EXISTS {STAGE} ("
+        " item_id integer, ts timestamp,"
+        " buy_price integer, buy_quantity integer,"
+        " sell_price integer, sell_quantity integer"
+        ") ON COMMIT DELETE ROWS"
+    ))
+
+
+def load_rows(conn, rows, capture=None, ledger=None, unnamed=None) -> tuple[int, int]:
+    """
+    Copie `rows` (itérable de dicts au format daily_raw) dans daily_raw
+    au sein de la transaction courante de `conn` (Connection SQLAlchemy).
+    `capture` = (début de capture ou None, keyframe) enregistre aussi la
+    capture dans raw_captures ; à None, le plus petit ts des lignes.
+    `ledger` = (nom de fichier, sha256) inscrit le fichier dans
+    ingest_ledger, avec le même début de capture.
+    `unnamed` (set) reçoit les items créés sans nom, à passer à
+    item_names.name_items une fois la transaction commitée.
+    Retourne (lignes lues, lignes réellement insérées).
+    """
+    _ensure_stage(conn)
+    stream = _CopyStream(rows)
+    cur = conn.connection.cursor()
+    try:
+        cur.copy_expert(f"COPY {STAGE} ({_COLS}) FROM STDIN", stream)
+    finally:
+        cur.close()
+    if stream.error is not None:
+        raise stream.error
+
+    if not PACKED and daily_raw_partitioned(conn):
+        days = conn.execute(text(f"SELECT DISTINCT ts::date FROM {STAGE}")).scalars()
+        ensure_daily_partitions(conn, days)
+
+    new_ids = conn.execute(text(
+        f"SELECT DISTINCT s.item_id FROM {STAGE} s"
+        " WHERE NOT EXISTS (SELECT 1 FROM items i WHERE i.id = s.item_id)"
+    )).scalars().all()
+    if new_ids:
+        created = ensure_items(conn, new_ids)
+        if unnamed is not None:
+            unnamed.update(created)
+
+    if capture is not None:
+        ts, keyframe = capture
+        conn.execute(text(
+            f"INSERT INTO raw_captures (ts, keyframe, rows)"
+            f" SELECT COALESCE(:ts, min(ts)), :keyframe, count(*) FROM {STAGE}"
+            " HAVING COALESCE(:ts, min(ts)) IS NOT NULL"
+            " ON CONFLICT (ts) DO NOTHING"
+        ), {"ts": ts, "keyframe": keyframe})
+
+    if PACKED:
+        new = append_ctes(STAGE)
+    else:
+        new = (f"ins AS ("
+               f" INSERT INTO daily_raw ({_COLS}) SELECT {_COLS} FROM {STAGE}"
+               f" ON CONFLICT (item_id, ts) DO NOTHING RETURNING {_COLS})")
+    inserted = conn.execute(text(
+        f"WITH {new}, {rollup_ctes('ins')} SELECT count(*) FROM ins"
+    )).scalar()
+    if ledger is not None:
+        name, sha256 = ledger
+        conn.execute(text(
+            f"INSERT INTO ingest_ledger (name, sha256, rows, captured_at)"
+            f" SELECT :name, :sha256, :rows, COALESCE(:ts, min(ts)) FROM {STAGE}"
+            " ON CONFLICT (name) DO NOTHING"
+        ), {"name": name, "sha256": sha256, "rows": inserted,
+            "ts": capture[0] if capture is not None else None})
+    conn.execute(text(f"TRUNCATE {STAGE}"))
+    if inserted:
+        notify(conn, "raw")
+    return stream.count, inserted
@@ -1,53 +1,191 @@
 # fetch_to_daily_raw.py
-import argparse, requests, time, datetime, json, sys
+# ------------------------------------------------------------------
+# Capture les prix du Trading Post : la liste des ids est découpée en
+# chunks de 200, récupérés en parallèle (pool de threads, une session
+# HTTP keep-alive par thread), cadencés par un seau à jetons, avec
+# retries + backoff exponentiel par chunk.  Chaque ligne porte
+# l'horodatage de réception de son chunk.
+#
+# GW2_API_BASE permet de pointer vers un serveur local de test.
+# --output x.json écrit du JSON, --output x.gw2s le format binaire
+# compact de snapfmt.py.
+#
+# --delta STATE (opt-in) : le carnet complet de la capture précédente
+# est conservé dans STATE (.gw2s) et seuls les items dont prix ou
+# quantités ont changé sont émis, avec une capture complète (keyframe)
+# au moins toutes les --keyframe-minutes et à chaque changement de jour
+# UTC.  Les trous sont reconstruits à l'agrégation (--forward-fill).
+# ------------------------------------------------------------------
+import argparse, requests, time, datetime, json, sys, random, threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
 import os
-if not os.getenv("DATABASE_URL"):
-    raise RuntimeError("DATABASE_URL n'est pas défini (ni dans .env, ni en variable d'environnement).")
 
-API_BASE = "https://api.guildwars2.com/v2"
+from ratelimit import TokenBucket
+import snapfmt
+
+API_BASE     = os.getenv("GW2_API_BASE", "https://api.guildwars2.com/v2")
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "20"))
+WORKERS      = 8                 # requêtes simultanées
+RATE         = 10.0              # requêtes / seconde (l'API tolère 600 / min)
+BURST        = 50
+RETRIES      = 3
+BACKOFF      = 0.5               # secondes, doublé à chaque tentative
+KEYFRAME_MIN = 60                # minutes max entre deux captures complètes
+
+_BOOK = ("buy_price", "buy_quantity", "sell_price", "sell_quantity")
+
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    """Session propre au thread courant : connexions réutilisées (keep-alive)."""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
 
 def batched(seq, n=200):
     for i in range(0, len(seq), n):
         yield seq[i:i+n]
 
-def fetch_snapshot():
-    ids = requests.get(f"{API_BASE}/commerce/prices").json()
-    data = []
-    for chunk in batched(ids):
-        r = requests.get(f"{API_BASE}/commerce/prices", params={"ids": ",".join(map(str, chunk))}, timeout=20)
-        data.extend(r.json())
-        time.sleep(0.3)
-    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
-    return [{
-        "item_id": e["id"],
-        "ts": now,
-        "buy_price": e["buys"]["unit_price"],
-        "buy_quantity": e["buys"]["quantity"],
-        "sell_price": e["sells"]["unit_price"],
-        "sell_quantity": e["sells"]["quantity"],
-    } for e in data]
+
+def fetch_chunk(chunk, bucket: TokenBucket, api_base: str = API_BASE, retries: int = RETRIES):
+    """Retourne (horodatage de réception, entrées JSON) pour un chunk d'ids."""
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            r = _session().get(f"{api_base}/commerce/prices",
+                               params={"ids": ",".join(map(str, chunk))},
+                               timeout=HTTP_TIMEOUT)
+            if r.status_code == 404:         # tous les ids ont quitté le TP
+                return None, []
+            if r.status_code == 429 or r.status_code >= 500:
+                err = f"HTTP {r.status_code}"
+            else:
+                r.raise_for_status()         # autre 4xx : inutile de réessayer
+                return datetime.datetime.now(datetime.timezone.utc).isoformat(), r.json()
+        except (requests.ConnectionError, requests.Timeout, ValueError) as exc:
+            err = exc
+        if attempt == retries:
+            raise RuntimeError(f"chunk {chunk[0]}… : {err} après {retries + 1} essais")
+        delay = BACKOFF * 2 ** attempt * (1 + random.random())
+        print(f"⚠️  chunk {chunk[0]}… : {err} — nouvel essai dans {delay:.1f}s", file=sys.stderr)
+        time.sleep(delay)
+
+
+def fetch_snapshot(api_base: str = API_BASE, workers: int = WORKERS,
+                   rate: float = RATE, burst: int = BURST):
+    bucket = TokenBucket(rate, burst)
+    bucket.acquire()
+    resp = _session().get(f"{api_base}/commerce/prices", timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    ids = resp.json()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        chunks = pool.map(lambda c: fetch_chunk(c, bucket, api_base), batched(ids))
+        return [{
+            "item_id": e["id"],
+            "ts": ts,
+            "buy_price": e["buys"]["unit_price"],
+            "buy_quantity": e["buys"]["quantity"],
+            "sell_price": e["sells"]["unit_price"],
+            "sell_quantity": e["sells"]["quantity"],
+        } for ts, data in chunks for e in data]
+
+# ------------------------------------------------------------------
+# Mode delta : état local de la capture précédente
+# ------------------------------------------------------------------
+def _meta_path(state: Path) -> Path:
+    return state.with_name(state.name + ".meta")
+
+
+def load_state(state: Path):
+    """(carnet {item_id: (bp, bq, sp, sq)}, instant de la dernière keyframe) ou ({}, None)."""
+    if not state.exists() or not _meta_path(state).exists():
+        return {}, None
+    _, _, cols = snapfmt.decode(state.read_bytes())
+    book = {
+        item_id: tuple(cols[f][i] for f in _BOOK)
+        for i, item_id in enumerate(cols["item_id"])
+    }
+    meta = json.loads(_meta_path(state).read_text())
+    return book, datetime.datetime.fromisoformat(meta["keyframe"])
+
+
+def select_delta(snaps, book, last_keyframe, started, keyframe_minutes=KEYFRAME_MIN):
+    """Retourne (lignes à émettre, keyframe ?) pour la capture commencée à `started`."""
+    keyframe = (
+        last_keyframe is None
+        or last_keyframe.date() != started.date()
+        or started - last_keyframe >= datetime.timedelta(minutes=keyframe_minutes)
+    )
+    if keyframe:
+        return snaps, True
+    return [r for r in snaps
+            if book.get(r["item_id"]) != tuple(r[f] for f in _BOOK)], False
+
+
+def save_state(state: Path, snaps, started, keyframe: bool) -> None:
+    """À appeler une fois la capture écrite : elle devient la référence."""
+    tmp = state.with_name(state.name + ".tmp")
+    snapfmt.write_snapshot(tmp, snaps, base_ts=started)
+    tmp.replace(state)
+    if keyframe:
+        _meta_path(state).write_text(json.dumps({"keyframe": started.isoformat()}))
+
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--output")          # si présent → mode JSON
+    ap.add_argument("--output")          # si présent → fichier (.json ou .gw2s)
+    ap.add_argument("--workers", type=int, default=WORKERS, help="requêtes simultanées")
+    ap.add_argument("--rate", type=float, default=RATE, help="requêtes par seconde")
+    ap.add_argument("--delta", type=Path, metavar="STATE",
+                    help="n'émet que les items modifiés depuis la capture mémorisée dans STATE")
+    ap.add_argument("--keyframe-minutes", type=int, default=KEYFRAME_MIN,
+                    help="intervalle max entre deux captures complètes (mode delta)")
     args = ap.parse_args()
+    if args.delta and args.output and not args.output.endswith(snapfmt.SUFFIX):
+        ap.error(f"--delta nécessite une sortie {snapfmt.SUFFIX}")
 
-    snaps = fetch_snapshot()
+    t0 = time.monotonic()
+    started = datetime.datetime.now(datetime.timezone.utc)
+    snaps = fetch_snapshot(workers=args.workers, rate=args.rate)
+    print(f"⏱️  {len(snaps)} prix récupérés en {time.monotonic() - t0:.1f}s")
+
+    rows, keyframe = snaps, True
+    if args.delta:
+        book, last_keyframe = load_state(args.delta)
+        rows, keyframe = select_delta(snaps, book, last_keyframe, started,
+                                      args.keyframe_minutes)
+        print(f"🔀 {'keyframe' if keyframe else 'delta'} : {len(rows)}/{len(snaps)} items émis")
 
     if args.output:                      # ----- mode cloud -----
-        with open(args.output, "w", encoding="utf-8") as f:
-            json.dump(snaps, f, separators=(",", ":"))
-        print(f"💾 {args.output} écrit ({len(snaps)} items).")
+        if args.output.endswith(snapfmt.SUFFIX):
+            flags = 0 if keyframe else snapfmt.FLAG_DELTA
+            snapfmt.write_snapshot(args.output, rows, flags, base_ts=started)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(rows, f, separators=(",", ":"))
+        print(f"💾 {args.output} écrit ({len(rows)} items).")
     else:                                # ----- mode local -----
-        from models import Session, DailyRaw, Item     # import tardif
-        with Session() as s:
-            for d in snaps:
-                s.add(DailyRaw(**d))
-            s.commit()
+        from models import get_engine, ensure_upcoming_partitions   # import tardif
+        from bulk_ingest import load_rows
+        from item_names import name_items
+        engine = get_engine()
+        with engine.begin() as conn:
+            ensure_upcoming_partitions(conn)
+        unnamed = set()
+        with engine.begin() as conn:
+            load_rows(conn, rows, (started.replace(tzinfo=None), keyframe), unnamed=unnamed)
+        name_items(unnamed)
         print("✅ Snapshots insérés en base.")
 
+    if args.delta:
+        save_state(args.delta, snaps, started, keyframe)
+
 if __name__ == "__main__":
     main()
@@ -1,17 +1,17 @@
 # find_fast_flips.py (hybride snapshots + daily_raw du jour)
 # ----------------------------------------------------------------
-# Combine les stats de la veille (snapshots) avec les données du jour (daily_raw)
-# pour détecter les flips rapides de manière plus actuelle.
+# Combine les stats de la veille (snapshots) avec les données du jour
+# pour détecter les flips rapides de manière plus actuelle.  Les totaux
+# du jour sont lus dans la vue intraday_summary (une ligne par item) ;
+# daily_raw n'est scanné que si le jour n'y figure pas.
 # ----------------------------------------------------------------
 
 from dotenv import load_dotenv
 load_dotenv()
-import os
-if not os.getenv("DATABASE_URL"):
-    raise RuntimeError("DATABASE_URL n'est pas défini (ni dans .env, ni en variable d'environnement).")
 
-from models import Session, Snapshot, DailyRaw, Item
-from sqlalchemy import func
+from models import Session, Snapshot, Item, intraday_summary
+import tick_store
+from sqlalchemy import select, exists, func, case, cast, BigInteger, Integer, Numeric
 from tabulate import tabulate
 import pandas as pd
 import datetime
@@ -29,93 +29,145 @@ def format_price(copper):
     pc = copper % 100
     return f"{po}p {pa:02}a {pc:02}c"
 
+def intraday_totals(start: datetime.datetime, end: datetime.datetime):
+    """
+    Totaux intraday par item sur [start, end[ en une requête : quantités
+    listées cumulées et quantités exécutées estimées comme la ↓ d’un tick
+    à l’autre (LAG partitionné par item, comme aggregate_daily).
+    """
+    t = tick_store.ticks(start, end).subquery("ticks")
+    lagged = (
+        select(
+            t.c.item_id,
+            t.c.buy_quantity, t.c.sell_quantity,
+            func.lag(t.c.buy_quantity)
+                .over(partition_by=t.c.item_id,
+                      order_by=t.c.ts).label("prev_buy_qty"),
+            func.lag(t.c.sell_quantity)
+                .over(partition_by=t.c.item_id,
+                      order_by=t.c.ts).label("prev_sell_qty"),
+        )
+        .cte("lagged")
+    )
+    w = lagged.alias()
+
+    def drop(prev, cur):
+        return case((prev > cur, prev - cur), else_=0).cast(BigInteger)
+
+    return (
+        select(
+            w.c.item_id,
+            func.sum(drop(w.c.prev_sell_qty, w.c.sell_quantity)).label("exec_sells"),
+            func.sum(drop(w.c.prev_buy_qty, w.c.buy_quantity)).label("exec_buys"),
+            func.sum(w.c.buy_quantity).label("buy_qty"),
+            func.sum(w.c.sell_quantity).label("sell_qty"),
+        )
+        .group_by(w.c.item_id)
+        .subquery("today")
+    )
+
+
+def summary_totals(day: datetime.date):
+    """Mêmes colonnes qu'intraday_totals, lues dans intraday_summary."""
+    v = intraday_summary
+    return (
+        select(
+            v.c.item_id,
+            v.c.exec_buy_qty.label("exec_sells"),    # ↓ des quantités en vente
+            v.c.exec_sell_qty.label("exec_buys"),
+            v.c.sum_buy_qty.label("buy_qty"),
+            v.c.sum_sell_qty.label("sell_qty"),
+        )
+        .where(v.c.day == day)
+        .subquery("today")
+    )
+
+
+def summary_available(s, day: datetime.date) -> bool:
+    return s.scalar(select(exists().where(intraday_summary.c.day == day)))
+
+
+def flip_query(day: datetime.date, latest_ts, filtered: bool = True,
+               from_summary: bool = True):
+    """
+    Snapshots de `latest_ts` enrichis des totaux intraday de `day`,
+    avec les métriques de flip calculées en SQL.  Si `filtered`, les
+    seuils du module sont appliqués dans le WHERE.  `from_summary` :
+    totaux lus dans intraday_summary plutôt que recalculés sur daily_raw.
+    """
+    if from_summary:
+        t = summary_totals(day)
+    else:
+        start = datetime.datetime.combine(day, datetime.time())
+        t = intraday_totals(start, start + datetime.timedelta(days=1))
+
+    exec_sell_qty = func.coalesce(t.c.exec_sells, Snapshot.exec_sell_qty)
+    exec_buy_qty  = func.coalesce(t.c.exec_buys, Snapshot.exec_buy_qty)
+    spread_pct = (
+        cast(Snapshot.avg_sell_price - Snapshot.avg_buy_price, Numeric) * 100
+        / func.nullif(Snapshot.avg_buy_price, 0)
+    )
+    net_gain = (
+        cast(func.floor(Snapshot.avg_sell_price * 0.85), Integer)
+        - Snapshot.avg_buy_price
+    )
+    buy_queue_ratio = (
+        cast(Snapshot.total_buy_qty_listed, Numeric) / func.nullif(exec_sell_qty, 0)
+    )
+
+    q = (
+        select(
+            Snapshot.item_id, Item.name,
+            Snapshot.avg_buy_price, Snapshot.avg_sell_price,
+            Snapshot.total_buy_qty_listed,
+            exec_sell_qty.label("exec_sell_qty"),
+            exec_buy_qty.label("exec_buy_qty"),
+            t.c.buy_qty, t.c.sell_qty,
+            spread_pct.label("spread_pct"),
+            net_gain.label("net_gain"),
+            buy_queue_ratio.label("buy_queue_ratio"),
+        )
+        .join(Item, Snapshot.item_id == Item.id)
+        .outerjoin(t, t.c.item_id == Snapshot.item_id)
+        .where(Snapshot.ts == latest_ts,
+               Snapshot.avg_buy_price.isnot(None),
+               Snapshot.avg_sell_price.isnot(None),
+               Snapshot.total_buy_qty_listed.isnot(None))
+    )
+    if filtered:
+        q = q.where(
+            net_gain >= MIN_NET_GAIN,
+            spread_pct >= MIN_SPREAD_PCT,
+            buy_queue_ratio <= MAX_BUY_WAIT_RATIO,
+            exec_buy_qty >= MIN_SELL_SPEED,
+        )
+    return q
+
+
 def find_fast_flips():
     today = datetime.date.today()
 
     with Session() as s:
         latest_ts = s.query(func.max(Snapshot.ts)).scalar()
+        from_summary = summary_available(s, today)
         print(f"📅 Snapshot le plus récent : {latest_ts}")
-        print(f"📊 Enrichissement avec daily_raw du {today} (en cours)\n")
-
-        # --- DailyRaw du jour (agg intraday par item) ---
-        today_data = {
-            item_id: {
-                "exec_sells": 0,
-                "exec_buys": 0,
-                "buy_qty": 0,
-                "sell_qty": 0,
+        print(f"📊 Enrichissement avec {'intraday_summary' if from_summary else 'daily_raw'}"
+              f" du {today} (en cours)\n")
+
+        results = [
+            {
+                "Item ID": r.item_id,
+                "Nom": r.name,
+                "Achat": format_price(r.avg_buy_price),
+                "Vente": format_price(r.avg_sell_price),
+                "Gain Net": format_price(r.net_gain),
+                "Spread %": f"{r.spread_pct:6.2f}%",
+                "⏳ Attente": f"{r.buy_queue_ratio:>4.2f}j",
+                "Vendus (achat)": f"{r.exec_sell_qty:,}",
+                "Vendus (vente)": f"{r.exec_buy_qty:,}",
             }
-            for (item_id,) in s.query(DailyRaw.item_id).filter(func.date(DailyRaw.ts) == today).distinct()
-        }
-
-        rows = s.query(DailyRaw).filter(func.date(DailyRaw.ts) == today).all()
-        for row in rows:
-            if row.item_id not in today_data:
-                continue
-            t = today_data[row.item_id]
-            t["buy_qty"] += row.buy_quantity or 0
-            t["sell_qty"] += row.sell_quantity or 0
-
-        # on recalcule les exec_qty comme la ↓ d’un tick à l’autre
-        for item_id in today_data:
-            buy_diffs = []
-            sell_diffs = []
-            prev = None
-            raw = s.query(DailyRaw).filter(DailyRaw.item_id == item_id, func.date(DailyRaw.ts) == today).order_by(DailyRaw.ts).all()
-            for r in raw:
-                if prev:
-                    if prev.sell_quantity > r.sell_quantity:
-                        buy_diffs.append(prev.sell_quantity - r.sell_quantity)
-                    if prev.buy_quantity > r.buy_quantity:
-                        sell_diffs.append(prev.buy_quantity - r.buy_quantity)
-                prev = r
-            today_data[item_id]["exec_sells"] = sum(buy_diffs)
-            today_data[item_id]["exec_buys"] = sum(sell_diffs)
-
-        # --- Snapshots de la veille (base des calculs) ---
-        q = (
-            s.query(Snapshot, Item.name)
-            .join(Item, Snapshot.item_id == Item.id)
-            .filter(Snapshot.ts == latest_ts)
-            .filter(Snapshot.avg_buy_price.isnot(None),
-                    Snapshot.avg_sell_price.isnot(None),
-                    Snapshot.total_buy_qty_listed.isnot(None))
-        )
-
-        results = []
-        for snap, name in q.all():
-            item_id = snap.item_id
-            extra = today_data.get(item_id, {})
-            exec_sell_qty = extra.get("exec_sells", snap.exec_sell_qty)
-            exec_buy_qty = extra.get("exec_buys", snap.exec_buy_qty)
-
-            spread = snap.avg_sell_price - snap.avg_buy_price
-            spread_pct = (spread * 100 / snap.avg_buy_price) if snap.avg_buy_price else 0
-            net_gain = int(snap.avg_sell_price * 0.85) - snap.avg_buy_price
-
-            buy_queue_ratio = (
-                snap.total_buy_qty_listed / exec_sell_qty
-                if exec_sell_qty else None
-            )
-
-            if (
-                net_gain >= MIN_NET_GAIN and
-                spread_pct >= MIN_SPREAD_PCT and
-                buy_queue_ratio is not None and
-                buy_queue_ratio <= MAX_BUY_WAIT_RATIO and
-                exec_buy_qty >= MIN_SELL_SPEED
-            ):
-                results.append({
-                    "Item ID": item_id,
-                    "Nom": name,
-                    "Achat": format_price(snap.avg_buy_price),
-                    "Vente": format_price(snap.avg_sell_price),
-                    "Gain Net": format_price(net_gain),
-                    "Spread %": f"{spread_pct:6.2f}%",
-                    "⏳ Attente": f"{buy_queue_ratio:>4.2f}j",
-                    "Vendus (achat)": f"{exec_sell_qty:,}",
-                    "Vendus (vente)": f"{exec_buy_qty:,}",
-                })
+            for r in s.execute(flip_query(today, latest_ts, from_summary=from_summary))
+        ]
 
         if not results:
             print("❌ Aucun flip rapide détecté.")
@@ -125,4 +177,4 @@ def find_fast_flips():
         print(tabulate(results, headers="keys", tablefmt="fancy_grid"))
 
 if __name__ == "__main__":
-    find_fast_flips()
\ No newline at end of file
+    find_fast_flips()
@@ -0,0 +1,132 @@
+# flip_scoring.py
+# ----------------------------------------------------------------
+# Moteur de scoring vectorisé pour les flips rapides.
+#
+# Les candidats (dernier snapshot + totaux intraday, voir
+# find_fast_flips.flip_query) sont chargés une seule fois en colonnes
+# pandas/NumPy ; les règles MAX_BUY_WAIT_RATIO / MIN_SELL_SPEED /
+# MIN_NET_GAIN / MIN_SPREAD_PCT deviennent des masques booléens, ce qui
+# permet de balayer des centaines de jeux de seuils sur le même frame.
+#
+#   df  = load_candidates()
+#   top = score_flips(df, top=20, min_net_gain=50)
+#   res = sweep(df, [{"min_net_gain": g} for g in (15, 50, 100)])
+# ----------------------------------------------------------------
+
+import datetime
+import itertools
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func
+
+from models import Session, Snapshot
+from find_fast_flips import (
+    flip_query, summary_available,
+    MAX_BUY_WAIT_RATIO, MIN_SELL_SPEED, MIN_NET_GAIN, MIN_SPREAD_PCT,
+)
+
+FEE = 0.15                     # taxe + frais de listing du Trading Post
+
+DEFAULTS = dict(
+    max_buy_wait_ratio = MAX_BUY_WAIT_RATIO,
+    min_sell_speed     = MIN_SELL_SPEED,
+    min_net_gain       = MIN_NET_GAIN,
+    min_spread_pct     = MIN_SPREAD_PCT,
+)
+
+_NUMERIC = (
+    "avg_buy_price", "avg_sell_price", "total_buy_qty_listed",
+    "exec_sell_qty", "exec_buy_qty",
+)
+
+
+def load_candidates(day: datetime.date | None = None) -> pd.DataFrame:
+    """Dernier snapshot + totaux intraday de `day` (aujourd'hui par défaut), sans filtre."""
+    day = day or datetime.date.today()
+    with Session() as s:
+        latest_ts = s.query(func.max(Snapshot.ts)).scalar()
+        q = flip_query(day, latest_ts, filtered=False,
+                       from_summary=summary_available(s, day))
+        df = pd.DataFrame(s.execute(q).mappings().all())
+    if df.empty:
+        return pd.DataFrame(columns=["item_id", "name", *_NUMERIC])
+    df[list(_NUMERIC)] = df[list(_NUMERIC)].apply(pd.to_numeric).astype("float64")
+    return df[["item_id", "name", *_NUMERIC]]
+
+
+def flip_metrics(df: pd.DataFrame) -> pd.DataFrame:
+    """Ajoute spread, spread_pct, net_gain, buy_queue_ratio et score (colonnes float)."""
+    buy  = df["avg_buy_price"].to_numpy(dtype="float64")
+    sell = df["avg_sell_price"].to_numpy(dtype="float64")
+    exec_sell = df["exec_sell_qty"].to_numpy(dtype="float64")
+    exec_buy  = df["exec_buy_qty"].to_numpy(dtype="float64")
+    listed    = df["total_buy_qty_listed"].to_numpy(dtype="float64")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spread = sell - buy
+        spread_pct = np.where(buy != 0, spread * 100 / buy, np.nan)
+        net_gain = np.floor(sell * (1 - FEE)) - buy
+        buy_queue_ratio = np.where(exec_sell != 0, listed / exec_sell, np.nan)
+
+    return df.assign(
+        spread=spread,
+        spread_pct=spread_pct,
+        net_gain=net_gain,
+        buy_queue_ratio=buy_queue_ratio,
+        # gain potentiel sur la journée si tout le volume exécuté passait
+        score=net_gain * exec_buy,
+    )
+
+
+def candidate_mask(df: pd.DataFrame,
+                   max_buy_wait_ratio: float = MAX_BUY_WAIT_RATIO,
+                   min_sell_speed: float = MIN_SELL_SPEED,
+                   min_net_gain: float = MIN_NET_GAIN,
+                   min_spread_pct: float = MIN_SPREAD_PCT) -> np.ndarray:
+    """Masque des lignes qui passent toutes les règles (df issu de flip_metrics)."""
+    # les NaN (division par zéro) échouent toutes les comparaisons
+    return (
+        (df["net_gain"].to_numpy() >= min_net_gain)
+        & (df["spread_pct"].to_numpy() >= min_spread_pct)
+        & (df["buy_queue_ratio"].to_numpy() <= max_buy_wait_ratio)
+        & (df["exec_buy_qty"].to_numpy() >= min_sell_speed)
+    )
+
+
+def score_flips(df: pd.DataFrame, top: int | None = None,
+                rank_by: str = "score", **thresholds) -> pd.DataFrame:
+    """Candidats retenus, triés par `rank_by` décroissant (les `top` premiers)."""
+    if "net_gain" not in df:
+        df = flip_metrics(df)
+    params = {**DEFAULTS, **thresholds}
+    out = df[candidate_mask(df, **params)]
+    if top is not None:
+        out = out.nlargest(top, rank_by)
+    else:
+        out = out.sort_values(rank_by, ascending=False)
+    return out.reset_index(drop=True)
+
+
+def grid(**axes) -> list[dict]:
+    """Produit cartésien : grid(min_net_gain=[15, 50], min_spread_pct=[5, 10])."""
+    keys = list(axes)
+    return [dict(zip(keys, vals)) for vals in itertools.product(*axes.values())]
+
+
+def sweep(df: pd.DataFrame, param_sets: list[dict], top: int = 10) -> pd.DataFrame:
+    """Une ligne par jeu de seuils : nb de candidats, score cumulé, meilleurs items."""
+    if "net_gain" not in df:
+        df = flip_metrics(df)
+    rows = []
+    for params in param_sets:
+        mask = candidate_mask(df, **{**DEFAULTS, **params})
+        hits = df[mask]
+        best = hits.nlargest(top, "score")
+        rows.append({
+            **{**DEFAULTS, **params},
+            "candidates": int(mask.sum()),
+            "total_score": float(hits["score"].sum()),
+            "top_items": best["item_id"].tolist(),
+        })
+    return pd.DataFrame(rows)
@@ -0,0 +1,223 @@
+# history_cache.py
+# ----------------------------------------------------------------
+# Cache local en colonnes de la table snapshots, pour les analyses et
+# backtests qui relisent tout l'historique.
+#
+# Un dossier par mois dans HISTORY_CACHE_DIR (défaut .history_cache/) :
+#
+#   2025-07/item_ids.npy     ids triés (int32), une ligne par item
+#           present.npy      bool [item, jour] : snapshot existant
+#           <colonne>.npy    [item, jour], NaN si pas de snapshot
+#                            (float64 pour les colonnes entières,
+#                            exactes ; float32 pour les ratios)
+#
+# Un mois est exporté d'un bloc (COPY … TO STDOUT, sans ORM) puis mis
+# en place par renommage ; les fichiers sont relus en mémoire-mappée
+# (np.load(mmap_mode="r")) : seules les colonnes et lignes demandées
+# sont lues sur disque.
+#
+#   python history_cache.py sync            mois absents + dernier mois
+#   python history_cache.py sync --full     tout reconstruire
+#
+#   ids, days, cols = load(["avg_buy_price", "exec_sell_qty"], start, end)
+#   df = load_frame(["avg_buy_price"], start, end, items=[19721, 24])
+#
+# aggregate_daily.py met à jour les mois agrégés après chaque run si
+# HISTORY_CACHE_DIR est défini.
+# ----------------------------------------------------------------
+
+import argparse
+import calendar
+import datetime
+import io
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import Date, Numeric, cast, func, select
+
+load_dotenv()
+from models import Snapshot, get_engine
+
+CACHE_DIR = Path(os.getenv("HISTORY_CACHE_DIR", ".history_cache"))
+
+COLUMNS = [c.name for c in Snapshot.__table__.c if c.name not in ("id", "item_id", "ts")]
+DTYPES  = {
+    c.name: np.float32 if isinstance(c.type, Numeric) else np.float64
+    for c in Snapshot.__table__.c if c.name in COLUMNS
+}
+
+
+def month_start(day: datetime.date) -> datetime.date:
+    return day.replace(day=1)
+
+
+def next_month(month: datetime.date) -> datetime.date:
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def month_dir(month: datetime.date, cache_dir: Path = CACHE_DIR) -> Path:
+    return cache_dir / month.strftime("%Y-%m")
+
+
+def cached_months(cache_dir: Path = CACHE_DIR) -> list[datetime.date]:
+    if not cache_dir.exists():
+        return []
+    return sorted(
+        datetime.datetime.strptime(p.name, "%Y-%m").date()
+        for p in cache_dir.iterdir()
+        if p.is_dir() and (p / "item_ids.npy").exists() and len(p.name) == 7
+    )
+
+
+# ----------------------------------------------------------------
+# Export
+# ----------------------------------------------------------------
+def _copy_month(conn, month: datetime.date) -> pd.DataFrame:
+    cols = ", ".join(COLUMNS)
+    sql = (
+        f"COPY (SELECT item_id, ts::date - DATE '{month}' AS day, {cols}"
+        f" FROM snapshots WHERE ts >= DATE '{month}' AND ts < DATE '{next_month(month)}')"
+        " TO STDOUT WITH (FORMAT csv, HEADER)"
+    )
+    buf = io.BytesIO()
+    cur = conn.connection.cursor()
+    try:
+        cur.copy_expert(sql, buf)
+    finally:
+        cur.close()
+    buf.seek(0)
+    return pd.read_csv(buf, dtype={"item_id": np.int32, "day": np.int16, **DTYPES})
+
+
+def export_month(conn, month: datetime.date, cache_dir: Path = CACHE_DIR) -> int:
+    """Réécrit le mois `month` depuis snapshots ; retourne le nombre de snapshots."""
+    df = _copy_month(conn, month)
+    ndays = calendar.monthrange(month.year, month.month)[1]
+    ids, row = np.unique(df["item_id"].to_numpy(), return_inverse=True)
+    day = df["day"].to_numpy()
+
+    target = month_dir(month, cache_dir)
+    tmp = target.with_name(target.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    np.save(tmp / "item_ids.npy", ids.astype(np.int32))
+    present = np.zeros((len(ids), ndays), dtype=bool)
+    present[row, day] = True
+    np.save(tmp / "present.npy", present)
+    for col in COLUMNS:
+        arr = np.full((len(ids), ndays), np.nan, dtype=DTYPES[col])
+        arr[row, day] = df[col].to_numpy()
+        np.save(tmp / f"{col}.npy", arr)
+
+    # remplacement quasi atomique : l'ancien mois n'est supprimé qu'après
+    old = target.with_name(target.name + ".old")
+    if target.exists():
+        target.rename(old)
+    tmp.rename(target)
+    shutil.rmtree(old, ignore_errors=True)
+    return len(df)
+
+
+def update(days, cache_dir: Path = CACHE_DIR) -> None:
+    """Ré-exporte les mois contenant `days` (après une agrégation)."""
+    months = sorted({month_start(d) for d in days})
+    if not months:
+        return
+    with get_engine().connect() as conn:
+        for month in months:
+            n = export_month(conn, month, cache_dir)
+            print(f"🗄️  cache {month:%Y-%m} : {n} snapshots")
+
+
+def sync(full: bool = False, cache_dir: Path = CACHE_DIR) -> None:
+    """Exporte les mois absents du cache, plus le dernier mois (en cours)."""
+    with get_engine().connect() as conn:
+        first, last = conn.execute(   # dates, que snapshots.ts soit date ou timestamp
+            select(cast(func.min(Snapshot.ts), Date), cast(func.max(Snapshot.ts), Date))
+        ).one()
+    if first is None:
+        print("👍 snapshots vide, rien à exporter.")
+        return
+    have = set(cached_months(cache_dir))
+    months, m = [], month_start(first)
+    while m <= last:
+        if full or m not in have or m == month_start(last):
+            months.append(m)
+        m = next_month(m)
+    update(months, cache_dir)
+
+
+# ----------------------------------------------------------------
+# Lecture
+# ----------------------------------------------------------------
+def open_month(month: datetime.date, columns=(), cache_dir: Path = CACHE_DIR):
+    """(item_ids, present, {col: memmap}) d'un mois, sans rien copier."""
+    d = month_dir(month, cache_dir)
+    ids = np.load(d / "item_ids.npy")
+    present = np.load(d / "present.npy", mmap_mode="r")
+    return ids, present, {c: np.load(d / f"{c}.npy", mmap_mode="r") for c in columns}
+
+
+def load(columns, start: datetime.date, end: datetime.date,
+         items=None, cache_dir: Path = CACHE_DIR):
+    """
+    Colonnes `columns` sur [start, end] : (item_ids, days, {col: [item, jour]})
+    plus la clé "present" (bool).  `items` restreint les lignes ; par défaut
+    tous les items vus sur la période.  Les jours hors cache restent NaN.
+    """
+    months = [m for m in cached_months(cache_dir) if month_start(start) <= m <= end]
+    opened = [(m, *open_month(m, columns, cache_dir)) for m in months]
+    if items is None:
+        ids = np.unique(np.concatenate([o[1] for o in opened])) if opened else np.empty(0, np.int32)
+    else:
+        ids = np.unique(np.asarray(items, dtype=np.int32))
+
+    ndays = (end - start).days + 1
+    days = np.array([start + datetime.timedelta(days=i) for i in range(ndays)])
+    out = {c: np.full((len(ids), ndays), np.nan, dtype=DTYPES[c]) for c in columns}
+    out["present"] = np.zeros((len(ids), ndays), dtype=bool)
+
+    for month, m_ids, present, cols in opened:
+        # lignes du mois correspondant aux ids demandés
+        pos = np.searchsorted(m_ids, ids).clip(max=max(len(m_ids) - 1, 0))
+        found = (m_ids[pos] == ids) if len(m_ids) else np.zeros(len(ids), bool)
+        src_rows, dst_rows = pos[found], np.flatnonzero(found)
+        # jours du mois dans [start, end]
+        lo = max(start, month)
+        hi = min(end, next_month(month) - datetime.timedelta(days=1))
+        s0, s1 = (lo - month).days, (hi - month).days + 1
+        d0 = (lo - start).days
+        sel = np.ix_(dst_rows, np.arange(d0, d0 + s1 - s0))
+        out["present"][sel] = present[src_rows, s0:s1]
+        for c in columns:
+            out[c][sel] = cols[c][src_rows, s0:s1]
+    return ids, days, out
+
+
+def load_frame(columns, start: datetime.date, end: datetime.date,
+               items=None, cache_dir: Path = CACHE_DIR) -> pd.DataFrame:
+    """Même contenu que load, en lignes (item_id, ts, colonnes…) comme snapshots."""
+    ids, days, arrays = load(columns, start, end, items, cache_dir)
+    rows, cols = np.nonzero(arrays["present"])
+    df = pd.DataFrame({"item_id": ids[rows], "ts": days[cols]})
+    for c in columns:
+        df[c] = arrays[c][rows, cols]
+    return df
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("command", choices=("sync",))
+    ap.add_argument("--full", action="store_true", help="reconstruit tous les mois")
+    ap.add_argument("--dir", type=Path, default=CACHE_DIR, help="dossier du cache")
+    args = ap.parse_args()
+    sync(args.full, args.dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,8 @@ import requests
 from dotenv import load_dotenv
 
 load_dotenv()
-import os
-if not os.getenv("DATABASE_URL"):
-    raise RuntimeError("DATABASE_URL n'est pas défini (ni dans .env, ni en variable d'environnement).")
-import time
 from models import Session, Item
+from item_names import fetch_items, load_cache, save_cache
 
 API_BASE = "https://api.guildwars2.com/v2"
 
@@ -17,15 +14,8 @@ def get_all_trading_post_item_ids():
     return response.json()
 
 def get_item_details(ids):
-    chunks = [ids[i:i+200] for i in range(0, len(ids), 200)]
-    results = []
-    for chunk in chunks:
-        url = f"{API_BASE}/items"
-        response = requests.get(url, params={"ids": ",".join(map(str, chunk))})
-        response.raise_for_status()
-        results.extend(response.json())
-        time.sleep(0.3)  # pour respecter l'API rate limit
-    return results
+    # lots de 200 en parallèle, cadencés (voir item_names.py)
+    return fetch_items(ids, API_BASE)
 
 def fetch_and_store_items():
     ids = get_all_trading_post_item_ids()
@@ -43,6 +33,11 @@ def fetch_and_store_items():
             session.merge(Item(id=item_id, name=name))
         session.commit()
 
+    # alimente le cache de noms utilisé par aggregate_daily
+    cache = load_cache()
+    cache.update({item["id"]: item["name"] for item in items_data if item.get("name")})
+    save_cache(cache)
+
     print("✔️ Insertion terminée.")
 
 if __name__ == "__main__":
@@ -1,78 +1,148 @@
 #!/usr/bin/env python3
-"""Importe scraped_trends/*.json → tables items & daily_raw (ORM models.py)."""
+"""Importe scraped_trends/*.json|*.jsonl → tables items & daily_raw (ORM models.py).
 
-import argparse, json
+to_daily_raw / load_batch servent aussi au mode --to-db de
+scrape_trends_playwright.py, qui verse les lignes sans passer par le disque.
+
+--workers N : les fichiers <id>.json sont regroupés par --files-per-tx en
+transactions réparties sur un pool de N processus (un engine chacun) ;
+les items sont pré-créés une fois d'après les noms de fichiers avant la
+phase parallèle.  Les .jsonl restent importés en flux, un par un.
+"""
+
+import argparse
 from dotenv import load_dotenv
 
 load_dotenv()
-import os
-if not os.getenv("DATABASE_URL"):
-    raise RuntimeError("DATABASE_URL n'est pas défini (ni dans .env, ni en variable d'environnement).")
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
-from sqlalchemy.orm import Session
-from sqlalchemy import select
-from sqlalchemy.dialects.postgresql import insert as pg_insert
-from models import engine, Item, DailyRaw   # ← ton fichier models.py
-
-# ────── paramètres CLI ───────────────────────────────────────────────────────
-p = argparse.ArgumentParser()
-p.add_argument("--dir",   default="scraped_trends", help="dossier .json")
-p.add_argument("--batch", default=10_000, type=int, help="taille batch")
-args = p.parse_args()
-DATA_DIR = Path(args.dir)
-assert DATA_DIR.exists(), f"{DATA_DIR} introuvable"
+from models import get_engine, daily_raw_partitioned, ensure_daily_partitions
+from item_names import ensure_items, name_items
+from json_stream import iter_json_array, iter_json_lines, batched
+from bulk_ingest import load_rows
+
+BATCH        = 10_000
+FILES_PER_TX = 50
 
 # ────── helpers ──────────────────────────────────────────────────────────────
 def parse_ts(ts: str) -> datetime:      # « 2025-01-05T00:00:01.000Z » → naïf
     return datetime.fromisoformat(ts.replace("Z", ""))   # pas de TZ → ts « naive »
 
-def ensure_items(sess: Session, ids: set[int]):
-    existing = {i for (i,) in sess.execute(select(Item.id).where(Item.id.in_(ids)))}
-    missing  = ids - existing
-    if missing:
-        sess.bulk_save_objects([Item(id=i, name=f"item_{i}") for i in missing])
-        sess.flush()     # pas commit ici – commit à la fin du fichier
-
-def flush(sess: Session, buf: list[dict]):
-    if not buf:
-        return
-    stmt = (
-        pg_insert(DailyRaw)
-        .values(buf)
-        .on_conflict_do_nothing(index_elements=["item_id", "ts"])
+def to_daily_raw(r: dict) -> dict:       # ligne scrapée → colonnes daily_raw
+    return dict(
+        item_id       = int(r["item_id"]),
+        ts            = parse_ts(r["ts"]),
+        buy_price     = int(r["buy_price"]),
+        buy_quantity  = int(r["buy_qty"]),
+        sell_price    = int(r["sell_price"]),
+        sell_quantity = int(r["sell_qty"]),
     )
-    sess.execute(stmt)
+
+def read_rows(path: Path):              # un fichier par item (.json) ou JSON lines
+    if path.suffix == ".jsonl":
+        return iter_json_lines(path)
+    return iter_json_array(path)
+
+def load_batch(conn, rows: list[dict], unnamed: set | None = None) -> int:
+    """Items manquants + COPY ON CONFLICT DO NOTHING (alimente aussi intraday_rollup).
+    `unnamed` reçoit les items créés sans nom (name_items après commit)."""
+    if not rows:
+        return 0
+    created = ensure_items(conn, {r["item_id"] for r in rows})
+    if unnamed is not None:
+        unnamed.update(created)
+    return load_rows(conn, rows, unnamed=unnamed)[1]
+
+def import_file(path: Path, batch: int = BATCH) -> int:
+    """Importe un fichier en une transaction ; retourne le nombre de lignes lues."""
+    n, unnamed = 0, set()
+    with get_engine().begin() as conn:
+        for rows in batched(map(to_daily_raw, read_rows(path)), batch):
+            load_batch(conn, rows, unnamed)
+            n += len(rows)
+    name_items(unnamed)
+    return n
+
+# ────── import parallèle ─────────────────────────────────────────────────────
+def seed_items(paths: list[Path]) -> int:
+    """Crée d'un coup les items des fichiers <id>.json (avant les workers)."""
+    ids = {int(p.stem) for p in paths if p.stem.isdigit()}
+    with get_engine().begin() as conn:
+        unnamed = ensure_items(conn, ids)
+    name_items(unnamed)
+    return len(ids)
+
+def import_group(paths: list[Path], batch: int = BATCH) -> tuple[int, int]:
+    """Importe un groupe de petits fichiers <id>.json (items déjà créés) en
+    une transaction ; retourne (fichiers non vides, lignes lues)."""
+    files = [list(map(to_daily_raw, read_rows(p))) for p in paths]
+    # partitions dans une transaction courte à part : créées au milieu du
+    # chargement, elles verrouilleraient daily_raw contre les autres workers
+    days = {r["ts"].date() for rows in files for r in rows}
+    with get_engine().begin() as conn:
+        if daily_raw_partitioned(conn):
+            ensure_daily_partitions(conn, days)
+
+    # items pré-créés d'après le nom ; sinon ensure_items par lot
+    seeded = [r for p, rows in zip(paths, files) if p.stem.isdigit() for r in rows]
+    others = [r for p, rows in zip(paths, files) if not p.stem.isdigit() for r in rows]
+    unnamed = set()
+    with get_engine().begin() as conn:    # un COPY par lot, pas par fichier
+        for chunk in batched(seeded, batch):
+            load_rows(conn, chunk)
+        for chunk in batched(others, batch):
+            load_batch(conn, chunk, unnamed)
+    name_items(unnamed)
+    return sum(1 for rows in files if rows), sum(map(len, files))
+
+def _init_worker():
+    # connexions héritées du parent (fork) : le worker ouvre les siennes
+    get_engine().dispose(close=False)
+
+def import_parallel(paths: list[Path], workers: int,
+                    files_per_tx: int = FILES_PER_TX, batch: int = BATCH) -> None:
+    t0 = time.monotonic()
+    print(f"👥 {seed_items(paths)} items pré-créés")
+    groups = [paths[i:i + files_per_tx] for i in range(0, len(paths), files_per_tx)]
+    files = rows = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = [pool.submit(import_group, g, batch) for g in groups]
+        for fut in as_completed(futures):
+            f, n = fut.result()
+            files += f; rows += n
+            print(f"✅ {files}/{len(paths)} fichiers  ({rows} lignes)")
+    print(f"⏱️  {rows} lignes en {time.monotonic() - t0:.1f}s avec {workers} workers")
 
 # ────── import ───────────────────────────────────────────────────────────────
-files = sorted(DATA_DIR.glob("*.json"))
-print(f"{len(files)} fichiers à importer…")
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--dir",   default="scraped_trends", help="dossier .json / .jsonl")
+    p.add_argument("--batch", default=BATCH, type=int, help="taille batch")
+    p.add_argument("--workers", default=1, type=int, help="processus d'import parallèles")
+    p.add_argument("--files-per-tx", default=FILES_PER_TX, type=int,
+                   help="fichiers .json par transaction (mode --workers)")
+    args = p.parse_args()
+    data_dir = Path(args.dir)
+    assert data_dir.exists(), f"{data_dir} introuvable"
+
+    files = sorted([*data_dir.glob("*.json"), *data_dir.glob("*.jsonl")])
+    print(f"{len(files)} fichiers à importer…")
+
+    if args.workers > 1:
+        small = [f for f in files if f.suffix == ".json"]
+        files = [f for f in files if f.suffix == ".jsonl"]
+        if small:
+            import_parallel(small, args.workers, args.files_per_tx, args.batch)
 
-with Session(engine) as sess:
     for jf in files:
-        data = json.loads(jf.read_text())
-        if not data:
+        n = import_file(jf, args.batch)
+        if not n:
             print(f"⚠️  {jf.name} vide – ignoré"); continue
+        print(f"✅ {jf.name}  ({n} lignes)")
+
+    print("🎉  Import terminé – lance aggregate_daily.py pour snapshots.")
 
-        ensure_items(sess, {int(r["item_id"]) for r in data})
-
-        batch = []
-        for r in data:
-            batch.append(
-                dict(
-                    item_id       = int(r["item_id"]),
-                    ts            = parse_ts(r["ts"]),
-                    buy_price     = int(r["buy_price"]),
-                    buy_quantity  = int(r["buy_qty"]),
-                    sell_price    = int(r["sell_price"]),
-                    sell_quantity = int(r["sell_qty"]),
-                )
-            )
-            if len(batch) >= args.batch:
-                flush(sess, batch); batch.clear()
-
-        flush(sess, batch)
-        sess.commit()
-        print(f"✅ {jf.name}  ({len(data)} lignes)")
-
-print("🎉  Import terminé – lance aggregate_daily.py pour snapshots.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+ingest_daemon.py
+──────────────────────────────────────────────────────────────────────────────
+Service d'ingestion continue, à la place de local_ingest.py lancé en cron.
+
+Le processus reste vivant avec son pool de connexions : toutes les
+--poll secondes il ingère les captures posées dans snapshots/ (JSON ou
+.gw2s), par lots d'au plus --max-files, avec le même chargement que
+local_ingest (COPY, plusieurs fichiers par transaction, registre
+ingest_ledger, fichier supprimé après commit).  Une capture est donc
+requêtable dans daily_raw quelques secondes après son écriture.
+
+Le ménage git (pull --rebase de raw-feed pour récupérer les captures du
+workflow, commit + push des suppressions) tourne à part, toutes les
+--git-every secondes ; --git-every 0 le désactive (captures locales).
+
+Un fichier illisible (JSON ou .gw2s invalide, valeurs rejetées par la
+base) est déplacé dans snapshots/failed/ au lieu de bloquer les
+suivants ; une base injoignable est simplement retentée ; toute autre
+erreur (table absente, schéma pas à jour…) arrête le service sans
+toucher aux fichiers.
+SIGINT / SIGTERM : fin du lot en cours, dernier ménage git, sortie.
+"""
+
+import argparse, datetime, signal, struct, threading, time, zlib
+from dotenv import load_dotenv
+
+load_dotenv()
+import psycopg2
+from sqlalchemy.exc import DataError, IntegrityError, InterfaceError, OperationalError
+
+from local_ingest import (
+    BRANCH, FILES_PER_TX, SNAP_DIR,
+    ensure_branch_up_to_date, files_to_ingest, git, ingest_files,
+)
+
+# ───────────── CONFIG ────────────────────────────────────────────────────────
+POLL      = 2.0                 # secondes entre deux scrutations du dossier
+SETTLE    = 1.0                 # âge min. d'un fichier (écriture terminée)
+MAX_FILES = 200                 # fichiers max par lot
+GIT_EVERY = 300                 # secondes entre deux ménages git (0 = jamais)
+FAILED    = SNAP_DIR / "failed"
+# ─────────────────────────────────────────────────────────────────────────────
+
+# erreurs dues au contenu d'un fichier (seules à le mettre en quarantaine) ;
+# psycopg2.* : levées telles quelles par le COPY (bulk_ingest)
+BAD_FILE = (
+    ValueError, KeyError, zlib.error, struct.error,        # JSON, snapfmt, champs
+    DataError, IntegrityError, psycopg2.DataError, psycopg2.IntegrityError,
+)
+
+
+def ready_files(max_files: int = MAX_FILES, settle: float = SETTLE):
+    """Captures complètes (non modifiées depuis `settle` s), plus anciennes d'abord."""
+    now = time.time()
+    files = []
+    for path in files_to_ingest():
+        try:
+            if now - path.stat().st_mtime >= settle:
+                files.append(path)
+        except FileNotFoundError:        # supprimé entre glob et stat
+            pass
+    return files[:max_files]
+
+
+def quarantine(path) -> None:
+    FAILED.mkdir(exist_ok=True)
+    path.replace(FAILED / path.name)
+    print(f"🚫 {path.name} illisible → {FAILED}/")
+
+
+def ingest_batch(paths, files_per_tx: int = FILES_PER_TX) -> int:
+    """Ingère un lot ; en cas d'échec, isole le(s) fichier(s) fautif(s).
+    Retourne le nombre de fichiers ingérés."""
+    try:
+        ingest_files(paths, files_per_tx)
+        return len(paths)
+    except BAD_FILE as exc:              # le reste (base, schéma) remonte tel quel
+        print(f"⚠️  lot en échec ({exc.__class__.__name__}: {exc}) — fichier par fichier")
+
+    done = 0
+    for path in paths:
+        if not path.exists():            # déjà ingéré avec un groupe précédent
+            done += 1
+            continue
+        try:
+            ingest_files([path], 1)
+            done += 1
+        except BAD_FILE:
+            quarantine(path)
+    return done
+
+
+def housekeeping() -> None:
+    """Récupère les nouvelles captures de raw-feed et pousse les suppressions."""
+    ensure_branch_up_to_date()
+    git("add", "-u", str(SNAP_DIR))
+    # rien à committer → code retour non nul, pas d'erreur
+    commit = git("commit", "-m", f"purge after ingest {datetime.date.today()}", check=False)
+    if commit.returncode == 0:
+        git("push", "origin", BRANCH)
+
+
+def run(poll: float = POLL, git_every: float = GIT_EVERY,
+        max_files: int = MAX_FILES, files_per_tx: int = FILES_PER_TX) -> None:
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    next_git = 0.0                       # premier ménage tout de suite
+    print(f"👀 Surveillance de {SNAP_DIR}/ toutes les {poll:g}s "
+          f"(git : {f'toutes les {git_every:g}s' if git_every else 'désactivé'})")
+    while not stop.is_set():
+        if git_every and time.monotonic() >= next_git:
+            try:
+                housekeeping()
+            except Exception as exc:     # réseau, conflit… : on réessaiera
+                print(f"⚠️  ménage git en échec : {exc}")
+            next_git = time.monotonic() + git_every
+
+        files = ready_files(max_files)
+        if files:
+            t0 = time.monotonic()
+            try:
+                n = ingest_batch(files, files_per_tx)
+                print(f"📥 {n}/{len(files)} fichiers ingérés en {time.monotonic() - t0:.1f}s")
+            except (OperationalError, InterfaceError) as exc:
+                print(f"⚠️  base injoignable, nouvel essai dans {poll * 5:g}s : {exc.orig}")
+                stop.wait(poll * 5)
+            if len(files) == max_files:  # arriéré : on enchaîne sans attendre
+                continue
+        stop.wait(poll)
+
+    if git_every:
+        print("⏹️  Arrêt — dernier ménage git …")
+        try:
+            housekeeping()
+        except Exception as exc:
+            print(f"⚠️  ménage git en échec : {exc}")
+    print("👋 Service arrêté.")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--poll", type=float, default=POLL, help="secondes entre deux scrutations")
+    ap.add_argument("--git-every", type=float, default=GIT_EVERY,
+                    help="secondes entre deux pull/push de raw-feed (0 = désactivé)")
+    ap.add_argument("--max-files", type=int, default=MAX_FILES, help="fichiers max par lot")
+    ap.add_argument("--files-per-tx", type=int, default=FILES_PER_TX,
+                    help="nombre de fichiers par transaction")
+    args = ap.parse_args()
+    run(args.poll, args.git_every, args.max_files, args.files_per_tx)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# item_names.py
+# ------------------------------------------------------------------
+# Résolution des noms d'items manquants dans la table items :
+#   1. un seul SELECT id FROM items WHERE id = ANY(…) pour trouver les
+#      ids absents ;
+#   2. cache local persistant {id: nom} (ITEM_NAMES_CACHE, JSON) ;
+#   3. pour le reste, /v2/items?ids= par lots de 200 en parallèle,
+#      cadencé par un seau à jetons ;
+#   4. un seul INSERT … ON CONFLICT DO NOTHING (placeholder auto_{id}
+#      si l'API ne connaît pas l'item ou ne répond pas).
+#
+# À l'ingestion, aucun appel HTTP dans la transaction de chargement :
+# ensure_items n'y insère que les ids (nom du cache, sinon auto_{id}),
+# ce qui suffit à la FK daily_raw → items ; name_items remplace ensuite
+# les placeholders, après le commit, dans une courte transaction à part.
+# ------------------------------------------------------------------
+
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from sqlalchemy import Integer, String, any_, bindparam, cast, column, select, update, values
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+
+from models import Item, get_engine
+from ratelimit import TokenBucket
+
+API_BASE     = os.getenv("GW2_API_BASE", "https://api.guildwars2.com/v2")
+CACHE_PATH   = Path(os.getenv("ITEM_NAMES_CACHE", ".item_names.json"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "20"))
+CHUNK        = 200               # ids max par requête /v2/items
+WORKERS      = 4
+RATE         = 5.0               # requêtes / seconde
+
+
+def load_cache(path: Path = CACHE_PATH) -> dict[int, str]:
+    try:
+        return {int(k): v for k, v in json.loads(path.read_text(encoding="utf-8")).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_cache(names: dict[int, str], path: Path = CACHE_PATH) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps({str(k): v for k, v in sorted(names.items())},
+                              ensure_ascii=False), encoding="utf-8")
+    tmp.replace(path)
+
+
+def _fetch_chunk(chunk, bucket: TokenBucket, api_base: str) -> list[dict]:
+    bucket.acquire()
+    r = requests.get(f"{api_base}/items",
+                     params={"ids": ",".join(map(str, chunk)), "lang": "en"},
+                     timeout=HTTP_TIMEOUT)
+    if r.status_code == 404:             # aucun id du lot n'existe
+        return []
+    r.raise_for_status()                 # 206 : seuls les ids connus sont renvoyés
+    return r.json()
+
+
+def fetch_items(ids, api_base: str = API_BASE, workers: int = WORKERS,
+                rate: float = RATE, skip_errors: bool = False) -> list[dict]:
+    """Détails /v2/items des `ids`, lots de CHUNK récupérés en parallèle.
+    skip_errors : un lot en échec est signalé puis ignoré au lieu de lever."""
+    ids = list(ids)
+    chunks = [ids[i:i + CHUNK] for i in range(0, len(ids), CHUNK)]
+    bucket = TokenBucket(rate, workers)
+
+    def one(chunk):
+        try:
+            return _fetch_chunk(chunk, bucket, api_base)
+        except (requests.RequestException, ValueError) as exc:
+            if not skip_errors:
+                raise
+            print(f"⚠️  noms des items {chunk[0]}… indisponibles : {exc}", file=sys.stderr)
+            return []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [item for items in pool.map(one, chunks) for item in items]
+
+
+def resolve_names(ids, cache_path: Path = CACHE_PATH) -> dict[int, str]:
+    """{id: nom} pour les ids connus du cache ou de l'API ; le cache est complété."""
+    cache = load_cache(cache_path)
+    unknown = [i for i in ids if i not in cache]
+    if unknown:
+        fetched = {
+            item["id"]: item["name"]
+            for item in fetch_items(unknown, skip_errors=True)
+            if item.get("name")
+        }
+        if fetched:
+            cache.update(fetched)
+            save_cache(cache, cache_path)
+    return {i: cache[i] for i in ids if i in cache}
+
+
+def ensure_items(conn, ids) -> list[int]:
+    """Insère dans items les `ids` absents, sans appel HTTP : nom du cache
+    local, sinon auto_{id}.  Retourne les ids insérés sans nom, à passer
+    à name_items une fois la transaction commitée."""
+    ids = {int(i) for i in ids}
+    if not ids:
+        return []
+    wanted = bindparam("ids", sorted(ids), type_=ARRAY(Integer))
+    existing = set(conn.execute(select(Item.id).where(Item.id == any_(wanted))).scalars())
+    missing = sorted(ids - existing)
+    if not missing:
+        return []
+    cache = load_cache()
+    created = conn.execute(
+        pg_insert(Item)
+        .values([{"id": i, "name": cache.get(i, f"auto_{i}")} for i in missing])
+        .on_conflict_do_nothing(index_elements=["id"])
+        .returning(Item.id)
+    ).scalars()
+    return [i for i in created if i not in cache]
+
+
+def name_items(ids) -> int:
+    """Remplace les placeholders auto_{id} des `ids` par leur nom (cache
+    puis API, hors transaction) ; retourne le nombre d'items renommés."""
+    ids = sorted({int(i) for i in ids})
+    names = resolve_names(ids) if ids else {}
+    if not names:
+        return 0
+    v = values(column("id", Integer), column("name", String), name="v").data(list(names.items()))
+    with get_engine().begin() as conn:      # transaction courte, après le chargement
+        return conn.execute(
+            update(Item)
+            .where(Item.id == v.c.id, Item.name == "auto_" + cast(Item.id, String))
+            .values(name=v.c.name)
+        ).rowcount
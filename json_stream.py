@@ -0,0 +1,84 @@
+# json_stream.py
+# ------------------------------------------------------------------
+# Lecture incrémentale d'un tableau JSON de premier niveau
+# ([{...}, {...}, …]) : le fichier est lu par blocs et chaque élément
+# est décodé dès qu'il est complet, sans jamais matérialiser la liste
+# entière.  La mémoire reste bornée par la taille d'un bloc + celle du
+# plus gros élément, quelle que soit la taille du fichier.
+# iter_json_lines fait de même pour le JSON lines (un objet par ligne).
+# ------------------------------------------------------------------
+
+import json
+from itertools import islice
+from pathlib import Path
+
+CHUNK_SIZE = 1 << 16          # 64 Kio par lecture
+
+_WS = " \t\n\r"
+
+
+def iter_json_array(path: Path, chunk_size: int = CHUNK_SIZE):
+    """Génère un par un les éléments du tableau JSON contenu dans `path`."""
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buf, pos, eof = "", 0, False
+
+        def fill() -> bool:
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+                return False
+            buf, pos = buf[pos:] + chunk, 0
+            return True
+
+        def skip(chars: str) -> None:
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in chars:
+                    pos += 1
+                if pos < len(buf) or not fill():
+                    return
+
+        skip(_WS)
+        if pos >= len(buf):
+            return                                  # fichier vide
+        if buf[pos] != "[":
+            raise ValueError(f"{path} : tableau JSON attendu")
+        pos += 1
+
+        while True:
+            skip(_WS + ",")
+            if pos >= len(buf):
+                raise ValueError(f"{path} : tableau JSON tronqué")
+            if buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if fill():
+                    continue                        # élément coupé par le bloc
+                raise
+            # un scalaire coupé par le bloc (« 2. », « 1e », « -… ») est
+            # décodé trop court : tant qu'il n'est pas suivi d'un
+            # séparateur, on relit
+            if (end == len(buf) or buf[end] not in _WS + ",]") and not eof and fill():
+                continue
+            pos = end
+            yield obj
+
+
+def iter_json_lines(path: Path):
+    """Génère les objets d'un fichier JSON lines ; lignes vides ignorées,
+    ainsi qu'une dernière ligne tronquée (écriture interrompue)."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip() and line.endswith("\n"):
+                yield json.loads(line)
+
+
+def batched(rows, n: int):
+    """Regroupe un itérable en listes de `n` éléments (la dernière plus courte)."""
+    it = iter(rows)
+    while batch := list(islice(it, n)):
+        yield batch
@@ -1,31 +1,47 @@
 """
 local_ingest.py
 ──────────────────────────────────────────────────────────────────────────────
-Met à jour la branche `raw-feed`, ingère tous les snapshots JSON dans
+Met à jour la branche `raw-feed`, ingère tous les snapshots (JSON ou
+binaires .gw2s, voir snapfmt.py) dans
 daily_raw, supprime les fichiers puis pousse la purge.  Si des
 modifications locales sont en cours, elles sont automatiquement stashées
 avant le pull/rebase et restaurées ensuite.
+
+Les fichiers sont chargés par COPY (voir bulk_ingest.py), plusieurs
+fichiers par transaction ; une ligne (item_id, ts) déjà présente est
+ignorée, donc relancer l'ingestion après un crash est sans risque.
+
+Chaque fichier chargé est inscrit dans ingest_ledger (nom, sha256,
+lignes insérées, début de capture) dans la même transaction que ses
+lignes.  Avant de lire un groupe, une seule requête y cherche les noms
+et empreintes : un fichier déjà ingéré (crash entre le commit et la
+suppression) ou identique à un autre (relance du workflow) est sauté
+sans être parsé, puis supprimé comme les autres.
 """
 
-import json, os, subprocess, pathlib, datetime
+import argparse, os, subprocess, pathlib, datetime, hashlib
 from dotenv import load_dotenv
+from sqlalchemy import func, literal, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 # Charge les variables d'environnement (fichier .env éventuel)
 load_dotenv()
-import os
-if not os.getenv("DATABASE_URL"):
-    raise RuntimeError("DATABASE_URL n'est pas défini (ni dans .env, ni en variable d'environnement).")
-from models import Session, DailyRaw      # modèles existants
+from models import IngestLedger, get_engine, ensure_upcoming_partitions
+from bulk_ingest import load_rows
+from item_names import name_items
+from json_stream import iter_json_array
+import snapfmt
 
 # ───────────── CONFIG ────────────────────────────────────────────────────────
 BRANCH       = "raw-feed"
 SNAP_DIR     = pathlib.Path("snapshots")                        # dossier dans le dépôt
+FILES_PER_TX = 10                                               # fichiers par transaction
 # ─────────────────────────────────────────────────────────────────────────────
 
 
 def git(*args, check: bool = True):
     """Exécute git dans le repo courant."""
-    subprocess.run(["git", *args], check=check)
+    return subprocess.run(["git", *args], check=check)
 
 
 def ensure_branch_up_to_date() -> None:
@@ -54,20 +70,86 @@ def ensure_branch_up_to_date() -> None:
 
 def files_to_ingest() -> list[pathlib.Path]:
     SNAP_DIR.mkdir(exist_ok=True)
-    return sorted(SNAP_DIR.glob("*.json"))
+    return sorted([*SNAP_DIR.glob("*.json"), *SNAP_DIR.glob(f"*{snapfmt.SUFFIX}")])
+
+
+def read_rows(path: pathlib.Path):
+    """Lignes d'un fichier de capture, quel que soit son format."""
+    if path.suffix == snapfmt.SUFFIX:
+        return snapfmt.iter_rows(path)
+    return iter_json_array(path)
+
+
+def capture_info(path: pathlib.Path):
+    """(début de capture, keyframe) pour raw_captures ; JSON = capture complète."""
+    if path.suffix == snapfmt.SUFFIX:
+        flags, _, base = snapfmt.read_header(path)
+        return snapfmt.to_datetime(base), not flags & snapfmt.FLAG_DELTA
+    return None, True
+
+
+def file_sha256(path: pathlib.Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def already_ingested(conn, names, digests) -> tuple[set[str], set[str]]:
+    """(noms, empreintes) de ingest_ledger parmi `names` / `digests`."""
+    rows = conn.execute(
+        select(IngestLedger.name, IngestLedger.sha256)
+        .where(or_(IngestLedger.name.in_(names), IngestLedger.sha256.in_(digests)))
+    ).all()
+    return {r.name for r in rows}, {r.sha256 for r in rows}
+
+
+def ingest_files(paths: list[pathlib.Path], files_per_tx: int = FILES_PER_TX) -> None:
+    """Ingère les fichiers par groupes de `files_per_tx`, un COPY par fichier ;
+    les fichiers déjà présents dans ingest_ledger sont sautés."""
+    with get_engine().begin() as conn:    # DDL hors des transactions de chargement
+        ensure_upcoming_partitions(conn)
+    for i in range(0, len(paths), files_per_tx):
+        group = paths[i:i + files_per_tx]
+        digests = {path: file_sha256(path) for path in group}
+        unnamed = set()
+        with get_engine().begin() as conn:
+            names, seen = already_ingested(conn, [p.name for p in group], list(digests.values()))
+            for path in group:
+                digest, capture = digests[path], capture_info(path)
+                if path.name in names:
+                    print(f"   ⏭️  {path.name}  déjà ingéré")
+                    continue
+                if digest in seen:
+                    # contenu identique : inscrit sans relire les lignes, avec
+                    # le début de capture du fichier d'origine
+                    l = IngestLedger
+                    conn.execute(pg_insert(l).from_select(
+                        ["name", "sha256", "rows", "captured_at"],
+                        select(literal(path.name), l.sha256, literal(0),
+                               func.coalesce(capture[0], l.captured_at))
+                        .where(l.sha256 == digest).limit(1),
+                    ).on_conflict_do_nothing())
+                    print(f"   ⏭️  {path.name}  contenu déjà ingéré")
+                    continue
+                read, inserted = load_rows(conn, read_rows(path), capture, (path.name, digest), unnamed)
+                seen.add(digest)
+                print(f"   ↳ {path.name}  ({inserted}/{read} lignes)")
+        for path in group:
+            path.unlink()   # suppression après commit du groupe
+        name_items(unnamed)  # API GW2 hors de la transaction de chargement
 
 
 def ingest_file(path: pathlib.Path) -> None:
-    print(f"   ↳ {path.name}")
-    data = json.loads(path.read_text("utf-8"))
-    with Session() as s:
-        for row in data:
-            s.add(DailyRaw(**row))
-        s.commit()
-    path.unlink()   # suppression après succès
+    ingest_files([path])
 
 
 def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--files-per-tx", type=int, default=FILES_PER_TX,
+                    help="nombre de fichiers par transaction")
+    args = ap.parse_args()
 
     print("→ Mise à jour de la branche raw-feed …")
     ensure_branch_up_to_date()
@@ -77,8 +159,7 @@ def main() -> None:
         print("✅ Aucun nouveau snapshot à ingérer.")
         return
 
-    for f in files:
-        ingest_file(f)
+    ingest_files(files, args.files_per_tx)
 
     # pousser la purge (suppression des fichiers) vers GitHub
     git("add", "-u", str(SNAP_DIR))
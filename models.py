@@ -1,9 +1,11 @@
+import datetime
 import os
 from dotenv import load_dotenv
 from sqlalchemy import (
-    Column, Integer, BigInteger, Date, DateTime, Numeric,
-    String, ForeignKey, UniqueConstraint, create_engine
+    Column, DDL, Integer, BigInteger, Boolean, Date, DateTime, MetaData, Numeric,
+    SmallInteger, String, Table, ForeignKey, UniqueConstraint, create_engine, event, text
 )
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 # Charge les variables d'environnement depuis un fichier .env s'il existe
@@ -79,15 +81,21 @@ class Snapshot(Base):
     pct_change_buy  = Column(Numeric(12, 4))
     pct_change_sell = Column(Numeric(12, 4))
 
+    __table_args__ = (
+        UniqueConstraint("item_id", "ts", name="uq_item_time"),
+    )
+
 # -----------------------------------------------------------------
 # Table daily_raw
 # -----------------------------------------------------------------
 class DailyRaw(Base):
     __tablename__ = "daily_raw"
 
-    id = Column(Integer, primary_key=True)
+    # table partitionnée par jour (RANGE sur ts) : la clé primaire doit
+    # contenir ts ; id en bigint car la séquence survit aux purges
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
     item_id = Column(Integer, ForeignKey("items.id"), nullable=False)
-    ts = Column(DateTime, nullable=False)
+    ts = Column(DateTime, primary_key=True)
     buy_price     = Column(Integer)
     buy_quantity  = Column(Integer)
     sell_price    = Column(Integer)
@@ -95,16 +103,328 @@ class DailyRaw(Base):
 
     __table_args__ = (
         UniqueConstraint("item_id", "ts", name="uq_daily_item_time"),
+        {"postgresql_partition_by": "RANGE (ts)"},
     )
 
 # -----------------------------------------------------------------
-# Connexion & création auto
+# Table daily_ticks : stockage compact des ticks (RAW_STORAGE=packed,
+# voir tick_store.py), une ligne par (item, jour, tranche horaire) au
+# lieu d'une par tick.  Tableaux alignés, triés par ts_ms
+# (millisecondes depuis minuit).
+# -----------------------------------------------------------------
+class DailyTicks(Base):
+    __tablename__ = "daily_ticks"
+    item_id = Column(Integer, ForeignKey("items.id"), primary_key=True)
+    day     = Column(Date, primary_key=True)
+    part    = Column(SmallInteger, primary_key=True)    # ts_ms // tranche
+
+    ts_ms         = Column(ARRAY(Integer), nullable=False)
+    buy_price     = Column(ARRAY(Integer), nullable=False)
+    buy_quantity  = Column(ARRAY(Integer), nullable=False)
+    sell_price    = Column(ARRAY(Integer), nullable=False)
+    sell_quantity = Column(ARRAY(Integer), nullable=False)
+
+# -----------------------------------------------------------------
+# Table raw_captures : une ligne par capture ingérée.  En mode delta
+# (fetch_to_daily_raw --delta) seules les lignes modifiées sont dans
+# daily_raw ; ces instants servent de grille pour le forward-fill.
+# -----------------------------------------------------------------
+class RawCapture(Base):
+    __tablename__ = "raw_captures"
+    ts       = Column(DateTime, primary_key=True)
+    keyframe = Column(Boolean, nullable=False)
+    rows     = Column(Integer, nullable=False)
+
+# -----------------------------------------------------------------
+# Table intraday_rollup : accumulateurs par item et par jour, mis à
+# jour à chaque ingestion (voir rollup.py).  Les histogrammes sont des
+# objets JSON {bucket log(prix) : nb de ticks} pour la médiane approchée.
+# out_of_order : un lot est arrivé avant le dernier tick accumulé, les
+# quantités exécutées ne sont plus exactes (jour finalisé depuis le brut).
 # -----------------------------------------------------------------
-DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    raise RuntimeError("DATABASE_URL n'est pas défini dans l'environnement.")
+class IntradayRollup(Base):
+    __tablename__ = "intraday_rollup"
+    item_id = Column(Integer, ForeignKey("items.id"), primary_key=True)
+    day     = Column(Date, primary_key=True)
+
+    ticks    = Column(Integer, nullable=False)
+    first_ts = Column(DateTime, nullable=False)
+    last_ts  = Column(DateTime, nullable=False)
+
+    open_buy_price  = Column(Integer)
+    open_sell_price = Column(Integer)
+    last_buy_price  = Column(Integer)
+    last_sell_price = Column(Integer)
+    last_buy_qty    = Column(Integer)
+    last_sell_qty   = Column(Integer)
+
+    min_buy_price  = Column(Integer)
+    max_buy_price  = Column(Integer)
+    min_sell_price = Column(Integer)
+    max_sell_price = Column(Integer)
+
+    sum_buy_price    = Column(BigInteger)
+    sum_sell_price   = Column(BigInteger)
+    sumsq_buy_price  = Column(Numeric)
+    sumsq_sell_price = Column(Numeric)
+
+    sum_spread = Column(BigInteger)
+    min_spread = Column(Integer)
+    max_spread = Column(Integer)
+
+    sum_buy_qty   = Column(BigInteger)
+    sum_sell_qty  = Column(BigInteger)
+    exec_buy_qty  = Column(BigInteger)
+    exec_sell_qty = Column(BigInteger)
+
+    hist_buy  = Column(JSONB)
+    hist_sell = Column(JSONB)
+
+    out_of_order = Column(Boolean, nullable=False, server_default=text("false"))
+
+# -----------------------------------------------------------------
+# Table ohlc_bars : barres intraday (5 min, 1 h) construites depuis
+# daily_raw au moment de l'agrégation, avant la purge (voir bars.py).
+# resolution en secondes, ts = début de la barre ; buy/sell_qty =
+# quantités listées en fin de barre, exec_* comme dans snapshots.
+# -----------------------------------------------------------------
+class OhlcBar(Base):
+    __tablename__ = "ohlc_bars"
+    item_id    = Column(Integer, ForeignKey("items.id"), primary_key=True)
+    resolution = Column(Integer, primary_key=True)
+    ts         = Column(DateTime, primary_key=True)
+
+    buy_open   = Column(Integer)
+    buy_high   = Column(Integer)
+    buy_low    = Column(Integer)
+    buy_close  = Column(Integer)
+    sell_open  = Column(Integer)
+    sell_high  = Column(Integer)
+    sell_low   = Column(Integer)
+    sell_close = Column(Integer)
+
+    buy_qty       = Column(Integer)
+    sell_qty      = Column(Integer)
+    exec_buy_qty  = Column(BigInteger)
+    exec_sell_qty = Column(BigInteger)
+    ticks         = Column(Integer, nullable=False)
+
+# -----------------------------------------------------------------
+# Table aggregation_shards : avancement de l'agrégation parallèle
+# (aggregate_daily --mode sharded).  Une ligne par (jour, tranche
+# d'item_id [item_lo, item_hi[) ; done_at est posé dans la transaction
+# qui écrit les snapshots de la tranche.  Les lignes d'un jour sont
+# supprimées avec son brut, une fois toutes ses tranches faites.
+# -----------------------------------------------------------------
+class AggregationShard(Base):
+    __tablename__ = "aggregation_shards"
+    day     = Column(Date, primary_key=True)
+    item_lo = Column(Integer, primary_key=True)
+    item_hi = Column(Integer, nullable=False)
+    done_at = Column(DateTime)
+    rows    = Column(Integer)
+    seconds = Column(Numeric(10, 3))
+
+# -----------------------------------------------------------------
+# Table ingest_ledger : un fichier de capture par ligne (local_ingest,
+# ingest_daemon), écrite dans la transaction qui charge ses lignes.
+# Un fichier dont le nom ou le contenu (sha256) y figure déjà est sauté
+# sans être lu.  rows = lignes réellement insérées (0 pour un doublon
+# de contenu) ; captured_at = début de capture, comme raw_captures.
+# -----------------------------------------------------------------
+class IngestLedger(Base):
+    __tablename__ = "ingest_ledger"
+    name        = Column(String, primary_key=True)
+    sha256      = Column(String(64), nullable=False, index=True)
+    rows        = Column(Integer, nullable=False)
+    captured_at = Column(DateTime)
+    ingested_at = Column(DateTime, nullable=False, server_default=text("now()"))
+
+# -----------------------------------------------------------------
+# Vue intraday_summary : une ligne par item, son état le plus récent
+# (dernier jour présent dans intraday_rollup).  Rien à rafraîchir :
+# intraday_rollup est déjà mis à jour à chaque ingestion, la vue ne
+# fait que l'exposer.  exec_buy_qty = ↓ des quantités en vente (achats
+# exécutés), exec_sell_qty = ↓ des quantités en achat.
+# -----------------------------------------------------------------
+INTRADAY_SUMMARY_SQL = """
+CREATE OR REPLACE VIEW intraday_summary AS
+SELECT DISTINCT ON (item_id)
+       item_id, day, ticks, last_ts,
+       last_buy_price  AS buy_price,
+       last_sell_price AS sell_price,
+       last_buy_qty    AS buy_qty,
+       last_sell_qty   AS sell_qty,
+       open_buy_price, open_sell_price,
+       min_buy_price, max_buy_price, min_sell_price, max_sell_price,
+       sum_buy_qty, sum_sell_qty,
+       exec_buy_qty, exec_sell_qty
+FROM intraday_rollup
+ORDER BY item_id, day DESC
+"""
+
+# la vue n'est pas une table : métadonnées à part, ignorées par create_all
+views = MetaData()
+
+intraday_summary = Table(
+    "intraday_summary", views,
+    Column("item_id", Integer, primary_key=True),
+    Column("day", Date),
+    Column("ticks", Integer),
+    Column("last_ts", DateTime),
+    Column("buy_price", Integer),
+    Column("sell_price", Integer),
+    Column("buy_qty", Integer),
+    Column("sell_qty", Integer),
+    Column("open_buy_price", Integer),
+    Column("open_sell_price", Integer),
+    Column("min_buy_price", Integer),
+    Column("max_buy_price", Integer),
+    Column("min_sell_price", Integer),
+    Column("max_sell_price", Integer),
+    Column("sum_buy_qty", BigInteger),
+    Column("sum_sell_qty", BigInteger),
+    Column("exec_buy_qty", BigInteger),
+    Column("exec_sell_qty", BigInteger),
+)
+
+event.listen(Base.metadata, "after_create", DDL(INTRADAY_SUMMARY_SQL))
+
+# -----------------------------------------------------------------
+# Partitions journalières de daily_raw : daily_raw_YYYYMMDD couvre
+# [jour, jour + 1).  Les ingestions créent celles dont elles ont besoin
+# (et quelques jours d'avance), aggregate_daily détache puis supprime
+# celles des jours agrégés au lieu d'un DELETE ligne à ligne.
+# -----------------------------------------------------------------
+PARTITION_AHEAD = 2          # jours créés d'avance à chaque ingestion
+
+
+def daily_partition_name(day: datetime.date) -> str:
+    return f"daily_raw_{day:%Y%m%d}"
+
+
+def daily_raw_partitioned(conn) -> bool:
+    """False tant que la migration de partitionnement n'est pas appliquée."""
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table"
+        " WHERE partrelid = to_regclass('daily_raw'))"
+    )).scalar()
+
+
+def daily_partitions(conn) -> dict[datetime.date, str]:
+    """{jour: nom} des partitions journalières existantes."""
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i"
+        " JOIN pg_class c ON c.oid = i.inhrelid"
+        " WHERE i.inhparent = to_regclass('daily_raw')"
+    )).scalars()
+    out = {}
+    for name in names:
+        try:
+            out[datetime.datetime.strptime(name, "daily_raw_%Y%m%d").date()] = name
+        except ValueError:               # partition créée à la main : ignorée
+            pass
+    return out
+
+
+def ensure_daily_partitions(conn, days) -> list[datetime.date]:
+    """Crée les partitions manquantes pour `days` ; retourne les jours créés."""
+    missing = sorted(set(days) - set(daily_partitions(conn)))
+    if not missing:
+        return []
+    # sérialise les ingestions concurrentes ; IF NOT EXISTS couvre celle
+    # qui a créé la partition pendant qu'on attendait le verrou
+    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('daily_raw_partitions'))"))
+    for day in missing:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {daily_partition_name(day)}"
+            f" PARTITION OF daily_raw"
+            f" FOR VALUES FROM ('{day}') TO ('{day + datetime.timedelta(days=1)}')"
+        ))
+    return missing
+
+
+def ensure_upcoming_partitions(conn, ahead: int = PARTITION_AHEAD) -> list[datetime.date]:
+    """Partitions d'aujourd'hui et des `ahead` jours suivants (UTC, comme ts)."""
+    if not daily_raw_partitioned(conn):
+        return []
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    return ensure_daily_partitions(
+        conn, (today + datetime.timedelta(days=i) for i in range(ahead + 1))
+    )
+
+
+def drop_daily_partitions(conn, start: datetime.date | None,
+                          end: datetime.date) -> list[datetime.date]:
+    """Détache puis supprime les partitions des jours de [start, end)."""
+    dropped = []
+    for day, name in sorted(daily_partitions(conn).items()):
+        if day < end and (start is None or day >= start):
+            conn.execute(text(f"ALTER TABLE daily_raw DETACH PARTITION {name}"))
+            conn.execute(text(f"DROP TABLE {name}"))
+            dropped.append(day)
+    return dropped
+
+# -----------------------------------------------------------------
+# Notifications : NOTIFY gw2_data à chaque ingestion ('raw') ou
+# agrégation ('snapshots').  Livrées au commit seulement ; écoutées par
+# query_api.py pour invalider son cache.
+# -----------------------------------------------------------------
+NOTIFY_CHANNEL = "gw2_data"
+
+
+def notify(conn, payload: str) -> None:
+    conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                 {"channel": NOTIFY_CHANNEL, "payload": payload})
+
+# -----------------------------------------------------------------
+# Connexion : engine créé au premier usage (pas à l'import), pool
+# réglable par DB_POOL_SIZE / DB_MAX_OVERFLOW.  Le schéma n'est plus
+# créé à chaque lancement : `python models.py create` (ou alembic).
+# -----------------------------------------------------------------
+DB_POOL_SIZE    = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+_engine = None
+_Session = sessionmaker()
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        url = os.getenv("DATABASE_URL")
+        if not url:
+            raise RuntimeError("DATABASE_URL n'est pas défini (ni dans .env, ni en variable d'environnement).")
+        _engine = create_engine(url, pool_size=DB_POOL_SIZE,
+                                max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True)
+        _Session.configure(bind=_engine)
+    return _engine
+
+
+def Session(**kw):
+    """Nouvelle session ORM (même usage que l'ancien sessionmaker)."""
+    get_engine()
+    return _Session(**kw)
+
+
+def __getattr__(name):
+    # compatibilité : `from models import engine` reste possible
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def create_schema() -> None:
+    """Tables manquantes + vue intraday_summary + partitions à venir."""
+    eng = get_engine()
+    Base.metadata.create_all(eng)
+    with eng.begin() as conn:
+        ensure_upcoming_partitions(conn)
 
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
 
-Base.metadata.create_all(engine)
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] != ["create"]:
+        sys.exit("usage : python models.py create")
+    create_schema()
+    print("✅ Schéma à jour.")
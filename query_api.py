@@ -0,0 +1,271 @@
+# query_api.py
+# ----------------------------------------------------------------
+# Petit service HTTP/JSON en lecture seule (stdlib) au-dessus de la
+# base, pour les outils qui interrogent les mêmes requêtes en boucle :
+#
+#   GET /items/<id>/history?from=2025-07-01&to=2025-07-31&limit=365
+#                               snapshots quotidiens d'un item
+#   GET /intraday?ids=19721,24  état intraday courant (intraday_summary)
+#   GET /flips?top=20&min_net_gain=50
+#                               candidats flip_scoring, seuils optionnels
+#   GET /health
+#
+# Un seul processus : pool de connexions SQLAlchemy chaud, réponses
+# JSON gardées dans un cache LRU à durée de vie (--ttl).  Le cache est
+# vidé dès qu'une ingestion ou une agrégation est commitée (LISTEN sur
+# le canal de models.notify) ; le TTL ne sert que de filet de sécurité.
+# ----------------------------------------------------------------
+
+import argparse
+import datetime
+import decimal
+import json
+import math
+import select as select_mod
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import select
+
+from models import Session, Snapshot, get_engine, intraday_summary, NOTIFY_CHANNEL
+import flip_scoring
+
+HOST     = "127.0.0.1"
+PORT     = 8750
+TTL      = 300.0            # secondes
+MAX_SIZE = 512              # réponses gardées en cache
+HISTORY_LIMIT = 365
+HISTORY_MAX   = 3650        # plafond de ?limit=
+TOP_MAX       = 1000        # plafond de ?top=
+
+
+# ----------------------------------------------------------------
+# Cache LRU + TTL, partagé entre les threads du serveur
+# ----------------------------------------------------------------
+class ResponseCache:
+    def __init__(self, maxsize: int = MAX_SIZE, ttl: float = TTL):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.data: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.lock    = threading.Lock()
+        self.generation = 0         # incrémenté à chaque invalidation
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            hit = self.data.get(key)
+            if hit is None:
+                return None
+            stamp, body = hit
+            if time.monotonic() - stamp > self.ttl:
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return body
+
+    def put(self, key: str, body: bytes, generation: int) -> None:
+        """N'enregistre pas un résultat calculé avant une invalidation."""
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.data[key] = (time.monotonic(), body)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, prefixes: tuple[str, ...] = ("",)) -> None:
+        with self.lock:
+            self.generation += 1
+            for key in [k for k in self.data if k.startswith(prefixes)]:
+                del self.data[key]
+
+
+CACHE = ResponseCache()
+
+# 'raw' ne touche que l'intraday (et les flips qui en dépendent) ;
+# 'snapshots' (agrégation) change tout
+_INVALIDATES = {"raw": ("/intraday", "/flips")}
+
+
+def listen_for_changes(cache: ResponseCache, stop: threading.Event) -> None:
+    """Thread : LISTEN sur le canal de notification, reconnexion si besoin."""
+    while not stop.is_set():
+        try:
+            raw = get_engine().raw_connection()
+            conn = raw.dbapi_connection
+            raw.detach()                              # hors du pool : connexion dédiée
+            try:
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+                cache.invalidate()                    # notifications manquées entre-temps
+                while not stop.is_set():
+                    if select_mod.select([conn], [], [], 5)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            payload = conn.notifies.pop(0).payload
+                            cache.invalidate(_INVALIDATES.get(payload, ("",)))
+            finally:
+                conn.close()                          # détachée : le pool ne la fermera pas
+        except Exception as exc:
+            print(f"⚠️  écoute {NOTIFY_CHANNEL} interrompue : {exc} — reconnexion dans 5s")
+            stop.wait(5)
+
+
+# ----------------------------------------------------------------
+# Requêtes
+# ----------------------------------------------------------------
+def _date(value: str | None) -> datetime.date | None:
+    return datetime.date.fromisoformat(value) if value else None
+
+
+def _count(value: str | None, default: int, maximum: int) -> int:
+    """Entier ≥ 1 d'un paramètre (`default` si absent), plafonné à `maximum`."""
+    n = default if value is None or value == "" else int(value)
+    if n < 1:
+        raise ValueError(f"entier ≥ 1 attendu : {value}")
+    return min(n, maximum)
+
+
+def item_history(item_id: int, start=None, end=None, limit: int = HISTORY_LIMIT) -> list[dict]:
+    cols = [c for c in Snapshot.__table__.c if c.name != "id"]
+    q = select(*cols).where(Snapshot.item_id == item_id)
+    if start:
+        q = q.where(Snapshot.ts >= start)
+    if end:
+        q = q.where(Snapshot.ts <= end)
+    # les `limit` jours les plus récents, rendus dans l'ordre chronologique
+    sub = q.order_by(Snapshot.ts.desc()).limit(limit).subquery()
+    with Session() as s:
+        return [dict(r) for r in s.execute(select(sub).order_by(sub.c.ts)).mappings()]
+
+
+def intraday(ids: list[int] | None = None) -> list[dict]:
+    q = select(intraday_summary).order_by(intraday_summary.c.item_id)
+    if ids:
+        q = q.where(intraday_summary.c.item_id.in_(ids))
+    with Session() as s:
+        return [dict(r) for r in s.execute(q).mappings()]
+
+
+def flips(top: int = 20, rank_by: str = "score", **thresholds) -> list[dict]:
+    df = flip_scoring.score_flips(flip_scoring.load_candidates(),
+                                  top=top, rank_by=rank_by, **thresholds)
+    return df.to_dict("records")
+
+
+def _json_default(o):
+    if isinstance(o, (datetime.date, datetime.datetime)):
+        return o.isoformat()
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if hasattr(o, "item"):                      # scalaires NumPy
+        return o.item()
+    raise TypeError(f"{type(o).__name__} non sérialisable")
+
+
+def _clean(rows: list[dict]) -> list[dict]:
+    # NaN (divisions par zéro côté pandas) → null, JSON strict
+    return [
+        {k: None if isinstance(v, float) and math.isnan(v) else v for k, v in r.items()}
+        for r in rows
+    ]
+
+
+def route(path: str, query: dict[str, list[str]]):
+    """Retourne l'objet à sérialiser ; ValueError → 400, LookupError → 404."""
+    arg = lambda name: query.get(name, [None])[0]
+    parts = [p for p in path.split("/") if p]
+
+    if parts == ["health"]:
+        return {"status": "ok"}
+    if len(parts) == 3 and parts[0] == "items" and parts[2] == "history":
+        return item_history(int(parts[1]), _date(arg("from")), _date(arg("to")),
+                            _count(arg("limit"), HISTORY_LIMIT, HISTORY_MAX))
+    if parts == ["intraday"]:
+        ids = [int(i) for i in arg("ids").split(",")] if arg("ids") else None
+        return intraday(ids)
+    if parts == ["flips"]:
+        thresholds = {k: float(arg(k)) for k in flip_scoring.DEFAULTS if arg(k) is not None}
+        rank_by = arg("rank_by") or "score"
+        if rank_by not in ("score", "net_gain", "spread_pct", "exec_buy_qty"):
+            raise ValueError(f"rank_by inconnu : {rank_by}")
+        return _clean(flips(_count(arg("top"), 20, TOP_MAX), rank_by, **thresholds))
+    raise LookupError(path)
+
+
+# ----------------------------------------------------------------
+# Serveur HTTP
+# ----------------------------------------------------------------
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"              # keep-alive pour les clients en boucle
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, cache_state: str = "") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if cache_state:
+            self.send_header("X-Cache", cache_state)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status: int, message: str) -> None:
+        self._send(status, json.dumps({"error": message}).encode())
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        key = url.path + "?" + "&".join(f"{k}={v}" for k, v in sorted(query.items()))
+
+        if url.path != "/health" and (body := CACHE.get(key)) is not None:
+            return self._send(200, body, "hit")
+        generation = CACHE.generation
+        try:
+            result = route(url.path, query)
+        except LookupError:
+            return self._error(404, f"route inconnue : {url.path}")
+        except ValueError as exc:
+            return self._error(400, str(exc))
+        except Exception as exc:
+            print(f"❌ {self.path} : {exc}")
+            return self._error(500, "erreur interne")
+
+        body = json.dumps(result, default=_json_default, separators=(",", ":")).encode()
+        if url.path != "/health":
+            CACHE.put(key, body, generation)
+        self._send(200, body, "miss")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default=HOST)
+    ap.add_argument("--port", type=int, default=PORT)
+    ap.add_argument("--ttl", type=float, default=TTL, help="durée de vie max d'une réponse (s)")
+    args = ap.parse_args()
+    CACHE.ttl = args.ttl
+
+    stop = threading.Event()
+    threading.Thread(target=listen_for_changes, args=(CACHE, stop), daemon=True).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"🌐 API sur http://{args.host}:{args.port} (cache {CACHE.maxsize} réponses, TTL {args.ttl:g}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        print("👋 API arrêtée.")
+
+
+if __name__ == "__main__":
+    main()
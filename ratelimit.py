@@ -0,0 +1,52 @@
+# ratelimit.py
+# ------------------------------------------------------------------
+# Seau à jetons (token bucket) : `rate` requêtes par seconde en régime
+# permanent, avec des rafales jusqu'à `burst`.  Remplace les
+# time.sleep() fixes entre deux appels API.  AsyncTokenBucket est la
+# variante asyncio (coroutines d'une même boucle).
+# ------------------------------------------------------------------
+
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """Limiteur partagé entre threads ; acquire() bloque jusqu'au prochain jeton."""
+
+    def __init__(self, rate: float, burst: int | None = None):
+        self.rate   = float(rate)
+        self.burst  = float(burst or max(1, int(rate)))
+        self.tokens = self.burst
+        self.stamp  = time.monotonic()
+        self.lock   = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp  = now
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AsyncTokenBucket(TokenBucket):
+    """Même seau pour asyncio ; les coroutines en attente passent dans l'ordre."""
+
+    def __init__(self, rate: float, burst: int | None = None):
+        super().__init__(rate, burst)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            self._refill(time.monotonic())
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill(time.monotonic())
+            self.tokens -= 1
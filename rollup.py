@@ -0,0 +1,274 @@
+# rollup.py
+# ------------------------------------------------------------------
+# Accumulateurs intraday par (item_id, jour) dans intraday_rollup.
+#
+# À l'ingestion : les ticks nouvellement insérés dans daily_raw sont
+# réduits en un état partiel (open, last, min/max, sommes, sommes des
+# carrés, deltas LAG des quantités, histogramme) puis fusionnés dans
+# l'état existant par INSERT … ON CONFLICT DO UPDATE.  Le delta
+# d'exécution à la jonction (dernier tick connu → premier tick du lot)
+# est calculé contre l'état courant, donc ingérer fichier par fichier
+# ou par lots donne le même résultat tant que les ticks arrivent dans
+# l'ordre chronologique.  Un lot antérieur au dernier tick accumulé
+# (capture rejouée en retard) s'insère au milieu de la série : les
+# deltas à ses bords ne se déduisent pas de l'état, la ligne est
+# marquée out_of_order et le mode rollup finalise tout ce jour depuis
+# les ticks bruts (rollup_stats l'écarte).
+#
+# À l'agrégation : rollup_stats() produit les mêmes colonnes que
+# aggregate_daily.daily_stats() en O(items), sans relire daily_raw.
+# La médiane est estimée sur un histogramme à buckets logarithmiques
+# (largeur relative HIST_BASE − 1, soit ±0,5 %) ; la médiane exacte
+# reste disponible en relisant les ticks bruts.
+# ------------------------------------------------------------------
+
+import math
+
+from sqlalchemy import select, func, case, cast, and_, BigInteger, Date, Float, Integer, Numeric
+
+from models import IntradayRollup
+import tick_store
+
+HIST_BASE = 1.01
+
+
+def _bucket(col: str) -> str:
+    return f"CASE WHEN {col} > 0 THEN floor(ln({col}) / ln({HIST_BASE}))::int ELSE -1 END"
+
+
+def _hist_merge(a: str, b: str) -> str:
+    return (
+        "(SELECT jsonb_object_agg(k, n) FROM ("
+        " SELECT key AS k, sum(value::bigint) AS n FROM ("
+        f"  SELECT * FROM jsonb_each_text({a})"
+        f"  UNION ALL SELECT * FROM jsonb_each_text({b})"
+        " ) e GROUP BY key) m)"
+    )
+
+
+def rollup_ctes(source: str) -> str:
+    """
+    CTE SQL (à placer après `WITH {source} AS (…),`) qui fusionne dans
+    intraday_rollup les ticks de la relation `source` (colonnes de
+    daily_raw).  La dernière CTE, rollup_upsert, porte l'écriture.
+    """
+    return f"""
+    ordered AS (
+        SELECT item_id, ts::date AS day, ts,
+               buy_price, sell_price, buy_quantity, sell_quantity,
+               lag(buy_quantity)  OVER w AS prev_buy_qty,
+               lag(sell_quantity) OVER w AS prev_sell_qty,
+               row_number() OVER w AS rn,
+               row_number() OVER (PARTITION BY item_id, ts::date ORDER BY ts DESC) AS rn_desc
+        FROM {source}
+        WINDOW w AS (PARTITION BY item_id, ts::date ORDER BY ts)
+    ),
+    part AS (
+        SELECT item_id, day,
+               count(*)  AS ticks,
+               min(ts)   AS first_ts,
+               max(ts)   AS last_ts,
+               max(buy_price)     FILTER (WHERE rn = 1)      AS open_buy_price,
+               max(sell_price)    FILTER (WHERE rn = 1)      AS open_sell_price,
+               max(buy_quantity)  FILTER (WHERE rn = 1)      AS first_buy_qty,
+               max(sell_quantity) FILTER (WHERE rn = 1)      AS first_sell_qty,
+               max(buy_price)     FILTER (WHERE rn_desc = 1) AS last_buy_price,
+               max(sell_price)    FILTER (WHERE rn_desc = 1) AS last_sell_price,
+               max(buy_quantity)  FILTER (WHERE rn_desc = 1) AS last_buy_qty,
+               max(sell_quantity) FILTER (WHERE rn_desc = 1) AS last_sell_qty,
+               min(buy_price)  AS min_buy_price,  max(buy_price)  AS max_buy_price,
+               min(sell_price) AS min_sell_price, max(sell_price) AS max_sell_price,
+               sum(buy_price::bigint)  AS sum_buy_price,
+               sum(sell_price::bigint) AS sum_sell_price,
+               sum(buy_price::numeric  * buy_price)  AS sumsq_buy_price,
+               sum(sell_price::numeric * sell_price) AS sumsq_sell_price,
+               sum((sell_price - buy_price)::bigint) AS sum_spread,
+               min(sell_price - buy_price) AS min_spread,
+               max(sell_price - buy_price) AS max_spread,
+               sum(buy_quantity::bigint)  AS sum_buy_qty,
+               sum(sell_quantity::bigint) AS sum_sell_qty,
+               sum(GREATEST(prev_sell_qty - sell_quantity, 0)::bigint) AS exec_buy_qty,
+               sum(GREATEST(prev_buy_qty  - buy_quantity,  0)::bigint) AS exec_sell_qty
+        FROM ordered
+        GROUP BY item_id, day
+    ),
+    hist AS (
+        SELECT item_id, day,
+               jsonb_object_agg(b, n) FILTER (WHERE side = 'b') AS hist_buy,
+               jsonb_object_agg(b, n) FILTER (WHERE side = 's') AS hist_sell
+        FROM (
+            SELECT item_id, day, 'b' AS side, {_bucket("buy_price")} AS b, count(*) AS n
+            FROM ordered GROUP BY 1, 2, 3, 4
+            UNION ALL
+            SELECT item_id, day, 's', {_bucket("sell_price")}, count(*)
+            FROM ordered GROUP BY 1, 2, 3, 4
+        ) h
+        GROUP BY item_id, day
+    ),
+    rollup_upsert AS (
+        INSERT INTO intraday_rollup AS r (
+            item_id, day, ticks, first_ts, last_ts,
+            open_buy_price, open_sell_price, last_buy_price, last_sell_price,
+            last_buy_qty, last_sell_qty,
+            min_buy_price, max_buy_price, min_sell_price, max_sell_price,
+            sum_buy_price, sum_sell_price, sumsq_buy_price, sumsq_sell_price,
+            sum_spread, min_spread, max_spread,
+            sum_buy_qty, sum_sell_qty, exec_buy_qty, exec_sell_qty,
+            hist_buy, hist_sell
+        )
+        SELECT p.item_id, p.day, p.ticks, p.first_ts, p.last_ts,
+               p.open_buy_price, p.open_sell_price, p.last_buy_price, p.last_sell_price,
+               p.last_buy_qty, p.last_sell_qty,
+               p.min_buy_price, p.max_buy_price, p.min_sell_price, p.max_sell_price,
+               p.sum_buy_price, p.sum_sell_price, p.sumsq_buy_price, p.sumsq_sell_price,
+               p.sum_spread, p.min_spread, p.max_spread,
+               p.sum_buy_qty, p.sum_sell_qty,
+               -- delta à la jonction avec l'état déjà accumulé
+               p.exec_buy_qty + CASE WHEN c.last_ts < p.first_ts
+                   THEN GREATEST(c.last_sell_qty - p.first_sell_qty, 0) ELSE 0 END,
+               p.exec_sell_qty + CASE WHEN c.last_ts < p.first_ts
+                   THEN GREATEST(c.last_buy_qty - p.first_buy_qty, 0) ELSE 0 END,
+               h.hist_buy, h.hist_sell
+        FROM part p
+        JOIN hist h USING (item_id, day)
+        LEFT JOIN intraday_rollup c ON c.item_id = p.item_id AND c.day = p.day
+        ON CONFLICT (item_id, day) DO UPDATE SET
+            ticks    = r.ticks + EXCLUDED.ticks,
+            first_ts = LEAST(r.first_ts, EXCLUDED.first_ts),
+            last_ts  = GREATEST(r.last_ts, EXCLUDED.last_ts),
+            open_buy_price  = CASE WHEN EXCLUDED.first_ts < r.first_ts
+                                   THEN EXCLUDED.open_buy_price  ELSE r.open_buy_price  END,
+            open_sell_price = CASE WHEN EXCLUDED.first_ts < r.first_ts
+                                   THEN EXCLUDED.open_sell_price ELSE r.open_sell_price END,
+            last_buy_price  = CASE WHEN EXCLUDED.last_ts >= r.last_ts
+                                   THEN EXCLUDED.last_buy_price  ELSE r.last_buy_price  END,
+            last_sell_price = CASE WHEN EXCLUDED.last_ts >= r.last_ts
+                                   THEN EXCLUDED.last_sell_price ELSE r.last_sell_price END,
+            last_buy_qty    = CASE WHEN EXCLUDED.last_ts >= r.last_ts
+                                   THEN EXCLUDED.last_buy_qty    ELSE r.last_buy_qty    END,
+            last_sell_qty   = CASE WHEN EXCLUDED.last_ts >= r.last_ts
+                                   THEN EXCLUDED.last_sell_qty   ELSE r.last_sell_qty   END,
+            min_buy_price  = LEAST(r.min_buy_price,     EXCLUDED.min_buy_price),
+            max_buy_price  = GREATEST(r.max_buy_price,  EXCLUDED.max_buy_price),
+            min_sell_price = LEAST(r.min_sell_price,    EXCLUDED.min_sell_price),
+            max_sell_price = GREATEST(r.max_sell_price, EXCLUDED.max_sell_price),
+            sum_buy_price    = r.sum_buy_price    + EXCLUDED.sum_buy_price,
+            sum_sell_price   = r.sum_sell_price   + EXCLUDED.sum_sell_price,
+            sumsq_buy_price  = r.sumsq_buy_price  + EXCLUDED.sumsq_buy_price,
+            sumsq_sell_price = r.sumsq_sell_price + EXCLUDED.sumsq_sell_price,
+            sum_spread = r.sum_spread + EXCLUDED.sum_spread,
+            min_spread = LEAST(r.min_spread,    EXCLUDED.min_spread),
+            max_spread = GREATEST(r.max_spread, EXCLUDED.max_spread),
+            sum_buy_qty   = r.sum_buy_qty   + EXCLUDED.sum_buy_qty,
+            sum_sell_qty  = r.sum_sell_qty  + EXCLUDED.sum_sell_qty,
+            exec_buy_qty  = r.exec_buy_qty  + EXCLUDED.exec_buy_qty,
+            exec_sell_qty = r.exec_sell_qty + EXCLUDED.exec_sell_qty,
+            hist_buy  = {_hist_merge("r.hist_buy",  "EXCLUDED.hist_buy")},
+            hist_sell = {_hist_merge("r.hist_sell", "EXCLUDED.hist_sell")},
+            out_of_order = r.out_of_order OR EXCLUDED.first_ts < r.last_ts
+    )"""
+
+
+# ------------------------------------------------------------------
+# Finalisation : mêmes colonnes que aggregate_daily.daily_stats()
+# ------------------------------------------------------------------
+def _hist_median(hist, ticks):
+    e = func.jsonb_each_text(hist).table_valued("key", "value").render_derived()
+    b = cast(e.c.key, Integer)
+    cum = (
+        select(b.label("b"),
+               func.sum(cast(e.c.value, BigInteger)).over(order_by=b).label("cum"))
+        .select_from(e)
+        .subquery()
+    )
+    # centre géométrique arrondi : exact tant qu'un bucket fait < 1 c
+    centre = func.round(func.exp((cum.c.b + 0.5) * math.log(HIST_BASE)))
+    return (
+        select(case((cum.c.b < 0, 0.0), else_=centre))
+        .where(cum.c.cum * 2 >= ticks)
+        .order_by(cum.c.b)
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+def _exact_medians(start, end):
+    t = tick_store.ticks(start, end).subquery("ticks")
+    day = func.date_trunc("day", t.c.ts)
+    return (
+        select(
+            t.c.item_id, cast(day, Date).label("day"),
+            func.percentile_cont(0.5).within_group(t.c.buy_price).label("median_buy"),
+            func.percentile_cont(0.5).within_group(t.c.sell_price).label("median_sell"),
+        )
+        .group_by(t.c.item_id, day)
+        .subquery("exact")
+    )
+
+
+def out_of_order_days(start, end):
+    """Jours de [start, end[ dont un accumulateur a reçu des ticks hors
+    ordre : à finaliser depuis les ticks bruts."""
+    r = IntradayRollup
+    q = select(r.day).where(r.day < end.date(), r.out_of_order).distinct()
+    if start is not None:
+        q = q.where(r.day >= start.date())
+    return q
+
+
+def rollup_stats(start, end, exact_median: bool = False):
+    """Stats par (item_id, jour) pour les jours [start, end[ (datetimes à
+    minuit, `start` à None pour « depuis le début »), hors jours
+    out_of_order_days (finalisés depuis le brut)."""
+    r = IntradayRollup
+    n = cast(r.ticks, Numeric)
+    avg_buy  = r.sum_buy_price  / n
+    avg_sell = r.sum_sell_price / n
+
+    def std(sumsq, avg):
+        return func.sqrt(func.greatest(sumsq / n - avg * avg, 0))
+
+    q = select(
+        r.item_id,
+        r.day.label("day"),
+
+        r.open_buy_price.label("open_buy"),
+        r.open_sell_price.label("open_sell"),
+        r.last_buy_price.label("close_buy"),
+        r.last_sell_price.label("close_sell"),
+
+        r.min_buy_price.label("min_buy"),
+        r.max_buy_price.label("max_buy"),
+        r.min_sell_price.label("min_sell"),
+        r.max_sell_price.label("max_sell"),
+
+        avg_buy.label("avg_buy"),
+        avg_sell.label("avg_sell"),
+
+        std(r.sumsq_buy_price,  avg_buy).label("std_buy"),
+        std(r.sumsq_sell_price, avg_sell).label("std_sell"),
+
+        (r.sum_spread / n).label("avg_spread"),
+        r.min_spread.label("min_spread"),
+        r.max_spread.label("max_spread"),
+
+        (r.max_buy_price  - r.min_buy_price).label("delta_buy"),
+        (r.max_sell_price - r.min_sell_price).label("delta_sell"),
+
+        r.sum_buy_qty.label("tot_buy_listed"),
+        r.sum_sell_qty.label("tot_sell_listed"),
+        r.exec_buy_qty.label("exec_buy_qty"),
+        r.exec_sell_qty.label("exec_sell_qty"),
+    ).where(r.day < end.date(), r.day.not_in(out_of_order_days(start, end)))
+    if start is not None:
+        q = q.where(r.day >= start.date())
+
+    if exact_median:
+        m = _exact_medians(start, end)
+        return q.add_columns(m.c.median_buy, m.c.median_sell).join(
+            m, and_(m.c.item_id == r.item_id, m.c.day == r.day), isouter=True
+        )
+    return q.add_columns(
+        cast(_hist_median(r.hist_buy,  r.ticks), Float).label("median_buy"),
+        cast(_hist_median(r.hist_sell, r.ticks), Float).label("median_sell"),
+    )
@@ -3,31 +3,45 @@
 Télécharge l’historique « daily » (API datawars2.ie) pour la fenêtre fixe
    2025-01-05  ➜  2025-07-03  (180 jours, exclut 2025-07-04).
 
-▸ 1 fichier JSON par item dans scraped_trends/<ID>.json
-▸ checkpoint.txt évite de re-scraper un ID déjà traité
-▸ 40 workers parallèles en continu (filaire) – affichage en flux
+▸ sortie JSON lines compacte (une ligne par item et par jour) ajoutée à
+  scraped_trends/trends.jsonl par une tâche d'écriture dédiée
+▸ checkpoint SQLite (scraped_trends/checkpoint.sqlite) : un item n'est
+  marqué fait qu'une fois ses lignes écrites, la reprise est possible à
+  tout moment (l'ancien checkpoint.txt est importé au premier lancement)
+▸ 40 workers parallèles, seau à jetons sur l'hôte, retries + backoff
+▸ --to-db : les lignes sont versées directement dans daily_raw (COPY,
+  ON CONFLICT DO NOTHING) par lots, sans fichier intermédiaire ni
+  passage par import_scraped_trends.py ; mémoire constante (file bornée)
+▸ Ctrl-C / SIGTERM : plus de nouvelle requête, les résultats déjà reçus
+  sont écrits et le checkpoint fermé proprement (2ᵉ Ctrl-C : arrêt brutal)
 """
 
 from dotenv import load_dotenv
 load_dotenv()
 import os
-if not os.getenv("DATABASE_URL"):
-    raise RuntimeError("DATABASE_URL n'est pas défini (ni dans .env, ni en variable d'environnement).")
 
-import aiohttp, asyncio, json
+import argparse, aiohttp, asyncio, json, random, signal, sqlite3, time
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 
+from ratelimit import AsyncTokenBucket
+
 # ── PARAMÈTRES ────────────────────────────────────────────────────────────────
 CONCURRENCY = 40                       # workers simultanés
-API_BASE    = "https://api.datawars2.ie/gw2/v2/history/json?itemID="
+RATE        = 20.0                     # requêtes / seconde vers l'hôte
+RETRIES     = 4
+BACKOFF     = 1.0                      # secondes, doublé à chaque tentative
+WRITE_BATCH = 200                      # items par écriture + commit checkpoint
+API_BASE    = os.getenv("DATAWARS_API_BASE", "https://api.datawars2.ie/gw2/v2/history/json?itemID=")
 TIMEOUT     = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
 
 MAX_DATE = datetime(2025, 7, 3, tzinfo=timezone.utc).date()
 MIN_DATE = MAX_DATE - timedelta(days=179)            # 180 jours inclus
 
 OUT_DIR  = Path("scraped_trends"); OUT_DIR.mkdir(exist_ok=True)
-CHK_FILE = OUT_DIR / "checkpoint.txt"; CHK_FILE.touch(exist_ok=True)
+OUT_FILE = OUT_DIR / "trends.jsonl"
+CHK_DB   = OUT_DIR / "checkpoint.sqlite"
+CHK_FILE = OUT_DIR / "checkpoint.txt"                # ancien format
 IDS_FILE = "item_ids.txt"
 
 # ── HELPERS ───────────────────────────────────────────────────────────────────
@@ -52,45 +66,181 @@ def map_row(item: int, e: dict):
         "sell_qty" : e.get("sell_quantity_max") or 0,
     }
 
-# ── WORKER ────────────────────────────────────────────────────────────────────
-async def worker(queue: asyncio.Queue, session: aiohttp.ClientSession):
-    while True:
-        item_id = await queue.get()
+# ── CHECKPOINT ────────────────────────────────────────────────────────────────
+def open_checkpoint(path: Path = CHK_DB) -> sqlite3.Connection:
+    # utilisé depuis la boucle puis depuis le thread d'écriture, jamais en même temps
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS done ("
+               " item_id INTEGER PRIMARY KEY, rows INTEGER NOT NULL, ts TEXT NOT NULL)")
+    if CHK_FILE.exists():                             # migration one-shot
+        ids = [(int(i),) for i in CHK_FILE.read_text().split() if i.isdigit()]
+        db.executemany("INSERT OR IGNORE INTO done VALUES (?, -1, 'checkpoint.txt')", ids)
+        db.commit()
+        CHK_FILE.rename(CHK_FILE.with_suffix(".txt.migrated"))
+        print(f"↪️  {len(ids)} ids importés de {CHK_FILE.name}")
+    return db
+
+def done_ids(db: sqlite3.Connection) -> set[str]:
+    return {str(i) for (i,) in db.execute("SELECT item_id FROM done")}
+
+def mark_done(db: sqlite3.Connection, batch) -> None:
+    now = datetime.now(timezone.utc).isoformat()
+    db.executemany("INSERT OR REPLACE INTO done VALUES (?, ?, ?)",
+                   [(int(item_id), len(rows), now) for item_id, rows in batch])
+    db.commit()
+
+class FileSink:
+    """Ajoute les lignes au JSON lines, puis marque les items faits."""
+
+    def __init__(self, path: Path, db: sqlite3.Connection):
+        self.f  = open(path, "a", encoding="utf-8")
+        self.db = db
+
+    def write(self, batch) -> None:
+        self.f.write("".join(
+            json.dumps(r, separators=(",", ":")) + "\n"
+            for _, rows in batch for r in rows
+        ))
+        self.f.flush()
+        os.fsync(self.f.fileno())       # lignes sur disque avant le checkpoint
+        mark_done(self.db, batch)
+
+    def close(self) -> None:
+        self.f.close()
+
+class DbSink:
+    """Mode --to-db : un lot = une transaction daily_raw, puis items marqués faits."""
+
+    def __init__(self, db: sqlite3.Connection):
+        from models import get_engine                 # import tardif : base requise
+        from import_scraped_trends import to_daily_raw, load_batch
+        from item_names import name_items
+        self.engine, self.to_daily_raw, self.load_batch = get_engine(), to_daily_raw, load_batch
+        self.name_items = name_items
+        self.db = db
+
+    def write(self, batch) -> None:
+        rows = [self.to_daily_raw(r) for _, rs in batch for r in rs]
+        unnamed = set()
+        with self.engine.begin() as conn:
+            self.load_batch(conn, rows, unnamed)
+        mark_done(self.db, batch)       # après commit : un crash ne fait que rejouer
+        self.name_items(unnamed)
+
+    def close(self) -> None:
+        self.engine.dispose()
+
+# ── RÉSEAU ────────────────────────────────────────────────────────────────────
+async def fetch_history(session: aiohttp.ClientSession, bucket: AsyncTokenBucket,
+                        item_id: str, stop: asyncio.Event):
+    """JSON brut de l'item, ou None (échec définitif ou arrêt demandé)."""
+    for attempt in range(RETRIES + 1):
+        if stop.is_set():
+            return None
+        await bucket.acquire()
         try:
-            resp = await session.get(API_BASE + item_id)
-            if resp.status != 200:
-                print(f"HTTP {resp.status} → {item_id}")
-                queue.task_done(); continue
-            raw = await resp.json()
-        except Exception as exc:
-            print(f"⚠️  {item_id}: {exc}")
-            queue.task_done(); continue
+            async with session.get(API_BASE + item_id) as resp:
+                if resp.status == 200:
+                    return await resp.json(content_type=None)
+                if resp.status != 429 and resp.status < 500:
+                    print(f"HTTP {resp.status} → {item_id}")
+                    return None
+                err = f"HTTP {resp.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as exc:
+            err = exc
+        if attempt == RETRIES:
+            print(f"⚠️  {item_id}: {err} après {RETRIES + 1} essais")
+            return None
+        await asyncio.sleep(BACKOFF * 2 ** attempt * (1 + random.random()))
 
+# ── WORKER / WRITER ───────────────────────────────────────────────────────────
+async def worker(ids, results: asyncio.Queue, session, bucket, stop: asyncio.Event):
+    for item_id in ids:                 # itérateur partagé entre les workers
+        if stop.is_set():
+            return
+        raw = await fetch_history(session, bucket, item_id, stop)
+        if raw is None:
+            continue
         rows = [
             r for e in raw if in_window(e["date"])
             if (r := map_row(int(item_id), e))
         ]
-        (OUT_DIR/f"{item_id}.json").write_text(json.dumps(rows, indent=2))
-        CHK_FILE.write_text(CHK_FILE.read_text() + item_id + "\n")
+        await results.put((item_id, rows))  # file bornée : contre-pression
         print(f"✅ {item_id} : {len(rows)} jours")
-        queue.task_done()
+
+async def writer(results: asyncio.Queue, sink) -> int:
+    """Vide la file par lots jusqu'à la sentinelle None ; retourne le nb d'items écrits."""
+    written, finished = 0, False
+    while not finished:
+        batch = []
+        item = await results.get()
+        while True:
+            if item is None:
+                finished = True
+                break
+            batch.append(item)
+            if len(batch) >= WRITE_BATCH or results.empty():
+                break
+            item = results.get_nowait()
+        if batch:
+            await asyncio.to_thread(sink.write, batch)
+            written += len(batch)
+    return written
 
 # ── MAIN ───────────────────────────────────────────────────────────────────────
-async def main():
+async def main(concurrency: int = CONCURRENCY, rate: float = RATE, to_db: bool = False):
+    db      = open_checkpoint()
     ids_all = [l.strip() for l in open(IDS_FILE) if l.strip().isdigit()]
-    done    = set(CHK_FILE.read_text().split())
+    done    = done_ids(db)
     todo    = [i for i in ids_all if i not in done]
     print(f"{len(done)} déjà faits — {len(todo)} à faire")
 
-    queue = asyncio.Queue()
-    for id_ in todo:
-        queue.put_nowait(id_)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def on_signal(sig):
+        print("⏹️  arrêt demandé — écriture des résultats en cours…")
+        stop.set()
+        loop.remove_signal_handler(sig)   # un 2ᵉ signal interrompt vraiment
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, on_signal, sig)
+        except NotImplementedError:       # Windows
+            pass
 
-    conn = aiohttp.TCPConnector(limit=CONCURRENCY)
-    async with aiohttp.ClientSession(connector=conn, timeout=TIMEOUT) as sess:
-        workers = [asyncio.create_task(worker(queue, sess)) for _ in range(CONCURRENCY)]
-        await queue.join()                # attend que la file soit vide
-        for w in workers: w.cancel()      # arrête les workers
+    t0      = time.monotonic()
+    results = asyncio.Queue(maxsize=concurrency * 4)
+    sink    = DbSink(db) if to_db else FileSink(OUT_FILE, db)
+    writer_task = asyncio.create_task(writer(results, sink))
+    try:
+        bucket = AsyncTokenBucket(rate, concurrency)
+        ids    = iter(todo)
+        conn   = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=conn, timeout=TIMEOUT) as sess:
+            crawl = asyncio.gather(*(
+                worker(ids, results, sess, bucket, stop) for _ in range(concurrency)
+            ))
+            await asyncio.wait({crawl, writer_task}, return_when=asyncio.FIRST_COMPLETED)
+            if writer_task.done():        # écriture en échec : inutile de continuer
+                crawl.cancel()
+                writer_task.result()
+            await crawl
+        await results.put(None)
+        written = await writer_task
+    finally:
+        writer_task.cancel()
+        sink.close()
+        db.close()
+    print(f"💾 {written} items écrits dans {'daily_raw' if to_db else OUT_FILE} en {time.monotonic() - t0:.0f}s"
+          + (" (interrompu)" if stop.is_set() else ""))
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--concurrency", type=int, default=CONCURRENCY, help="workers simultanés")
+    ap.add_argument("--rate", type=float, default=RATE, help="requêtes par seconde")
+    ap.add_argument("--to-db", action="store_true",
+                    help="insère directement dans daily_raw au lieu de trends.jsonl")
+    args = ap.parse_args()
+    asyncio.run(main(args.concurrency, args.rate, args.to_db))
@@ -0,0 +1,140 @@
+# snapfmt.py
+# ------------------------------------------------------------------
+# Format binaire compact des captures (.gw2s), alternative au JSON.
+#
+#   en-tête  : "<4sBBHIq"  magic b"GW2S", version, flags, réservé,
+#              nombre de lignes, base_ts (µs depuis l'epoch, UTC)
+#   payload  : zlib( 6 colonnes int32 little-endian, octets « shufflés » )
+#              item_id (trié, codé en écarts au précédent),
+#              ts (ms depuis base_ts), buy_price, buy_quantity,
+#              sell_price, sell_quantity
+#
+# Le shuffle regroupe l'octet n de chaque entier : les poids forts,
+# presque toujours nuls, se compressent alors très bien.  Au décodage
+# les colonnes sont relues telles quelles avec array.frombytes.
+# ------------------------------------------------------------------
+
+import datetime
+import struct
+import sys
+import zlib
+from array import array
+from pathlib import Path
+
+MAGIC   = b"GW2S"
+VERSION = 1
+SUFFIX  = ".gw2s"
+
+FLAG_DELTA = 0x01       # capture delta : seuls les items modifiés sont présents
+
+_HEADER = struct.Struct("<4sBBHIq")
+_FIELDS = ("item_id", "ts", "buy_price", "buy_quantity", "sell_price", "sell_quantity")
+_EPOCH  = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+assert array("i").itemsize == 4
+
+
+def _shuffle(raw: bytes) -> bytes:
+    return b"".join(raw[i::4] for i in range(4))
+
+
+def _unshuffle(raw: bytes) -> bytes:
+    n = len(raw) // 4
+    out = bytearray(len(raw))
+    for i in range(4):
+        out[i::4] = raw[i * n:(i + 1) * n]
+    return bytes(out)
+
+
+def _to_us(ts) -> int:
+    if isinstance(ts, str):
+        ts = datetime.datetime.fromisoformat(ts)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    return (ts - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def encode(rows, flags: int = 0, base_ts=None) -> bytes:
+    """
+    Encode des lignes au format daily_raw (dicts) ; l'ordre n'importe pas.
+    `base_ts` (début de capture) doit précéder toutes les lignes ; par
+    défaut, le plus petit ts présent.
+    """
+    rows = sorted(rows, key=lambda r: r["item_id"])
+    stamps = [_to_us(r["ts"]) for r in rows]
+    base = _to_us(base_ts) if base_ts is not None else min(stamps, default=0)
+
+    cols = {f: array("i") for f in _FIELDS}
+    prev = 0
+    for r, us in zip(rows, stamps):
+        cols["item_id"].append(r["item_id"] - prev)
+        prev = r["item_id"]
+        cols["ts"].append((us - base) // 1000)
+        for f in _FIELDS[2:]:
+            cols[f].append(r[f])
+
+    if sys.byteorder != "little":
+        for a in cols.values():
+            a.byteswap()
+    payload = b"".join(_shuffle(cols[f].tobytes()) for f in _FIELDS)
+    header = _HEADER.pack(MAGIC, VERSION, flags, 0, len(rows), base)
+    return header + zlib.compress(payload, 9)
+
+
+def decode(data: bytes) -> tuple[int, int, dict[str, array]]:
+    """Retourne (flags, base_ts µs, colonnes) ; item_id absolus, ts en ms relatifs."""
+    magic, version, flags, _, n, base = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("fichier .gw2s invalide ou version inconnue")
+    payload = zlib.decompress(data[_HEADER.size:])
+    size = 4 * n
+
+    cols = {}
+    for i, f in enumerate(_FIELDS):
+        a = array("i")
+        a.frombytes(_unshuffle(payload[i * size:(i + 1) * size]))
+        if sys.byteorder != "little":
+            a.byteswap()
+        cols[f] = a
+
+    ids, acc = cols["item_id"], 0
+    for i in range(n):
+        acc += ids[i]
+        ids[i] = acc
+    return flags, base, cols
+
+
+def write_snapshot(path: Path, rows, flags: int = 0, base_ts=None) -> None:
+    Path(path).write_bytes(encode(rows, flags, base_ts))
+
+
+def to_datetime(us: int) -> datetime.datetime:
+    """µs depuis l'epoch → datetime UTC naïf (comme daily_raw.ts)."""
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=us)
+
+
+def read_header(path: Path) -> tuple[int, int, int]:
+    """(flags, nombre de lignes, base_ts µs) sans décompresser le payload."""
+    with open(path, "rb") as f:
+        _, _, flags, _, n, base = _HEADER.unpack(f.read(_HEADER.size))
+    return flags, n, base
+
+
+def iter_rows(path: Path):
+    """Génère les lignes au même format que le JSON (ts ISO 8601 UTC)."""
+    _, base, cols = decode(Path(path).read_bytes())
+    stamps: dict[int, str] = {}          # un ts par chunk : on formate une fois
+    for i in range(len(cols["item_id"])):
+        off = cols["ts"][i]
+        if (ts := stamps.get(off)) is None:
+            ts = stamps[off] = (
+                _EPOCH + datetime.timedelta(microseconds=base + off * 1000)
+            ).isoformat()
+        yield {
+            "item_id": cols["item_id"][i],
+            "ts": ts,
+            "buy_price": cols["buy_price"][i],
+            "buy_quantity": cols["buy_quantity"][i],
+            "sell_price": cols["sell_price"][i],
+            "sell_quantity": cols["sell_quantity"][i],
+        }
@@ -0,0 +1,308 @@
+# tick_archive.py
+# ----------------------------------------------------------------
+# Archive locale des ticks bruts, pour pouvoir recalculer snapshots
+# après la purge (nouvelle métrique, formule corrigée).
+#
+# Si TICK_ARCHIVE_DIR est défini, aggregate_daily exporte chaque jour
+# agrégé juste avant de le purger (même transaction), un fichier par
+# jour, trié par (item_id, ts) :
+#
+#   2025-07-14.npz   item_id, ts_ms (ms depuis minuit), buy_price,
+#                    sell_price, buy_quantity, sell_quantity
+#                    int32 compressés, -1 = NULL (prix et quantités
+#                    sont positifs)
+#
+# Ce sont les ticks que l'agrégation a lus : bruts (tick_store.ticks),
+# ou reconstruits sur la grille des captures avec --forward-fill (les
+# captures delta seules donneraient d'autres quantités, médianes,
+# écarts-types) ; la ré-agrégation retrouve donc les mêmes snapshots.
+#
+# La ré-agrégation ne recharge pas les ticks dans Postgres : les
+# colonnes de daily_stats sont calculées en NumPy par jour (pool de
+# processus), puis seules ces stats — une ligne par item — sont
+# copiées dans une table temporaire et passées à upsert_snapshots,
+# donc les formules de snapshot_columns restent les seules.
+#
+#   python tick_archive.py reaggregate --from 2025-01-01 --to 2025-06-30
+# ----------------------------------------------------------------
+
+import argparse
+import datetime
+import io
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import BigInteger, Date, Float, Numeric, cast, column, func, select, table, text
+from sqlalchemy.dialects import postgresql
+
+load_dotenv()
+import tick_store
+from aggregate_daily import upsert_snapshots
+from models import Session, notify
+
+ARCHIVE_DIR = Path(os.getenv("TICK_ARCHIVE_DIR", ".tick_archive"))
+WORKERS     = os.cpu_count() or 1
+
+COLUMNS = ("item_id", "ts_ms", "buy_price", "sell_price", "buy_quantity", "sell_quantity")
+STAGE   = "archive_stats"
+CHUNK_ROWS = 1_000_000          # lignes lues à la fois par export_ticks
+
+
+def day_path(day: datetime.date, archive_dir: Path = ARCHIVE_DIR) -> Path:
+    return archive_dir / f"{day}.npz"
+
+
+def archived_days(archive_dir: Path = ARCHIVE_DIR) -> list[datetime.date]:
+    if not archive_dir.exists():
+        return []
+    return sorted(datetime.date.fromisoformat(p.stem) for p in archive_dir.glob("????-??-??.npz"))
+
+
+# ----------------------------------------------------------------
+# Export (avant purge)
+# ----------------------------------------------------------------
+def _columns(t, midnight) -> list:
+    ms = func.floor(func.extract("epoch", t.c.ts - midnight) * 1000)
+    return [t.c.item_id, ms, *(func.coalesce(t.c[c], -1) for c in COLUMNS[2:])]
+
+
+def _copy_out(s, q, buf) -> None:
+    sql = q.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    cur = s.connection().connection.cursor()
+    try:
+        cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv)", buf)
+    finally:
+        cur.close()
+    buf.seek(0)
+
+
+def _write(day: datetime.date, df: pd.DataFrame, archive_dir: Path) -> int:
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    path = day_path(day, archive_dir)
+    tmp = path.with_name(path.stem + ".tmp.npz")
+    np.savez_compressed(tmp, **{c: df[c].to_numpy() for c in COLUMNS})
+    tmp.replace(path)
+    return len(df)
+
+
+def export_day(s, day: datetime.date, archive_dir: Path = ARCHIVE_DIR) -> int:
+    """Écrit les ticks bruts du jour `day` ; retourne le nombre de ticks."""
+    ts0 = datetime.datetime.combine(day, datetime.time())
+    t = tick_store.ticks(ts0, ts0 + datetime.timedelta(days=1)).subquery("t")
+    with tempfile.TemporaryFile() as buf:
+        _copy_out(s, select(*_columns(t, ts0)).order_by(t.c.item_id, t.c.ts), buf)
+        df = pd.read_csv(buf, names=COLUMNS, dtype=np.int32)
+    return _write(day, df, archive_dir)
+
+
+def export_ticks(s, ticks, days, archive_dir: Path = ARCHIVE_DIR) -> dict:
+    """Écrit les jours `days` d'un SELECT de ticks couvrant plusieurs jours
+    (ex. aggregate_daily.ff_ticks sur toute la plage) : la requête est
+    exécutée une seule fois, triée par jour puis découpée en lisant, au
+    lieu d'être refaite (forward-fill compris) pour chaque jour.
+    Retourne {jour: nombre de ticks}."""
+    days = sorted(set(days))
+    t = ticks.subquery("t")
+    day = cast(t.c.ts, Date)
+    first = datetime.datetime.combine(days[0], datetime.time())
+    last = datetime.datetime.combine(days[-1], datetime.time()) + datetime.timedelta(days=1)
+    q = (
+        select(day, *_columns(t, func.date_trunc("day", t.c.ts)))
+        .where(t.c.ts >= first, t.c.ts < last, day.in_(days))
+        .order_by(day, t.c.item_id, t.c.ts)
+    )
+    counts, parts, current = {}, [], None
+    with tempfile.TemporaryFile() as buf:
+        _copy_out(s, q, buf)
+        chunks = pd.read_csv(buf, names=("day", *COLUMNS), chunksize=CHUNK_ROWS,
+                             dtype={"day": str, **{c: np.int32 for c in COLUMNS}})
+        for chunk in chunks:
+            for d, df in chunk.groupby("day", sort=False):
+                if d != current and parts:          # jour suivant : le précédent est complet
+                    counts[current] = _write(current, pd.concat(parts), archive_dir)
+                    parts = []
+                current = datetime.date.fromisoformat(d) if isinstance(d, str) else d
+                parts.append(df[list(COLUMNS)])
+        if parts:
+            counts[current] = _write(current, pd.concat(parts), archive_dir)
+    return counts
+
+
+def export_days(s, days, archive_dir: Path = ARCHIVE_DIR, ticks=None) -> None:
+    """Archive les jours `days` : ticks bruts jour par jour, ou `ticks` (ceux
+    que l'agrégation a lus) en un seul passage."""
+    if ticks is None:
+        counts = {day: export_day(s, day, archive_dir) for day in sorted(set(days))}
+    else:
+        counts = export_ticks(s, ticks, days, archive_dir)
+    for day, n in counts.items():
+        print(f"📦 {day} : {n} ticks archivés")
+
+
+# ----------------------------------------------------------------
+# Stats journalières en NumPy (colonnes de aggregate_daily.daily_stats)
+# ----------------------------------------------------------------
+def _valid(a: np.ndarray) -> np.ndarray:
+    return np.where(a < 0, np.nan, a.astype("float64"))
+
+
+def _count(v: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    return np.add.reduceat((~np.isnan(v)).astype(np.int64), starts)
+
+
+def _median(v: np.ndarray, group: np.ndarray, starts: np.ndarray, counts: np.ndarray):
+    # un seul tri sur la clé (groupe, valeur) ; NULL en fin de groupe,
+    # médiane parmi les `counts` premiers
+    key = group.astype(np.int64) << 32 | np.nan_to_num(v, nan=2**32 - 1).astype(np.int64)
+    key.sort()
+    val = (key & 0xFFFFFFFF).astype("float64")
+    lo = val[starts + np.maximum(counts - 1, 0) // 2]
+    hi = val[starts + counts // 2]
+    return np.where(counts > 0, (lo + hi) / 2, np.nan)
+
+
+def day_stats(path: Path) -> pd.DataFrame:
+    """Une ligne par item : les agrégats de daily_stats, sommes et effectifs
+    à la place des moyennes (divisées en SQL, comme avg())."""
+    with np.load(path) as z:
+        item = z["item_id"]
+        cols = {c: _valid(z[c]) for c in COLUMNS[2:]}
+    starts = np.flatnonzero(np.r_[True, item[1:] != item[:-1]])
+    group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(item)]))
+    last = np.r_[starts[1:], len(item)] - 1
+
+    out = {"item_id": item[starts], "day": datetime.date.fromisoformat(path.stem)}
+    spread = cols["sell_price"] - cols["buy_price"]
+    for side in ("buy", "sell"):
+        v = cols[f"{side}_price"]
+        n = _count(v, starts)
+        total = np.add.reduceat(np.nan_to_num(v), starts)
+        mean = np.where(n > 0, total / np.maximum(n, 1), np.nan)
+        var = np.add.reduceat(np.nan_to_num((v - mean[group]) ** 2), starts) / np.maximum(n, 1)
+        out |= {
+            f"open_{side}": v[starts], f"close_{side}": v[last],
+            f"min_{side}": np.fmin.reduceat(v, starts), f"max_{side}": np.fmax.reduceat(v, starts),
+            f"sum_{side}": total, f"n_{side}": n,
+            f"median_{side}": _median(v, group, starts, n),
+            f"std_{side}": np.where(n > 0, np.sqrt(var), np.nan),
+        }
+    n = _count(spread, starts)
+    out |= {
+        "sum_spread": np.add.reduceat(np.nan_to_num(spread), starts), "n_spread": n,
+        "min_spread": np.fmin.reduceat(spread, starts), "max_spread": np.fmax.reduceat(spread, starts),
+    }
+    # quantités exécutées : baisses d'un tick à l'autre, dans l'item
+    first = np.zeros(len(item), bool)
+    first[starts] = True
+    for side, qty in (("buy", "sell_quantity"), ("sell", "buy_quantity")):
+        q = cols[qty]
+        drop = np.r_[np.nan, q[:-1]] - q
+        drop = np.where(~first & (drop > 0), drop, 0)
+        out[f"exec_{side}_qty"] = np.add.reduceat(drop, starts)
+    for side in ("buy", "sell"):
+        q = cols[f"{side}_quantity"]
+        listed = np.add.reduceat(np.nan_to_num(q), starts)
+        out[f"tot_{side}_listed"] = np.where(_count(q, starts) > 0, listed, np.nan)
+
+    df = pd.DataFrame(out)
+    for c in df.columns.drop(["item_id", "day"]):
+        if c not in _FLOATS:
+            df[c] = df[c].astype("Int64")          # entiers, NULL conservés
+    return df
+
+
+# ----------------------------------------------------------------
+# Ré-agrégation
+# ----------------------------------------------------------------
+_STAT_COLS = (
+    "open_buy", "close_buy", "min_buy", "max_buy", "sum_buy", "n_buy", "median_buy", "std_buy",
+    "open_sell", "close_sell", "min_sell", "max_sell", "sum_sell", "n_sell", "median_sell", "std_sell",
+    "sum_spread", "n_spread", "min_spread", "max_spread",
+    "exec_buy_qty", "exec_sell_qty", "tot_buy_listed", "tot_sell_listed",
+)
+_FLOATS = ("median_buy", "median_sell", "std_buy", "std_sell")
+
+
+def _stats_select():
+    """Mêmes colonnes que daily_stats, lues dans la table de staging."""
+    st = table(STAGE, column("item_id"), column("day"),
+               *(column(c, Float if c in _FLOATS else BigInteger) for c in _STAT_COLS))
+    c = st.c
+
+    def avg(side):
+        # numeric / effectif, comme avg() sur des entiers
+        return (cast(c[f"sum_{side}"], Numeric) / func.nullif(c[f"n_{side}"], 0)).label(f"avg_{side}")
+
+    return select(
+        c.item_id, c.day,
+        c.open_buy, c.open_sell, c.close_buy, c.close_sell,
+        c.min_buy, c.max_buy, c.min_sell, c.max_sell,
+        avg("buy"), avg("sell"), c.median_buy, c.median_sell, c.std_buy, c.std_sell,
+        avg("spread"), c.min_spread, c.max_spread,
+        (c.max_buy - c.min_buy).label("delta_buy"),
+        (c.max_sell - c.min_sell).label("delta_sell"),
+        c.tot_buy_listed, c.tot_sell_listed, c.exec_buy_qty, c.exec_sell_qty,
+    )
+
+
+def load_stats(s, df: pd.DataFrame) -> list[datetime.date]:
+    """Upsert des stats d'un jour dans snapshots (transaction de `s`)."""
+    s.execute(text(
+        f"CREATE TEMP TABLE IF NOT EXISTS {STAGE} (item_id integer, day date, "
+        + ", ".join(f"{c} {'float8' if c in _FLOATS else 'bigint'}" for c in _STAT_COLS)
+        + ") ON COMMIT DELETE ROWS"
+    ))
+    buf = io.StringIO()
+    df[["item_id", "day", *_STAT_COLS]].to_csv(buf, index=False, header=False, na_rep="")
+    buf.seek(0)
+    cur = s.connection().connection.cursor()
+    try:
+        cur.copy_expert(f"COPY {STAGE} FROM STDIN WITH (FORMAT csv)", buf)
+    finally:
+        cur.close()
+    return upsert_snapshots(s, _stats_select())
+
+
+def reaggregate(start: datetime.date, end: datetime.date, workers: int = WORKERS,
+                archive_dir: Path = ARCHIVE_DIR) -> None:
+    days = [d for d in archived_days(archive_dir) if start <= d <= end]
+    if not days:
+        print("👍 Aucun jour archivé sur la période.")
+        return
+    t0 = time.monotonic()
+    paths = [day_path(d, archive_dir) for d in days]
+    with ProcessPoolExecutor(max_workers=workers) as pool, Session() as s:
+        # calcul en parallèle, écriture dans l'ordre, un jour par transaction
+        for day, df in zip(days, pool.map(day_stats, paths)):
+            n = len(load_stats(s, df))
+            notify(s.connection(), "snapshots")
+            s.commit()
+            print(f"♻️  {day} : {n} snapshots recalculés")
+    print(f"✅ {len(days)} jours en {time.monotonic() - t0:.1f}s")
+
+    if os.getenv("HISTORY_CACHE_DIR"):
+        import history_cache
+        history_cache.update(days)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("command", choices=("reaggregate",))
+    ap.add_argument("--from", dest="start", type=datetime.date.fromisoformat,
+                    default=datetime.date.min, help="premier jour (défaut : début de l'archive)")
+    ap.add_argument("--to", dest="end", type=datetime.date.fromisoformat,
+                    default=datetime.date.max, help="dernier jour inclus (défaut : fin de l'archive)")
+    ap.add_argument("--workers", type=int, default=WORKERS, help="processus de calcul")
+    ap.add_argument("--dir", type=Path, default=ARCHIVE_DIR, help="dossier de l'archive")
+    args = ap.parse_args()
+    reaggregate(args.start, args.end, args.workers, args.dir)
+
+
+if __name__ == "__main__":
+    main()
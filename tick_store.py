@@ -0,0 +1,162 @@
+# tick_store.py
+# ------------------------------------------------------------------
+# Stockage des ticks bruts, choisi par RAW_STORAGE :
+#
+#   rows   (défaut) : daily_raw, une ligne par tick (id, FK, index
+#                     unique (item_id, ts), partitions journalières) ;
+#   packed          : daily_ticks, une ligne par (item_id, jour,
+#                     tranche de PART_HOURS heures) avec des tableaux
+#                     int4 alignés (ts_ms, prix, quantités), ~25 octets
+#                     par tick et un seul petit index (mesuré à une
+#                     capture / 3 min : table ~5× et index ~150× plus
+#                     petits que daily_raw) ; la journée d'un item se
+#                     lit en quelques lignes contiguës de l'index.
+#
+# À l'ingestion (bulk_ingest.load_rows), les ticks nouveaux sont
+# ajoutés en fin de tableau ; un lot antérieur au dernier tick connu
+# (rattrapage) est fusionné puis retrié.  Postgres réécrit le tableau
+# entier à chaque ajout : les tranches bornent cette réécriture (~80
+# ticks à une capture / 3 min, stockés en ligne, hors TOAST) alors
+# qu'un tableau par jour rendait les dernières captures de la journée
+# 5× plus lentes à ingérer.  Les doublons (item_id, ts) sont ignorés
+# comme par ON CONFLICT DO NOTHING ; ts est tronqué à la milliseconde.
+#
+# À la lecture, ticks(start, end) rend un SELECT aux colonnes de
+# daily_raw quel que soit le stockage (unnest des tableaux en mode
+# packed) : daily_stats, le forward-fill, les barres OHLC, la médiane
+# exacte et find_fast_flips s'en servent tels quels.  En mode packed,
+# daily_raw reste lu aussi (et les deux sont purgés) : on peut basculer
+# en cours de journée.
+# ------------------------------------------------------------------
+
+import datetime
+import os
+
+from sqlalchemy import DateTime, cast, delete, func, literal_column, select, true, union_all
+
+from models import DailyRaw, DailyTicks
+
+RAW_STORAGE = os.getenv("RAW_STORAGE", "rows")
+PACKED      = RAW_STORAGE == "packed"
+ARRAYS      = ("buy_price", "buy_quantity", "sell_price", "sell_quantity")
+PART_HOURS  = 4
+
+_PART_MS = PART_HOURS * 3600 * 1000
+
+_MS = literal_column("interval '1 millisecond'")
+
+
+# ------------------------------------------------------------------
+# Ingestion (SQL brut, composé par bulk_ingest)
+# ------------------------------------------------------------------
+def _merged(col: str) -> str:
+    # tableaux existant + lot, retriés par ts_ms (lot hors ordre)
+    old, new = "daily_ticks", "EXCLUDED"
+    if col == "ts_ms":
+        return f"(SELECT array_agg(t ORDER BY t) FROM unnest({old}.ts_ms || {new}.ts_ms) AS u(t))"
+    return (f"(SELECT array_agg(v ORDER BY t) FROM unnest("
+            f"{old}.ts_ms || {new}.ts_ms, {old}.{col} || {new}.{col}) AS u(t, v))")
+
+
+def append_ctes(source: str) -> str:
+    """
+    CTE SQL (à placer après `WITH`) qui ajoute à daily_ticks les ticks
+    de la table `source` (colonnes de daily_raw).  `ins` contient les
+    ticks réellement ajoutés, au format daily_raw ; la CTE packed_upsert
+    porte l'écriture.
+    """
+    ms = "(extract(epoch FROM s.ts - s.ts::date) * 1000)::int"
+    part = f"{ms} / {_PART_MS}"
+    cols = ", ".join(ARRAYS)
+    aggs = ", ".join(f"array_agg({c} ORDER BY ts)" for c in ("ts_ms", *ARRAYS))
+    in_order = "EXCLUDED.ts_ms[1] > daily_ticks.ts_ms[cardinality(daily_ticks.ts_ms)]"
+    sets = ", ".join(
+        f"{c} = CASE WHEN {in_order} THEN daily_ticks.{c} || EXCLUDED.{c} ELSE {_merged(c)} END"
+        for c in ("ts_ms", *ARRAYS)
+    )
+    return f"""
+    ins AS (
+        SELECT DISTINCT ON (s.item_id, s.ts) s.item_id, s.ts, {ms} AS ts_ms, {part} AS part,
+               {", ".join(f"s.{c}" for c in ARRAYS)}
+        FROM (SELECT item_id, date_trunc('milliseconds', ts) AS ts, {cols}
+              FROM {source}) s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM daily_ticks d
+            WHERE d.item_id = s.item_id AND d.day = s.ts::date AND d.part = {part}
+              AND {ms} <= d.ts_ms[cardinality(d.ts_ms)]
+              AND {ms} = ANY (d.ts_ms)
+        )
+        ORDER BY s.item_id, s.ts
+    ),
+    packed_upsert AS (
+        INSERT INTO daily_ticks (item_id, day, part, ts_ms, {cols})
+        SELECT item_id, ts::date, part, {aggs}
+        FROM ins GROUP BY item_id, ts::date, part
+        ON CONFLICT (item_id, day, part) DO UPDATE SET {sets}
+    )"""
+
+
+# ------------------------------------------------------------------
+# Lecture : ticks [start, end[ au format daily_raw
+# items = (lo, hi) : seulement les item_id de [lo, hi[
+# ------------------------------------------------------------------
+def _rows(start, end, items):
+    q = (
+        select(
+            DailyRaw.item_id, DailyRaw.ts,
+            DailyRaw.buy_price, DailyRaw.sell_price,
+            DailyRaw.buy_quantity, DailyRaw.sell_quantity,
+        )
+        .where(DailyRaw.ts < end)
+    )
+    if items is not None:
+        q = q.where(DailyRaw.item_id >= items[0], DailyRaw.item_id < items[1])
+    return q if start is None else q.where(DailyRaw.ts >= start)
+
+
+def _packed(start, end, items):
+    d = DailyTicks
+    u = (
+        func.unnest(d.ts_ms, *(getattr(d, c) for c in ARRAYS))
+        .table_valued("ms", *ARRAYS)
+        .render_derived(name="u")
+    )
+    ts = (cast(d.day, DateTime) + u.c.ms * _MS).label("ts")
+    q = (
+        select(d.item_id, ts, u.c.buy_price, u.c.sell_price, u.c.buy_quantity, u.c.sell_quantity)
+        .select_from(d)
+        .join(u, true())
+        .where(d.day < end)
+    )
+    # bornes hors minuit : filtre au tick près
+    if end != datetime.datetime.combine(end.date(), datetime.time()):
+        q = q.where(ts < end)
+    if start is not None:
+        q = q.where(d.day >= start.date())
+        if start != datetime.datetime.combine(start.date(), datetime.time()):
+            q = q.where(ts >= start)
+    if items is not None:
+        q = q.where(d.item_id >= items[0], d.item_id < items[1])
+    return q
+
+
+def ticks(start: datetime.datetime | None, end: datetime.datetime,
+          items: tuple[int, int] | None = None):
+    """SELECT (item_id, ts, buy_price, sell_price, buy_quantity, sell_quantity)
+    des ticks de [start, end[, filtrés par plage (utilisable par index)."""
+    if PACKED:
+        return union_all(_packed(start, end, items), _rows(start, end, items))
+    return _rows(start, end, items)
+
+
+def packed_days(s, end: datetime.datetime) -> set[datetime.date]:
+    """Jours présents dans daily_ticks avant `end`."""
+    return set(s.scalars(select(DailyTicks.day).where(DailyTicks.day < end).distinct()))
+
+
+def purge_packed(s, start: datetime.datetime | None, end: datetime.datetime) -> int:
+    """Supprime les lignes daily_ticks des jours de [start, end[."""
+    q = delete(DailyTicks).where(DailyTicks.day < end)
+    if start is not None:
+        q = q.where(DailyTicks.day >= start.date())
+    return s.execute(q).rowcount